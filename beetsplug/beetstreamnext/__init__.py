@@ -46,6 +46,12 @@ import beetsplug.beetstreamnext.songs
 import beetsplug.beetstreamnext.users
 import beetsplug.beetstreamnext.general
 import beetsplug.beetstreamnext.authentication
+from beetsplug.beetstreamnext.catalog import Catalog
+from beetsplug.beetstreamnext.searchindex import search_index
+from beetsplug.beetstreamnext.similarity import similarity_engine
+from beetsplug.beetstreamnext.enrichment import EnrichmentWorker, enrich_library
+from beetsplug.beetstreamnext.thumbnails import thumbnail_cache
+from beetsplug.beetstreamnext.pregenerate import pregenerate_art, THUMBNAIL_SIZES, THUMBNAIL_FORMATS
 
 
 # Plugin hook
@@ -59,12 +65,29 @@ class BeetstreamNextPlugin(BeetsPlugin):
             'cors_supports_credentials': True,
             'reverse_proxy': False,
             'include_paths': False,
+            'stat_files': True,
             'never_transcode': False,
             'fetch_artists_images': False,
             'save_artists_images': True,
             'lastfm_api_key': '',
+            'local_similarity': True,
+            'enrichment_threads': 2,
             'playlist_dir': '',
+            'response_cache_size': 64,
+            'catalog': False,
+            'catalog_refresh_interval': 10,
             'users_storage': Path(config['library'].get()).parent / 'beetstreamnext_users.bin',
+            'artists_db': Path(config['library'].get()).parent / 'beetstreamnext_artists.db',
+            'search_index': Path(config['library'].get()).parent / 'beetstreamnext_search.db',
+            'metadata_cache': Path(config['library'].get()).parent / 'beetstreamnext_metadata.db',
+            'metadata_cache_size': 32,
+            'thumbnail_cache': Path(config['library'].get()).parent / 'beetstreamnext_thumbnails',
+            'thumbnail_cache_size': 256,
+            'thumbnail_sizes': list(THUMBNAIL_SIZES),
+            'thumbnail_formats': ['jpeg', 'webp', 'avif'],
+            'image_processes': 2,
+            'image_queue': 16,
+            'image_timeout': 10,
         })
         self.config['lastfm_api_key'].redact = True
 
@@ -84,6 +107,10 @@ class BeetstreamNextPlugin(BeetsPlugin):
         cmd = ui.Subcommand('beetstreamnext', help='run BeetstreamNext server, exposing OpenSubsonic API')
         cmd.parser.add_option('-d', '--debug', action='store_true', default=False, help='Debug mode')
         cmd.parser.add_option('-k', '--key', action='store_true', default=False, help='Generate a key to store passwords')
+        cmd.parser.add_option('-e', '--enrich', action='store_true', default=False,
+                              help='Fetch the bios, top tracks, similar artists and images of all artists, and exit')
+        cmd.parser.add_option('--pregenerate-art', action='store_true', default=False,
+                              help='Make the thumbnails of all the covers, and exit')
 
         def func(lib, opts, args):
             if opts.key:
@@ -116,23 +143,85 @@ class BeetstreamNextPlugin(BeetsPlugin):
                 self.config['port'] = int(args.pop(0))
 
             app.config['lastfm_api_key'] = self.config['lastfm_api_key'].get(None)
+            # Similar songs and artists computed from the library itself (needs NumPy), when Last.fm can't help
+            app.config['local_similarity'] = self.config['local_similarity'].get(True)
 
             app.config['fetch_artists_images'] = self.config['fetch_artists_images'].get(False)
             app.config['save_artists_images'] = self.config['save_artists_images'].get(False)
 
             app.config['root_directory'] = Path(config['directory'].get())
             app.config['users_storage'] = Path(self.config['users_storage'].get())
+            app.config['artists_db'] = Path(self.config['artists_db'].get())
+            app.config['search_index'] = Path(self.config['search_index'].get())
+            # Responses of Last.fm, Deezer and MusicBrainz, and its maximum size in MiB
+            app.config['metadata_cache'] = Path(self.config['metadata_cache'].get())
+            app.config['metadata_cache_size'] = self.config['metadata_cache_size'].get(float)
+            # Resized covers, and its maximum size in MiB (0 to disable it)
+            app.config['thumbnail_cache'] = Path(self.config['thumbnail_cache'].get())
+            app.config['thumbnail_cache_size'] = self.config['thumbnail_cache_size'].get(float)
+            # Processes resizing the covers (0 to do it in the request threads), how many covers can wait for them,
+            # and for how long (in seconds) before the original is sent instead
+            app.config['image_processes'] = self.config['image_processes'].get(int)
+            app.config['image_queue'] = self.config['image_queue'].get(int)
+            app.config['image_timeout'] = self.config['image_timeout'].get(float)
 
-            # Total number of items in the Beets database (only used to detect deletions in getIndexes endpoint)
-            # We initialise to +inf at BeetstreamNext start, so the real count is set the first time a client queries
-            # the getIndexes endpoint
-            app.config['nb_items'] = float('inf')
+            # Maximum size of the in-memory responses cache, in MiB (0 to disable it)
+            app.config['response_cache_size'] = self.config['response_cache_size'].get(float)
 
             app.config['lib'] = lib
             app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
-            app.config['INCLUDE_PATHS'] = self.config['include_paths']
+            app.config['INCLUDE_PATHS'] = self.config['include_paths'].get(False)
+            # When disabled, media files are never stat'ed: sizes are estimated from bitrate and length
+            app.config['stat_files'] = self.config['stat_files'].get(True)
             app.config['never_transcode'] = self.config['never_transcode'].get(False)
 
+            # Number of threads fetching the artists' data from Last.fm and Deezer (0 to do it in the requests)
+            enrichment_threads = self.config['enrichment_threads'].get(int)
+
+            if opts.enrich:
+                def progress(done, total, name):
+                    print(f'[{done}/{total}] {name}')
+                count = enrich_library(lib, threads=max(1, enrichment_threads), progress=progress)
+                print(f'Enriched {count} artists.')
+                return
+
+            if opts.pregenerate_art:
+                cache = thumbnail_cache()
+                if cache is None:
+                    print('The thumbnails cache is disabled (thumbnail_cache_size is 0).')
+                    return
+
+                def progress(done, total, made, elapsed):
+                    print(f'\r[{done}/{total}] {made} thumbnails, {done / max(elapsed, 1e-6):.1f} covers/s', end='')
+                sizes = [int(size) for size in self.config['thumbnail_sizes'].get(list)]
+                formats = [str(fmt).lower() for fmt in self.config['thumbnail_formats'].get(list)]
+                unsupported = [fmt for fmt in formats if fmt not in THUMBNAIL_FORMATS]
+                if unsupported:
+                    self._log.warning(f'Skipping the thumbnail formats Pillow can not make here: {", ".join(unsupported)}')
+                formats = [fmt for fmt in formats if fmt in THUMBNAIL_FORMATS]
+                covers, made = pregenerate_art(lib, cache, sizes=sizes, formats=formats, progress=progress)
+                print(f'\nMade {made} thumbnails of {covers} covers.')
+                return
+
+            # Build (or catch up) the full-text search index now, rather than on the first search
+            search_index(lib)
+            # And start computing the local similarities (in the background)
+            similarity_engine(lib)
+
+            # Serve the metadata from an in-memory copy of the library instead of querying SQLite
+            app.config['catalog'] = None
+            if self.config['catalog'].get(bool):
+                catalog = Catalog(lib)
+                catalog.start(interval=self.config['catalog_refresh_interval'].get(float))
+                app.config['catalog'] = catalog
+
+            # Prefetch the artists' data in the background (the most recently played first)
+            app.config['enrichment_worker'] = None
+            if enrichment_threads > 0 and (app.config['lastfm_api_key'] or app.config['fetch_artists_images']):
+                worker = EnrichmentWorker(lib, threads=enrichment_threads).start()
+                worker.submit_library()
+                app.config['enrichment_worker'] = worker
+
             possible_paths = [
                 (0, self.config['playlist_dir'].get(None)),  # BeetstreamNext's own
                 (1, config['playlist']['playlist_dir'].get(None)),  # Playlist plugin
@@ -1,15 +1,19 @@
 from beetsplug.beetstreamnext.utils import *
 from beetsplug.beetstreamnext import authentication
 from beetsplug.beetstreamnext import app
+from beetsplug.beetstreamnext.cache import cached_response, conditional_response
+from beetsplug.beetstreamnext.pagination import KeysetQuery, paginate, encode_cursor, decode_cursor
+from beetsplug.beetstreamnext.genreindex import genre_index
+from beetsplug.beetstreamnext.sampler import random_ids
 import flask
 import urllib.parse
-from functools import partial
 
 
 def album_payload(subsonic_album_id: str, with_songs=True) -> dict:
 
     beets_album_id = sub_to_beets_album(subsonic_album_id)
-    album_object = flask.g.lib.get_album(beets_album_id)
+    catalog = app.config.get('catalog')
+    album_object = catalog.album(beets_album_id) if catalog is not None else next(iter_rows('albums', [beets_album_id]), None)
 
     payload = {
         "album": {
@@ -20,6 +24,7 @@ def album_payload(subsonic_album_id: str, with_songs=True) -> dict:
 
 @app.route('/rest/getAlbum', methods=["GET", "POST"])
 @app.route('/rest/getAlbum.view', methods=["GET", "POST"])
+@conditional_response
 def get_album():
     r = flask.request.values
     album_id = r.get('id')
@@ -31,12 +36,15 @@ def get_album():
 
 @app.route('/rest/getAlbumInfo2', methods=["GET", "POST"])
 @app.route('/rest/getAlbumInfo2.view', methods=["GET", "POST"])
+@conditional_response
+@cached_response
 def get_album_info(ver=None):
     r = flask.request.values
 
     req_id = r.get('id')
     album_id = sub_to_beets_album(req_id)
-    album = flask.g.lib.get_album(album_id)
+    catalog = app.config.get('catalog')
+    album = catalog.album(album_id) if catalog is not None else next(iter_rows('albums', [album_id]), None)
 
     artist_quot = urllib.parse.quote(album.get('albumartist', ''))
     album_quot = urllib.parse.quote(album.get('album', ''))
@@ -59,6 +67,8 @@ def get_album_info(ver=None):
 
 @app.route('/rest/getAlbumList2', methods=["GET", "POST"])
 @app.route('/rest/getAlbumList2.view', methods=["GET", "POST"])
+@conditional_response(when=lambda r: r.get('type') != 'random')
+@cached_response(when=lambda r: r.get('type') != 'random')
 def get_album_list(ver=None):
 
     r = flask.request.values
@@ -71,8 +81,42 @@ def get_album_list(ver=None):
     to_year = int(r.get('toYear', 3000))
     genre_filter = r.get('genre')
 
-    # Start building the base query
-    query = "SELECT * FROM albums"
+    next_cursor = None
+    catalog = app.config.get('catalog')
+    if sort_by == 'random':
+        album_ids = random_ids('albums', size, genre_filter,
+                               int(r['fromYear']) if r.get('fromYear') else None,
+                               int(r['toYear']) if r.get('toYear') else None)
+        albums = filter(None, map(catalog.album, album_ids)) if catalog is not None else iter_rows('albums', album_ids)
+    elif sort_by == 'byGenre' and genre_filter:
+        # Exact genre matches, from the genre index (a cursor is the ID of the last album of the previous page)
+        position = decode_cursor(r['cursor']) if r.get('cursor') else None
+        album_ids = genre_index().album_ids(genre_filter, size, offset, position[-1] if position else None)
+        if size and len(album_ids) == size:
+            next_cursor = encode_cursor((album_ids[-1],))
+        albums = filter(None, map(catalog.album, album_ids)) if catalog is not None else iter_rows('albums', album_ids)
+    elif catalog is not None:
+        albums = catalog.album_list(sort_by, size, offset, from_year, to_year)
+    else:
+        query = _album_list_query(sort_by, from_year, to_year)
+        signature = ('albumList', sort_by, from_year, to_year)
+        album_ids, next_cursor = paginate(query, signature, size, offset, r.get('cursor'))
+        albums = iter_rows('albums', album_ids)
+
+    tag = 'albumList2' if flask.request.path.rsplit('.', 1)[0].endswith('2') else 'albumList'
+    payload = {
+        tag: {                        # albumList response does not include songs
+            "album": list(map_albums(albums, with_songs=False))
+        }
+    }
+    if next_cursor:
+        # Not part of the Subsonic API: clients that know about it can pass it back as the 'cursor' parameter
+        payload[tag]['nextCursor'] = next_cursor
+    return subsonic_response(payload, r.get('f', 'xml'))
+
+
+def _album_list_query(sort_by: str, from_year: int, to_year: int) -> KeysetQuery:
+
     conditions = []
     params = []
 
@@ -81,43 +125,22 @@ def get_album_list(ver=None):
         conditions.append("year BETWEEN ? AND ?")
         params.extend([min(from_year, to_year), max(from_year, to_year)])
 
-    if sort_by == 'byGenre' and genre_filter:
-        conditions.append("lower(genre) LIKE ?")
-        params.append(f"%{genre_filter.strip().lower()}%")
-
-    if conditions:
-        query += " WHERE " + " AND ".join(conditions)
-
-    # ordering based on sort_by parameter
+    # ordering based on sort_by parameter (the album ID is always the last sort key)
+    keys = ()
+    descending = False
     if sort_by == 'newest':
-        query += " ORDER BY added DESC"
+        keys, descending = ("COALESCE(added, 0)",), True
     elif sort_by == 'alphabeticalByName':
-        query += " ORDER BY album COLLATE NOCASE"
+        keys = ("COALESCE(album, '') COLLATE NOCASE",)
     elif sort_by == 'alphabeticalByArtist':
-        query += " ORDER BY albumartist COLLATE NOCASE"
+        keys = ("COALESCE(albumartist, '') COLLATE NOCASE",)
     elif sort_by == 'recent':
-        query += " ORDER BY year DESC"
+        keys, descending = ("COALESCE(year, 0)",), True
     elif sort_by == 'byYear':
         # Order by year, then by month and day
-        sort_dir = 'ASC' if from_year <= to_year else 'DESC'
-        query += f" ORDER BY year {sort_dir}, month {sort_dir}, day {sort_dir}"
-    elif sort_by == 'random':
-        query += " ORDER BY RANDOM()"
+        keys = ("COALESCE(year, 0)", "COALESCE(month, 0)", "COALESCE(day, 0)")
+        descending = from_year > to_year
 
     # TODO - sort_by: highest, frequent
 
-    # Add LIMIT and OFFSET for pagination
-    query += " LIMIT ? OFFSET ?"
-    params.extend([size, offset])
-
-    # Execute the query within a transaction
-    with flask.g.lib.transaction() as tx:
-        albums = tx.query(query, params)
-
-    tag = 'albumList2' if flask.request.path.rsplit('.', 1)[0].endswith('2') else 'albumList'
-    payload = {
-        tag: {                        # albumList response does not include songs
-            "album": list(map(partial(map_album, with_songs=False), albums))
-        }
-    }
-    return subsonic_response(payload, r.get('f', 'xml'))
\ No newline at end of file
+    return KeysetQuery('albums', keys, where=' AND '.join(conditions), params=params, descending=descending)
@@ -0,0 +1,131 @@
+from beetsplug.beetstreamnext.utils import strip_accents
+from beetsplug.beetstreamnext.cache import library_generation
+from beetsplug.beetstreamnext.artistregistry import artist_registry
+from beetsplug.beetstreamnext import app
+import threading
+from collections import defaultdict
+from array import array
+from itertools import groupby, islice
+from typing import List, Tuple, Union
+import flask
+
+
+class ArtistEntry:
+    """ Summary of an album artist, with everything the artists listings need """
+    __slots__ = ('id', 'name', 'sort_key', 'initial', 'album_count', 'mbid', 'cover_album_id', 'album_ids')
+
+    def __init__(self, artist_id: int, name: str, mbid: str, cover_album_id: int, album_ids: List[int]):
+        self.id = artist_id
+        self.name = name
+        self.sort_key = strip_accents(name).casefold()
+        self.initial = strip_accents(name[0]).upper()
+        self.album_count = len(album_ids)
+        self.mbid = mbid or ''
+        self.cover_album_id = cover_album_id
+        self.album_ids = array('q', album_ids)     # Ordered by year, then title
+
+
+class ArtistIndex:
+    """ Precomputed index of the album artists. When the library changes, the albums are read again (a single
+    query, on a few columns) and compared to the previous ones: only the artists whose albums changed are rebuilt.
+    This is where artists are registered in the artist registry (which gives them their ID): only the album artists
+    of the library get one """
+
+    def __init__(self):
+        self.generation = None
+        self.entries: List[ArtistEntry] = []     # Sorted by sort key
+        self.by_name = {}
+        self.groups: List[Tuple[str, List[ArtistEntry]]] = []
+        self._albums = {}       # album id -> (albumartist, mbid, has art, year, title)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_entry(artist_id: int, name: str, mbid: str, albums: List[tuple]) -> ArtistEntry:
+        albums.sort(key=lambda a: (a[1][3] or 0, a[1][4] or '', a[0]))
+        album_ids = [album_id for album_id, _ in albums]
+        with_art = [album_id for album_id, values in albums if values[2]]
+        return ArtistEntry(artist_id, name, mbid, min(with_art or album_ids), album_ids)
+
+    def refresh(self, lib) -> 'ArtistIndex':
+        generation = library_generation(lib)
+        if generation == self.generation:
+            return self
+
+        with self._lock:
+            if generation == self.generation:
+                # Someone else refreshed it in the meantime
+                return self
+
+            with lib.transaction() as tx:
+                rows = tx.query("""
+                    SELECT id, albumartist, mb_albumartistid, length(artpath) > 0, year, album
+                      FROM albums
+                     WHERE albumartist IS NOT NULL AND albumartist != ''
+                """)
+                # Album artists of songs without an album get an ID too (they don't have an entry)
+                singles = tx.query("""
+                    SELECT albumartist, MAX(mb_albumartistid)
+                      FROM items
+                     WHERE album_id IS NULL AND albumartist IS NOT NULL AND albumartist != ''
+                     GROUP BY albumartist
+                """)
+            albums = {row[0]: tuple(row[1:]) for row in rows}
+            registry = artist_registry()
+            registry.register((name, mbid or '') for name, mbid in singles if registry.id_for(name) is None)
+
+            # Artists with an album added, removed or changed (including the previous artist of a changed album)
+            changed = {values[0] for album_id, values in albums.items() if self._albums.get(album_id) != values}
+            changed |= {values[0] for album_id, values in self._albums.items() if albums.get(album_id) != values}
+
+            if changed:
+                changed_albums = defaultdict(list)
+                for album_id, values in albums.items():
+                    if values[0] in changed:
+                        changed_albums[values[0]].append((album_id, values))
+
+                mbids = {name: max(values[1] or '' for _, values in artist_albums)
+                         for name, artist_albums in changed_albums.items()}
+                ids = artist_registry().register(mbids.items())
+                updated = {name: self._make_entry(ids[name], name, mbids[name], artist_albums)
+                           for name, artist_albums in changed_albums.items()}
+
+                # The other entries are kept as they are (and so is their order)
+                entries = []
+                for entry in self.entries:
+                    if entry.name not in changed:
+                        entries.append(entry)
+                    elif entry.name in updated:
+                        entries.append(updated.pop(entry.name))
+                if updated:
+                    # New artists (sorting an almost sorted list is cheap)
+                    entries.extend(updated.values())
+                    entries.sort(key=lambda e: (e.sort_key, e.name))
+                by_name = {entry.name: entry for entry in entries}
+                groups = [(initial, list(group))
+                          for initial, group in groupby(sorted(entries, key=lambda e: e.initial),
+                                                        key=lambda e: e.initial)]
+
+                # Swap everything at once, so concurrent readers always see a consistent index
+                self.entries, self.by_name, self.groups = entries, by_name, groups
+                app.logger.debug(f'Artist index updated ({len(changed)} changed, {len(entries)} artists)')
+
+            self._albums = albums
+            self.generation = generation
+
+        return self
+
+    def get(self, name: str) -> Union[ArtistEntry, None]:
+        return self.by_name.get(name)
+
+    def search(self, query: str, count: int, offset: int = 0) -> List[ArtistEntry]:
+        """ Artists whose name contains query (case and accent insensitive), in alphabetical order """
+        query = strip_accents(query).casefold()
+        matches = (entry for entry in self.entries if query in entry.sort_key)
+        return list(islice(matches, offset, offset + count))
+
+
+_artist_index = ArtistIndex()
+
+
+def artist_index(lib=None) -> ArtistIndex:
+    return _artist_index.refresh(lib or flask.g.lib)
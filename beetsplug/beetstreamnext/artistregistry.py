@@ -0,0 +1,88 @@
+from beetsplug.beetstreamnext import app
+import os
+import sqlite3
+import threading
+from typing import Iterable, List, Tuple, Union
+
+
+class ArtistRegistry:
+    """ Persistent mapping between album artists and compact integer IDs.
+    IDs are never reused, so an artist keeps its ID for as long as the registry file exists (even if it
+    disappears from the library for a while). The whole mapping is also kept in memory for O(1) lookups """
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS artists (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL UNIQUE,
+                    mbid TEXT NOT NULL DEFAULT '')
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS artists_by_mbid ON artists (mbid)")
+            rows = self._conn.execute("SELECT id, name, mbid FROM artists").fetchall()
+
+        self._ids = {name: artist_id for artist_id, name, _ in rows}
+        self._names = {artist_id: name for artist_id, name, _ in rows}
+        self._mbids = {name: mbid for _, name, mbid in rows}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def id_for(self, name: str) -> Union[int, None]:
+        """ Returns the ID of an artist, or None if it is not registered (artists are only registered by
+        the artist index, see register) """
+        return self._ids.get(name)
+
+    def name_for(self, artist_id: int) -> Union[str, None]:
+        return self._names.get(artist_id)
+
+    def by_mbid(self, mbid: str) -> List[str]:
+        """ Names of the artists with the given MusicBrainz ID """
+        with self._lock:
+            rows = self._conn.execute("SELECT name FROM artists WHERE mbid = ?", (mbid,)).fetchall()
+        return [name for name, in rows]
+
+    def register(self, artists: Iterable[Tuple[str, str]]) -> dict:
+        """ Registers (name, mbid) pairs in a single transaction, and returns their IDs """
+
+        artists = list(artists)
+        with self._lock:
+            new = [(name, mbid or '') for name, mbid in artists if name not in self._ids]
+            outdated = [(mbid, name) for name, mbid in artists
+                        if mbid and name in self._ids and self._mbids.get(name) != mbid]
+
+            if new or outdated:
+                with self._conn:
+                    self._conn.executemany("INSERT OR IGNORE INTO artists (name, mbid) VALUES (?, ?)", new)
+                    self._conn.executemany("UPDATE artists SET mbid = ? WHERE name = ?", outdated)
+
+                for name, mbid in new:
+                    artist_id = self._conn.execute("SELECT id FROM artists WHERE name = ?", (name,)).fetchone()[0]
+                    self._ids[name] = artist_id
+                    self._names[artist_id] = name
+                    self._mbids[name] = mbid
+                for mbid, name in outdated:
+                    self._mbids[name] = mbid
+
+                if new:
+                    app.logger.debug(f'Registered {len(new)} new artists ({len(self._ids)} in total)')
+
+        return {name: self._ids[name] for name, _ in artists}
+
+
+_artist_registry = None
+_artist_registry_lock = threading.Lock()
+
+
+def artist_registry() -> ArtistRegistry:
+    global _artist_registry
+    if _artist_registry is None:
+        with _artist_registry_lock:
+            if _artist_registry is None:
+                # Without a configured file (tests, etc), IDs are only stable for the lifetime of the process
+                _artist_registry = ArtistRegistry(app.config.get('artists_db') or ':memory:')
+    return _artist_registry
@@ -1,8 +1,10 @@
 from beetsplug.beetstreamnext.utils import *
 from beetsplug.beetstreamnext import app
-import time
+from beetsplug.beetstreamnext.cache import cached_response, conditional_response, library_last_modified
+from beetsplug.beetstreamnext.artistindex import artist_index
+from beetsplug.beetstreamnext.similarity import similarity_engine
+from beetsplug.beetstreamnext.enrichment import lastfm_artist, deezer_artist
 import urllib.parse
-from collections import defaultdict
 from functools import partial
 import flask
 
@@ -10,18 +12,17 @@ import flask
 def artist_payload(subsonic_artist_id: str, with_albums=True) -> dict:
 
     artist_name = sub_to_beets_artist(subsonic_artist_id)
+    artist = artist_index().get(artist_name) or artist_name
 
+    # When part of a directory response or a ArtistWithAlbumsID3 response, albums are included
+    # I don't think there is any endpoint that returns an artist with albums AND songs?
     payload = {
         'artist': {
-            **map_artist(artist_name, with_albums=with_albums)
+            **map_artist(artist, with_albums=with_albums)
         }
     }
-
-    # When part of a directory response or a ArtistWithAlbumsID3 response
     if with_albums:
-        albums = flask.g.lib.albums(f'albumartist:{artist_name}')
-                                     # I don't think there is any endpoint that returns an artist with albums AND songs?
-        payload['artist']['album'] = list(map(partial(map_album, with_songs=False), albums))
+        payload['artist'].setdefault('album', [])
 
     return payload
 
@@ -31,47 +32,49 @@ def artist_payload(subsonic_artist_id: str, with_albums=True) -> dict:
 
 @app.route('/rest/getIndexes', methods=["GET", "POST"])
 @app.route('/rest/getIndexes.view', methods=["GET", "POST"])
+@conditional_response
+@cached_response
 def get_artists_or_indexes():
     r = flask.request.values
 
-    modified_since = r.get('ifModifiedSince', '')
+    modified_since = int(r.get('ifModifiedSince') or 0)
 
-    with flask.g.lib.transaction() as tx:
-        artists = [row[0] for row in tx.query("SELECT DISTINCT albumartist FROM albums WHERE albumartist is NOT NULL")]
+    tag = 'indexes' if flask.request.path.rsplit('.', 1)[0].endswith('Indexes') else 'artists'
 
-    alphanum_dict = defaultdict(list)
-    for artist in artists:
-        alphanum_dict[strip_accents(artist[0]).upper()].append(artist)
+    if tag == 'indexes':
+        # In milliseconds
+        last_modified = int(library_last_modified() * 1000)
+        if modified_since and last_modified <= modified_since:
+            # Nothing changed since the client last asked, so there is no need to send the artists again
+            payload = {
+                tag: {
+                    'ignoredArticles': '',
+                    'lastModified': last_modified
+                }
+            }
+            return subsonic_response(payload, r.get('f', 'xml'))
+
+    index = artist_index()
 
-    tag = 'indexes' if flask.request.path.rsplit('.', 1)[0].endswith('Indexes') else 'artists'
     payload = {
         tag: {
             'ignoredArticles': '',      # TODO - include config from 'the' plugin??
             'index': [
-                {'name': char, 'artist': list(map(map_artist, artists))}
-                for char, artists in sorted(alphanum_dict.items())
+                {'name': initial, 'artist': map(partial(map_artist, with_albums=False), entries)}
+                for initial, entries in index.groups
             ]
         }
     }
 
     if tag == 'indexes':
-        with flask.g.lib.transaction() as tx:
-            latest = int(tx.query('SELECT added FROM items ORDER BY added DESC LIMIT 1')[0][0])
-            # TODO - 'mtime' field?
-            nb_items = tx.query('SELECT COUNT(*) FROM items')[0][0]
+        payload[tag]['lastModified'] = last_modified
 
-        if nb_items < app.config['nb_items']:
-            app.logger.warning('Media deletion detected (or very first time getIndexes is queried)')
-            # Deletion of items (or very first check since BeetstreamNext started)
-            latest = int(time.time() * 1000)
-            app.config['nb_items'] = nb_items
-
-        payload[tag]['lastModified'] = latest
-
-    return subsonic_response(payload, r.get('f', 'xml'))
+    # Artists are only mapped while the response is being sent
+    return subsonic_response(payload, r.get('f', 'xml'), stream=True)
 
 @app.route('/rest/getArtist', methods=["GET", "POST"])
 @app.route('/rest/getArtist.view', methods=["GET", "POST"])
+@conditional_response
 def get_artist():
     r = flask.request.values
 
@@ -90,11 +93,12 @@ def artistInfo2():
     r = flask.request.values
 
     artist_name = sub_to_beets_artist(r.get('id'))
-    first_item = flask.g.lib.items(f'albumartist:{artist_name}')[0]
-    artist_mbid = first_item.get('mb_albumartistid', '')
+    artist = artist_index().get(artist_name)
+    artist_mbid = artist.mbid if artist else ''
 
     if app.config['lastfm_api_key']:
-        data_lastfm = query_lastfm(artist_mbid, 'artist')
+        # Read from the cache only: missing data is fetched in the background, for the next time
+        data_lastfm = lastfm_artist(artist_name, artist_mbid, 'info')
         bio = data_lastfm.get('artist', {}).get('bio', {}).get('content', '')
         short_bio = trim_text(bio, char_limit=300)
     else:
@@ -109,13 +113,17 @@ def artistInfo2():
         }
     }
 
+    engine = similarity_engine()
+    if engine is not None:
+        similar = filter(None, map(artist_index().get, engine.similar_artists(artist_name, int(r.get('count') or 20))))
+        payload[tag]['similarArtist'] = [map_artist(entry, with_albums=False) for entry in similar]
+
     if app.config['fetch_artists_images']:
         # TODO - this is not fetching the actual images, maybe we keep it as always on?
-        dz_query = urllib.parse.quote_plus(artist_name.replace(' ', '-'))
-        dz_data = query_deezer(dz_query, 'artist')
+        dz_data = deezer_artist(artist_name, artist_mbid)
         if dz_data:
-            payload[tag]['smallImageUrl'] = dz_data.get('picture_medium', ''),
-            payload[tag]['mediumImageUrl'] = dz_data.get('picture_big', ''),
+            payload[tag]['smallImageUrl'] = dz_data.get('picture_medium', '')
+            payload[tag]['mediumImageUrl'] = dz_data.get('picture_big', '')
             payload[tag]['largeImageUrl'] = dz_data.get('picture_xl', '')
 
     return subsonic_response(payload, r.get('f', 'xml'))
\ No newline at end of file
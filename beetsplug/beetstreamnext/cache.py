@@ -0,0 +1,252 @@
+from beetsplug.beetstreamnext import app
+from beetsplug.beetstreamnext.utils import BEETSTREAMNEXT_VERSION
+import os
+import time
+import hashlib
+from datetime import datetime, timezone
+import threading
+from collections import OrderedDict
+from functools import wraps
+from typing import Union
+import flask
+
+
+# Request parameters that never change the content of a response (authentication, client info, cache busters)
+IGNORED_PARAMS = {'u', 'p', 't', 's', 'c', 'v', 'f', 'apiKey', '_'}
+
+
+class LibraryState:
+    """ Keeps track of changes to the Beets database, from this process or any other (beet import, etc).
+    Every change bumps the generation number, which can then be used to invalidate anything derived from the
+    library. The check is only a couple of stat calls, and happens at most once every check_interval seconds """
+
+    def __init__(self, check_interval: float = 1.0):
+        self.check_interval = check_interval
+        self.generation = 0
+        self.last_modified = 0.0    # Timestamp of the last change, in seconds
+        self.fingerprint = ''       # Unlike the generation number, this one is stable across restarts
+        self._signature = None
+        self._newest = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _file_signature(path: str):
+        try:
+            stat = os.stat(path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def _read_signature(self, lib) -> tuple:
+        db_path = os.fsdecode(lib.path)
+        # In-process writes bump the revision, external writes change the database files
+        return (getattr(lib, 'revision', 0),
+                self._file_signature(db_path),
+                self._file_signature(f'{db_path}-wal'))
+
+    @staticmethod
+    def _read_newest(lib) -> tuple:
+        with lib.transaction() as tx:
+            row = tx.query("""
+                SELECT (SELECT COUNT(*) FROM items), (SELECT MAX(MAX(added), MAX(mtime)) FROM items),
+                       (SELECT COUNT(*) FROM albums), (SELECT MAX(added) FROM albums)
+            """)[0]
+        return tuple(row)
+
+    def check(self, lib) -> int:
+        """ Returns the current generation number, after checking whether the library changed """
+
+        now = time.time()
+        if self._signature is not None and now - self._last_check < self.check_interval:
+            return self.generation
+
+        with self._lock:
+            self._last_check = now
+            signature = self._read_signature(lib)
+            if signature == self._signature:
+                return self.generation
+
+            newest = self._read_newest(lib)
+            newest_timestamp = max(newest[1] or 0, newest[3] or 0)
+
+            if self._signature is None or newest_timestamp > self.last_modified:
+                self.last_modified = newest_timestamp
+            elif newest != self._newest:
+                # Deleted media (or edits that don't touch the timestamps): the change happened just now
+                self.last_modified = now
+
+            self._signature = signature
+            self._newest = newest
+            self.fingerprint = repr((signature[1:], newest))
+            self.generation += 1
+            app.logger.debug(f'Library generation is now {self.generation}')
+
+        return self.generation
+
+
+class ResponseCache:
+    """ In-process LRU cache of serialised responses, bounded by a total size in bytes """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.generation = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _clear(self, generation: int):
+        self._entries.clear()
+        self.size = 0
+        self.generation = generation
+
+    def get(self, key: tuple, generation: int) -> Union[tuple, None]:
+        with self._lock:
+            if generation != self.generation:
+                # Everything in there is stale
+                self._clear(generation)
+                return None
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: tuple, generation: int, body: bytes, mimetype: str) -> None:
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self.generation:
+                self._clear(generation)
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[0])
+            self._entries[key] = (body, mimetype)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (old_body, _) = self._entries.popitem(last=False)
+                self.size -= len(old_body)
+
+
+_library_state = LibraryState()
+_response_cache = None
+
+
+def library_generation(lib=None) -> int:
+    return _library_state.check(lib or flask.g.lib)
+
+
+def library_last_modified(lib=None) -> float:
+    _library_state.check(lib or flask.g.lib)
+    return _library_state.last_modified
+
+
+def library_fingerprint(lib=None) -> str:
+    _library_state.check(lib or flask.g.lib)
+    return _library_state.fingerprint
+
+
+def get_response_cache() -> Union[ResponseCache, None]:
+    global _response_cache
+    max_bytes = int(app.config.get('response_cache_size', 64) * 1024 * 1024)
+    if max_bytes <= 0:
+        return None
+    if _response_cache is None or _response_cache.max_bytes != max_bytes:
+        _response_cache = ResponseCache(max_bytes)
+    return _response_cache
+
+
+def request_key() -> tuple:
+    """ Identifies a request by its endpoint, its normalised parameters and its response format """
+    r = flask.request.values
+    endpoint = flask.request.path.rsplit('.view', 1)[0]
+    params = tuple(sorted((k, tuple(r.getlist(k))) for k in r.keys() if k not in IGNORED_PARAMS))
+    return endpoint, params, r.get('f', 'xml')
+
+
+def _tee(chunks, cache: ResponseCache, key: tuple, generation: int, mimetype: str):
+    """ Passes a streamed response through, and caches it once it has been sent entirely """
+    parts = []
+    size = 0
+    for chunk in chunks:
+        if parts is not None:
+            parts.append(chunk)
+            size += len(chunk)
+            if size > cache.max_bytes:
+                parts = None
+        yield chunk
+    if parts is not None:
+        cache.put(key, generation, b''.join(parts), mimetype)
+
+
+def cached_response(view=None, *, when=None):
+    """ Decorator for endpoints whose response only depends on the request and the library contents.
+    Responses are cached until the library changes. An optional predicate can exclude some requests
+    (non-deterministic ones, for instance) """
+
+    if view is None:
+        return lambda v: cached_response(v, when=when)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = get_response_cache()
+        if cache is None or (when is not None and not when(flask.request.values)):
+            return view(*args, **kwargs)
+
+        key = request_key()
+        generation = library_generation()
+
+        entry = cache.get(key, generation)
+        if entry is not None:
+            body, mimetype = entry
+            return flask.Response(body, mimetype=mimetype)
+
+        response = flask.make_response(view(*args, **kwargs))
+        if response.status_code == 200:
+            if response.is_streamed:
+                response.response = _tee(response.response, cache, key, generation, response.mimetype)
+            else:
+                cache.put(key, generation, response.get_data(), response.mimetype)
+        return response
+
+    return wrapper
+
+
+def conditional_response(view=None, *, when=None):
+    """ Decorator for read-only endpoints whose response only depends on the request and the library contents.
+    Responses get a strong ETag (from the library state and the request) and a Last-Modified header (from the
+    newest change in the library), and conditional requests are answered with 304 Not Modified when possible """
+
+    if view is None:
+        return lambda v: conditional_response(v, when=when)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if when is not None and not when(flask.request.values):
+            return view(*args, **kwargs)
+
+        fingerprint = library_fingerprint()
+        last_modified = datetime.fromtimestamp(int(library_last_modified()), tz=timezone.utc)
+        etag = hashlib.sha1(f'{BEETSTREAMNEXT_VERSION}{fingerprint}{request_key()}'.encode('utf-8')).hexdigest()
+
+        req = flask.request
+        if req.if_none_match:
+            # If-None-Match takes precedence over If-Modified-Since
+            not_modified = req.if_none_match.contains_weak(etag)
+        else:
+            not_modified = req.if_modified_since is not None and last_modified <= req.if_modified_since
+
+        if not_modified:
+            response = flask.Response(status=304)
+        else:
+            response = flask.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
+
+    return wrapper
@@ -0,0 +1,254 @@
+from beetsplug.beetstreamnext.utils import strip_accents
+from beetsplug.beetstreamnext.cache import library_generation
+from beetsplug.beetstreamnext.projection import (CHILD_COLUMNS, CHILD_FLEX_COLUMNS, ALBUM_ID3_COLUMNS,
+                                                  SongRecord, AlbumRecord, make_record)
+from beetsplug.beetstreamnext import app
+import sys
+import time
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Union
+
+
+class _Snapshot(NamedTuple):
+    songs: Dict[int, SongRecord]
+    albums: Dict[int, AlbumRecord]
+    album_songs: Dict[int, List[SongRecord]]    # album ID -> its songs, by disc and track
+    aggregates: Dict[int, tuple]                # album ID -> (song count, duration, average rating)
+    songs_by_title: List[SongRecord]
+    songs_title_keys: List[str]                 # normalised titles, in the order of songs_by_title
+    albums_orders: Dict[str, List[AlbumRecord]]     # sort -> albums, filled when first needed
+
+
+_EMPTY = _Snapshot({}, {}, {}, {}, [], [], {})
+
+
+class Catalog:
+    """ In-memory copy of the parts of the library BeetstreamNext serves, so read endpoints never need SQLite.
+    A background thread watches the library, and only rebuilds the records that changed.
+    Everything derived from the records is published at once, in an immutable snapshot: each lookup reads a single
+    snapshot, so it never mixes old and new data """
+
+    def __init__(self, lib):
+        self.lib = lib
+        self.generation = None
+        self.memory_usage = 0       # Approximate, in bytes
+        self._snapshot = _EMPTY
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    @property
+    def songs(self) -> Dict[int, SongRecord]:
+        return self._snapshot.songs
+
+    @property
+    def albums(self) -> Dict[int, AlbumRecord]:
+        return self._snapshot.albums
+
+    # === Loading ===
+
+    def _read(self) -> tuple:
+        with self.lib.transaction() as tx:
+            song_rows = tx.query(f"SELECT {', '.join(CHILD_COLUMNS)} FROM items")
+            flex_rows = tx.query(
+                f"SELECT entity_id, key, value FROM item_attributes WHERE key IN ({', '.join('?' * len(CHILD_FLEX_COLUMNS))})",
+                tuple(CHILD_FLEX_COLUMNS)
+            )
+            album_rows = tx.query(f"SELECT {', '.join(ALBUM_ID3_COLUMNS)} FROM albums")
+
+        flex = defaultdict(dict)
+        for entity_id, key, value in flex_rows:
+            try:
+                flex[entity_id][key] = CHILD_FLEX_COLUMNS[key](value)
+            except (TypeError, ValueError):
+                continue
+
+        songs_values = {}
+        for row in song_rows:
+            row_flex = flex.get(row[0], {})
+            songs_values[row[0]] = tuple(row) + tuple(row_flex.get(key, 0) for key in CHILD_FLEX_COLUMNS)
+        albums_values = {row[0]: tuple(row) for row in album_rows}
+
+        return songs_values, albums_values
+
+    @staticmethod
+    def _merge(records: dict, new_values: dict, cls) -> tuple:
+        """ Only (re)creates the records whose values changed """
+        merged = {}
+        changed = 0
+        for record_id, values in new_values.items():
+            record = records.get(record_id)
+            if record is None or record.values() != values:
+                record = make_record(cls, values, intern=True)
+                changed += 1
+            merged[record_id] = record
+        removed = len(records.keys() - new_values.keys())
+        return merged, changed, removed
+
+    def refresh(self, force: bool = False) -> bool:
+        """ Updates the catalog if the library changed. Returns whether anything was updated """
+
+        generation = library_generation(self.lib)
+        if generation == self.generation and not force:
+            return False
+
+        with self._lock:
+            start = time.perf_counter()
+            songs_values, albums_values = self._read()
+
+            songs, songs_changed, songs_removed = self._merge(self.songs, songs_values, SongRecord)
+            albums, albums_changed, albums_removed = self._merge(self.albums, albums_values, AlbumRecord)
+
+            if self.generation is not None and not (songs_changed or songs_removed or albums_changed or albums_removed):
+                self.generation = generation
+                return False
+
+            self._snapshot = self._build_snapshot(songs, albums)
+            self.generation = generation
+            self.memory_usage = self._measure()
+
+            app.logger.info(
+                f'Catalog {"loaded" if songs_changed == len(songs) else "updated"} in '
+                f'{time.perf_counter() - start:.2f}s: {len(songs)} songs ({songs_changed} changed, {songs_removed} removed), '
+                f'{len(albums)} albums ({albums_changed} changed, {albums_removed} removed), '
+                f'~{self.memory_usage / 1024 ** 2:.1f} MiB'
+            )
+        return True
+
+    @staticmethod
+    def _build_snapshot(songs: dict, albums: dict) -> _Snapshot:
+        album_songs = defaultdict(list)
+        for song in songs.values():
+            album_songs[song.album_id].append(song)
+
+        aggregates = {}
+        for album_id, album_tracks in album_songs.items():
+            album_tracks.sort(key=lambda s: (s.disc or 0, s.track or 0))
+            ratings = [s.stars_rating for s in album_tracks if s.stars_rating]
+            aggregates[album_id] = (len(album_tracks),
+                                    sum(s.length or 0 for s in album_tracks),
+                                    sum(ratings) / len(ratings) if ratings else 0)
+
+        songs_by_title = sorted(songs.values(), key=lambda s: ((s.title or '').casefold(), s.id))
+
+        songs_title_keys = [strip_accents(s.title or '').casefold() for s in songs_by_title]
+        return _Snapshot(songs, albums, dict(album_songs), aggregates, songs_by_title, songs_title_keys, {})
+
+    def _measure(self) -> int:
+        """ Rough estimate of the memory used by the catalog """
+        snapshot = self._snapshot
+        size = 0
+        seen = set()
+        for records in (snapshot.songs.values(), snapshot.albums.values()):
+            for record in records:
+                size += sys.getsizeof(record)
+                for val in record.values():
+                    if id(val) not in seen:
+                        seen.add(id(val))
+                        size += sys.getsizeof(val)
+        for container in (snapshot.songs, snapshot.albums, snapshot.album_songs, snapshot.aggregates,
+                          snapshot.songs_by_title, snapshot.songs_title_keys):
+            size += sys.getsizeof(container)
+        size += sum(sys.getsizeof(key) for key in snapshot.songs_title_keys)
+        return size
+
+    def start(self, interval: float = 10.0) -> None:
+        """ Loads the catalog, and starts watching the library for changes """
+        self.refresh(force=True)
+
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception as e:
+                    app.logger.error(f'Catalog refresh failed: {e}')
+
+        self._watcher = threading.Thread(target=watch, name='beetstreamnext-catalog', daemon=True)
+        self._watcher.start()
+
+    # === Lookups ===
+
+    def song(self, song_id: int) -> Union[SongRecord, None]:
+        return self.songs.get(song_id)
+
+    def album(self, album_id: int) -> Union[AlbumRecord, None]:
+        return self.albums.get(album_id)
+
+    def album_songs(self, album_id: int) -> List[SongRecord]:
+        return list(self._snapshot.album_songs.get(album_id, []))
+
+    def album_aggregates(self, album_ids: Iterable[int]) -> dict:
+        aggregates = self._snapshot.aggregates
+        return {album_id: aggregates.get(album_id, (0, 0, 0)) for album_id in album_ids}
+
+    def artist_albums(self, artist_name: str) -> List[AlbumRecord]:
+        return sorted((a for a in self.albums.values() if a.albumartist == artist_name),
+                      key=lambda a: (a.year or 0, a.album or ''))
+
+    def search_songs(self, query: str, count: int, offset: int = 0) -> List[SongRecord]:
+        """ Songs whose title contains query (case and accent insensitive), sorted by title """
+        snapshot = self._snapshot
+        if not query:
+            return snapshot.songs_by_title[offset:offset + count]
+        query = strip_accents(query).casefold()
+        results = []
+        for key, song in zip(snapshot.songs_title_keys, snapshot.songs_by_title):
+            if query in key:
+                if offset:
+                    offset -= 1
+                    continue
+                results.append(song)
+                if len(results) >= count:
+                    break
+        return results
+
+    def search_albums(self, query: str, count: int, offset: int = 0) -> List[AlbumRecord]:
+        query = strip_accents(query).casefold()
+        albums = self._albums_order(self._snapshot, 'alphabeticalByName')
+        matches = (a for a in albums if query in strip_accents(a.album or '').casefold()) if query else albums
+        results = []
+        for album in matches:
+            if offset:
+                offset -= 1
+                continue
+            results.append(album)
+            if len(results) >= count:
+                break
+        return results
+
+    @staticmethod
+    def _albums_order(snapshot: _Snapshot, sort_by: str) -> List[AlbumRecord]:
+        # Stored in the snapshot it was made from, so it can't outlive it
+        order = snapshot.albums_orders.get(sort_by)
+        if order is None:
+            albums = snapshot.albums.values()
+            if sort_by == 'newest':
+                order = sorted(albums, key=lambda a: a.added or 0, reverse=True)
+            elif sort_by == 'alphabeticalByArtist':
+                order = sorted(albums, key=lambda a: (a.albumartist or '').casefold())
+            elif sort_by == 'recent':
+                order = sorted(albums, key=lambda a: a.year or 0, reverse=True)
+            elif sort_by == 'byYear':
+                order = sorted(albums, key=lambda a: (a.year or 0, a.month or 0, a.day or 0))
+            elif sort_by == 'alphabeticalByName':
+                order = sorted(albums, key=lambda a: (a.album or '').casefold())
+            else:
+                # Unordered in SQL, which means by ID
+                order = sorted(albums, key=lambda a: a.id)
+            snapshot.albums_orders[sort_by] = order
+        return order
+
+    def album_list(self, sort_by: str, size: int, offset: int = 0,
+                   from_year: int = 0, to_year: int = 3000) -> List[AlbumRecord]:
+        """ Same semantics as the getAlbumList(2) SQL queries (random and genre lists have their own indexes) """
+
+        albums = self._albums_order(self._snapshot, sort_by)
+
+        if sort_by == 'byYear':
+            low, high = min(from_year, to_year), max(from_year, to_year)
+            albums = [a for a in albums if low <= (a.year or 0) <= high]
+            if from_year > to_year:
+                albums.reverse()
+
+        return albums[offset:offset + size]
@@ -1,15 +1,22 @@
 from beetsplug.beetstreamnext.utils import *
 from beetsplug.beetstreamnext import app
+from beetsplug.beetstreamnext.artistindex import artist_index
+from beetsplug.beetstreamnext.enrichment import artist_image_path, save_artist_image, enrichment_worker, deezer_artist
+from beetsplug.beetstreamnext.singleflight import single_flight
+from beetsplug.beetstreamnext.metrics import metrics
+from beetsplug.beetstreamnext.imaging import IMAGE_FORMATS, NEGOTIATED_FORMATS, ImagePoolBusy, process_image
+from beetsplug.beetstreamnext.thumbnails import thumbnail_cache, thumbnail_key
 import os
-from typing import Union
-import requests
+from typing import Callable, Union
 from io import BytesIO
-from PIL import Image
 import flask
 
 
 have_ffmpeg = FFMPEG_PYTHON or FFMPEG_BIN
 
+# How long clients can keep a cover before asking again (and then, the ETag saves sending it again)
+COVER_MAX_AGE = 7 * 24 * 3600
+
 
 def extract_cover(path) -> Union[BytesIO, None]:
 
@@ -39,13 +46,58 @@ def extract_cover(path) -> Union[BytesIO, None]:
     return BytesIO(img_bytes) if img_bytes else None
 
 
-def resize_image(data: BytesIO, size: int) -> BytesIO:
-    img = Image.open(data)
-    img.thumbnail((size, size))
-    buf = BytesIO()
-    img.save(buf, format='JPEG')
-    buf.seek(0)
-    return buf
+def negotiate_image_format() -> str:
+    """ Best format for the client: WebP or AVIF if it says it accepts them (not just through */*), or else JPEG """
+    accepted = {mimetype for mimetype, quality in flask.request.accept_mimetypes if quality > 0}
+    return next((fmt for fmt in NEGOTIATED_FORMATS if IMAGE_FORMATS[fmt][0] in accepted), 'jpeg')
+
+
+def download_image(url: str, size: Union[int, None] = None, fmt: str = 'jpeg') -> Union[BytesIO, None]:
+    """ Downloads an image (resized to the given size if any), or returns None if it could not be """
+    response = http_client.get(url)
+    if response is None or not response.ok:
+        return None
+    img = BytesIO(response.content)
+    return process_image(img, size, fmt) if size else img
+
+
+def send_thumbnail(key: tuple, make: Callable[[str], Union[BytesIO, None]], negotiate: bool = True,
+                   fallback: bool = True):
+    """ Responds with a resized image, in the best format for the client (make is called with it), made only once
+    for all the concurrent requests of it (e.g. a grid of covers opened by several clients) and then kept in the
+    thumbnails cache. None if the image can't be made, or if the image pool is overloaded and the caller has a
+    fallback (the original image): otherwise, that gives a 503 """
+
+    fmt = negotiate_image_format() if negotiate else 'jpeg'
+    key = (*key, fmt)
+    name = thumbnail_key(key)
+    cache = thumbnail_cache()
+
+    def make_bytes():
+        img = make(fmt)
+        return img.getvalue() if img is not None else None
+
+    try:
+        if cache is not None:
+            img = single_flight.do((key[0], name), lambda: cache.get_or_make(name, make_bytes))
+            if isinstance(img, BytesIO):
+                # Shared with other requests, each needs its own
+                img = BytesIO(img.getvalue())
+        else:
+            data = single_flight.do((key[0], name), make_bytes)
+            img = BytesIO(data) if data is not None else None
+    except ImagePoolBusy:
+        if not fallback:
+            raise
+        metrics.increment('images.fallbacks')
+        return None
+
+    if img is None:
+        return None
+    response = flask.send_file(img, mimetype=IMAGE_FORMATS[fmt][0], etag=name, max_age=COVER_MAX_AGE)
+    if negotiate:
+        response.vary.add('Accept')
+    return response
 
 
 def send_album_art(album_id, size=None):
@@ -54,12 +106,14 @@ def send_album_art(album_id, size=None):
 
     album = flask.g.lib.get_album(album_id)
     if album:
-        art_path = album.get('artpath', b'').decode('utf-8')
+        art_path = (album.get('artpath') or b'').decode('utf-8')
         if os.path.isfile(art_path):
             if size:
-                cover = resize_image(art_path, size)
-                return flask.send_file(cover, mimetype='image/jpeg')
-            return flask.send_file(art_path, mimetype=get_mimetype(art_path))
+                response = send_thumbnail(('album_art', art_path, os.path.getmtime(art_path), size),
+                                          lambda fmt: process_image(art_path, size, fmt))
+                if response is not None:
+                    return response
+            return flask.send_file(art_path, mimetype=get_mimetype(art_path), max_age=COVER_MAX_AGE)
 
         mbid = album.get('mb_albumid')
         if mbid:
@@ -73,9 +127,10 @@ def send_album_art(album_id, size=None):
                 next_size = next((s for s in sorted(available_sizes) if s > size), None)
                 if next_size is None:
                     next_size = max(available_sizes)
-                response = requests.get(f'{art_url}-{next_size}')
-                cover = resize_image(BytesIO(response.content), size)
-                return flask.send_file(cover, mimetype='image/jpeg')
+                response = send_thumbnail(('coverartarchive', mbid, size),
+                                          lambda fmt: download_image(f'{art_url}-{next_size}', size, fmt))
+                if response is not None:
+                    return response
             return flask.redirect(art_url)
     return None
 
@@ -85,31 +140,35 @@ def send_artist_image(artist_id, size=None):
     # TODO - Maybe make a separate plugin to save deezer data permanently to disk / beets db?
 
     artist_name = sub_to_beets_artist(artist_id)
+    artist = artist_index().get(artist_name)
+    artist_mbid = artist.mbid if artist else ''
 
-    local_folder = app.config['root_directory'] / artist_name
-    local_image_path = local_folder / f'{artist_name}.jpg'
+    local_image_path = artist_image_path(artist_name)
 
-    # First, check if we have the image already downloaded
+    # First, check if we have the image already downloaded (otherwise, it will be in the background)
     if app.config['fetch_artists_images'] and app.config['save_artists_images'] and not local_image_path.is_file():
-        dz_data = query_deezer(artist_name, 'artist')
-        if dz_data:
-            artist_image_url = dz_data.get('picture_xl', '') or dz_data.get('picture_big', '')
-            if artist_image_url:
-                response = requests.get(artist_image_url)
-                if response.ok:
-                    img = Image.open(BytesIO(response.content))
-                    img.save(local_image_path)
+        worker = enrichment_worker()
+        if worker is not None:
+            worker.submit(artist_name, artist_mbid)
+        else:
+            dz_data = query_deezer(artist_name, 'artist')
+            if dz_data:
+                save_artist_image(artist_name, dz_data)
 
     # If we have the image locally, serve it
     if os.path.isfile(local_image_path):
         if size:
-            cover = resize_image(local_image_path, size)
-            return flask.send_file(cover, mimetype='image/jpeg')
-        return flask.send_file(local_image_path, mimetype=get_mimetype(local_image_path))
+            response = send_thumbnail(
+                ('artist_image', str(local_image_path), os.path.getmtime(local_image_path), size),
+                lambda fmt: process_image(local_image_path, size, fmt)
+            )
+            if response is not None:
+                return response
+        return flask.send_file(local_image_path, mimetype=get_mimetype(local_image_path), max_age=COVER_MAX_AGE)
 
     if app.config['fetch_artists_images']:
-        # No local image, and no need to cache - Query deezer
-        dz_data = query_deezer(artist_name, 'artist')
+        # No local image (yet) - Use deezer's
+        dz_data = deezer_artist(artist_name, artist_mbid)
         if dz_data:
             artist_image_url = dz_data.get('picture_small', '')
             available_sizes = [56, 250, 500, 1000]
@@ -122,11 +181,25 @@ def send_artist_image(artist_id, size=None):
                     next_size = next((s for s in sorted(available_sizes) if s >= size), None)
                     if next_size is None:
                         next_size = max(available_sizes)
-                    response = requests.get(artist_image_url.replace('56x56', f'{next_size}x{next_size}'))
-                    cover = resize_image(BytesIO(response.content), size)
-                    return flask.send_file(cover, mimetype='image/jpeg')
+                    response = send_thumbnail(
+                        ('deezer_image', artist_image_url, size),
+                        lambda fmt: download_image(artist_image_url.replace('56x56', f'{next_size}x{next_size}'), size, fmt)
+                    )
+                    if response is not None:
+                        return response
                 return flask.redirect(artist_image_url)
 
+    # Last resort: use the cover of one of the artist's albums
+    if artist is not None and artist.cover_album_id:
+        return send_album_art(artist.cover_album_id, size)
+
+
+@app.errorhandler(ImagePoolBusy)
+def image_pool_busy(e: ImagePoolBusy):
+    response = flask.make_response('Too many images to process, try again later', 503)
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
 
 @app.route('/rest/getCoverArt', methods=["GET", "POST"])
 @app.route('/rest/getCoverArt.view', methods=["GET", "POST"])
@@ -155,11 +228,25 @@ def get_cover_art():
 
         # Fallback: try to extract cover from the song file
         if have_ffmpeg:
-            cover = extract_cover(item.path)
-            if cover is not None:
-                if size:
-                    cover = resize_image(cover, size)
-                return flask.send_file(cover, mimetype='image/jpeg')
+            if size:
+                def make_cover(fmt):
+                    cover = extract_cover(item.path)
+                    return process_image(cover, size, fmt) if cover is not None else None
+
+                response = send_thumbnail(('embedded_art', item.path, item.get('mtime'), size), make_cover,
+                                          fallback=False)
+                if response is not None:
+                    return response
+            else:
+                # Without a size, the embedded image is sent as it is: it is not a thumbnail, so it is not cached,
+                # but concurrent requests of it still share one extraction
+                def extract():
+                    cover = extract_cover(item.path)
+                    return cover.getvalue() if cover is not None else None
+
+                data = single_flight.do(('embedded_art', item.path), extract)
+                if data is not None:
+                    return flask.send_file(BytesIO(data), mimetype='image/jpeg', max_age=COVER_MAX_AGE)
 
     # artist requests
     elif req_id.startswith(ART_ID_PREF):
@@ -0,0 +1,121 @@
+from beetsplug.beetstreamnext.utils import strip_accents
+from beetsplug.beetstreamnext.cache import library_generation
+from beetsplug.beetstreamnext import app
+import re
+import math
+import heapq
+import random
+import threading
+from array import array
+from collections import defaultdict
+from typing import Dict, Iterable, Set, Tuple
+import flask
+
+
+# Fields of the items in which an artist can be credited
+CREDIT_NAME_FIELDS = ('artist', 'artists', 'composer', 'lyricist')
+CREDIT_MBID_FIELDS = ('mb_artistid', 'mb_artistids')
+
+# Separators of several artists in a single credit (including Beets' own multi-valued fields separator)
+credits_separators = re.compile(r'\\␀|␀|;|, | & | feat\. | feat | ft\. | featuring ', re.IGNORECASE)
+
+
+def credit_key(name: str) -> str:
+    return ' '.join(strip_accents(name).casefold().split())
+
+
+def split_credits(value: str) -> Set[str]:
+    """ Every artist named in a credit, normalised. The full credit is kept too (for band names like 'Simon & Garfunkel') """
+    if not value:
+        return set()
+    keys = {credit_key(part) for part in credits_separators.split(value)}
+    keys.add(credit_key(value))
+    keys.discard('')
+    return keys
+
+
+class CreditIndex:
+    """ Maps the artists credited on songs (as artist, composer or lyricist, by name or by MusicBrainz ID)
+    to the IDs of these songs. Rebuilt with a single query whenever the library changes """
+
+    def __init__(self):
+        self.generation = None
+        self.by_name: Dict[str, array] = {}
+        self.by_mbid: Dict[str, array] = {}
+        self._lock = threading.Lock()
+
+    def refresh(self, lib) -> 'CreditIndex':
+        generation = library_generation(lib)
+        if generation == self.generation:
+            return self
+
+        with self._lock:
+            if generation == self.generation:
+                return self
+
+            with lib.transaction() as tx:
+                rows = tx.query(f"SELECT id, {', '.join(CREDIT_NAME_FIELDS + CREDIT_MBID_FIELDS)} FROM items")
+
+            by_name = defaultdict(lambda: array('q'))
+            by_mbid = defaultdict(lambda: array('q'))
+            split = {}      # Credits are very repetitive, split each one once
+
+            n_names = len(CREDIT_NAME_FIELDS)
+            for row in rows:
+                song_id = row[0]
+                names = set()
+                for value in row[1:1 + n_names]:
+                    if value:
+                        keys = split.get(value)
+                        if keys is None:
+                            keys = split[value] = split_credits(value)
+                        names.update(keys)
+                mbids = set()
+                for value in row[1 + n_names:]:
+                    if value:
+                        mbids.update(m for m in credits_separators.split(value) if m)
+
+                for key in names:
+                    by_name[key].append(song_id)
+                for mbid in mbids:
+                    by_mbid[mbid].append(song_id)
+
+            self.by_name, self.by_mbid = dict(by_name), dict(by_mbid)
+            self.generation = generation
+            app.logger.debug(f'Credit index rebuilt ({len(self.by_name)} names, {len(self.by_mbid)} MBIDs)')
+
+        return self
+
+    def song_ids(self, name: str, mbid: str = '') -> Set[int]:
+        """ Songs crediting the artist, by MBID or by name (or by any of the names, for collaborations) """
+        ids = set(self.by_mbid.get(mbid, ())) if mbid else set()
+        for key in split_credits(name):
+            ids.update(self.by_name.get(key, ()))
+        return ids
+
+    def sample(self, artists: Iterable[Tuple[str, str, float]], count: int) -> list:
+        """ Picks up to count songs from the given (name, MBID, weight) artists.
+        Every artist gets a share proportional to its weight however many songs it has, and songs are drawn
+        at random within these shares (weighted sampling without replacement) """
+
+        song_weights = {}
+        for name, mbid, weight in artists:
+            ids = self.song_ids(name, mbid)
+            if not ids or weight <= 0:
+                continue
+            song_weight = weight / len(ids)
+            for song_id in ids:
+                if song_weight > song_weights.get(song_id, 0):
+                    song_weights[song_id] = song_weight
+
+        # Efraimidis-Spirakis: the largest random() ** (1 / weight) keys make a weighted sample
+        # (compared as logarithms, which don't underflow for the small weights)
+        return heapq.nlargest(count, song_weights,
+                              key=lambda song_id: math.log(1.0 - random.random()) / song_weights[song_id])
+
+
+_credit_index = CreditIndex()
+
+
+def credit_index(lib=None) -> CreditIndex:
+    return _credit_index.refresh(lib or flask.g.lib)
@@ -0,0 +1,176 @@
+from beetsplug.beetstreamnext.utils import query_lastfm, query_deezer, http_client
+from beetsplug.beetstreamnext import app
+import os
+import queue
+import itertools
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterator, Tuple, Union
+from PIL import Image
+
+
+# Last.fm data prefetched for every artist
+LASTFM_ARTIST_METHODS = ('info', 'TopTracks', 'similar')
+
+# Artists waiting to be enriched, beyond which new requests are dropped (they will be queued again when needed)
+MAX_QUEUED_ARTISTS = 50000
+
+# Priorities of the jobs (lower is sooner)
+ON_DEMAND, PREFETCH = 0, 1
+
+
+def _lastfm_artist(name: str, mbid: str, method: str, cache_only: bool = False) -> Union[dict, None]:
+    # By MBID when there is one, as Last.fm's names don't always match the tags
+    if mbid:
+        return query_lastfm(mbid, 'artist', method, mbid=True, cache_only=cache_only)
+    return query_lastfm(name, 'artist', method, mbid=False, cache_only=cache_only)
+
+
+def artist_image_path(name: str):
+    return app.config['root_directory'] / name / f'{name}.jpg'
+
+
+def save_artist_image(name: str, dz_data: dict) -> bool:
+    """ Downloads the artist's picture from Deezer into the artist's folder """
+    image_url = dz_data.get('picture_xl', '') or dz_data.get('picture_big', '')
+    local_path = artist_image_path(name)
+    if not image_url or not local_path.parent.is_dir():
+        return False
+
+    response = http_client.get(image_url)
+    if response is None or not response.ok:
+        return False
+    try:
+        img = Image.open(BytesIO(response.content))
+        # Write next to it first, so a half-written file is never served
+        tmp_path = local_path.with_suffix('.tmp')
+        img.convert('RGB').save(tmp_path, format='JPEG')
+        os.replace(tmp_path, local_path)
+    except OSError as e:
+        app.logger.warning(f'Could not save the picture of {name}: {e}')
+        return False
+    return True
+
+
+def enrich_artist(name: str, mbid: str = '') -> None:
+    """ Fetches (into the metadata cache) everything the artist endpoints can show about an artist """
+    if app.config['lastfm_api_key']:
+        for method in LASTFM_ARTIST_METHODS:
+            _lastfm_artist(name, mbid, method)
+
+    if app.config['fetch_artists_images']:
+        dz_data = query_deezer(name, 'artist')
+        if dz_data and app.config['save_artists_images'] and not artist_image_path(name).is_file():
+            save_artist_image(name, dz_data)
+
+
+def library_artists(lib) -> Iterator[Tuple[str, str]]:
+    """ (name, MBID) of all the album artists, the most recently played first """
+    with lib.transaction() as tx:
+        rows = tx.query("""
+            SELECT items.albumartist, MAX(items.mb_albumartistid), MAX(CAST(played.value AS REAL)) AS last_played
+              FROM items
+              LEFT JOIN item_attributes AS played ON played.entity_id = items.id AND played.key = 'last_played'
+             WHERE items.albumartist IS NOT NULL AND items.albumartist != ''
+             GROUP BY items.albumartist
+             ORDER BY last_played IS NULL, last_played DESC, items.albumartist
+        """)
+    return ((name, mbid or '') for name, mbid, _ in rows)
+
+
+class EnrichmentWorker:
+    """ Background threads that fetch the artists' bios, top tracks, similar artists and pictures, so that
+    request handlers only ever read local data. Artists requested by clients go before the prefetching
+    of the rest of the library """
+
+    def __init__(self, lib, threads: int = 2, max_queued: int = MAX_QUEUED_ARTISTS):
+        self.lib = lib
+        self.threads = threads
+        self._queue = queue.PriorityQueue(maxsize=max_queued)
+        self._pending = {}      # artist name -> best priority it is queued with
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    def start(self) -> 'EnrichmentWorker':
+        for i in range(self.threads):
+            threading.Thread(target=self._run, name=f'enrichment-{i}', daemon=True).start()
+        return self
+
+    def submit(self, name: str, mbid: str = '', priority: int = ON_DEMAND) -> bool:
+        """ Queues an artist, unless it is already queued (with the same or a better priority) """
+        if not name:
+            return False
+        with self._lock:
+            if self._pending.get(name, priority + 1) <= priority:
+                return True
+            try:
+                self._queue.put_nowait((priority, next(self._order), name, mbid))
+            except queue.Full:
+                return False
+            self._pending[name] = priority
+        return True
+
+    def submit_library(self) -> int:
+        """ Queues all the album artists of the library, for prefetching """
+        return sum(self.submit(name, mbid, PREFETCH) for name, mbid in library_artists(self.lib))
+
+    def _run(self) -> None:
+        while True:
+            priority, _, name, mbid = self._queue.get()
+            with self._lock:
+                best = self._pending.get(name)
+                if best is None or best < priority:
+                    # Already done, or still queued with a better priority
+                    self._queue.task_done()
+                    continue
+                del self._pending[name]
+            try:
+                enrich_artist(name, mbid)
+            except Exception as e:
+                app.logger.warning(f'Could not enrich {name}: {e}')
+            finally:
+                self._queue.task_done()
+
+
+def enrichment_worker() -> Union[EnrichmentWorker, None]:
+    return app.config.get('enrichment_worker')
+
+
+def enrich_library(lib, threads: int = 4, progress: Union[Callable[[int, int, str], None], None] = None) -> int:
+    """ Enriches all the artists of the library now (at most threads at a time), and returns their number """
+    artists = list(library_artists(lib))
+    done = 0
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        futures = {pool.submit(enrich_artist, name, mbid): name for name, mbid in artists}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                app.logger.warning(f'Could not enrich {name}: {e}')
+            done += 1
+            if progress is not None:
+                progress(done, len(artists), name)
+    return len(artists)
+
+
+def lastfm_artist(name: str, mbid: str = '', method: str = 'info') -> dict:
+    """ Last.fm data about an artist, from the metadata cache. If it's not there yet, it is fetched in the
+    background (and an empty dict returned for now), or right away if there is no enrichment worker """
+    worker = enrichment_worker()
+    data = _lastfm_artist(name, mbid, method, cache_only=worker is not None)
+    if data is None:
+        worker.submit(name, mbid)
+        return {}
+    return data
+
+
+def deezer_artist(name: str, mbid: str = '') -> dict:
+    """ Deezer data about an artist, from the metadata cache (see lastfm_artist) """
+    worker = enrichment_worker()
+    data = query_deezer(name, 'artist', cache_only=worker is not None)
+    if data is None:
+        worker.submit(name, mbid)
+        return {}
+    return data
@@ -0,0 +1,64 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Union
+
+
+class FileStatCache:
+    """ Caches the size of media files, directory by directory.
+    Songs of an album usually live in the same directory, so a single scandir per album replaces
+    the stat calls of every song. Directories are scanned again once their entry is older than ttl seconds """
+
+    def __init__(self, ttl: float = 300.0, max_dirs: int = 20000):
+        self.ttl = ttl
+        self.max_dirs = max_dirs
+        self._dirs = OrderedDict()     # directory -> (scan time, {file name: size})
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _scan(directory: str) -> dict:
+        sizes = {}
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file():
+                            sizes[entry.name] = entry.stat().st_size
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        return sizes
+
+    def size(self, path: str) -> Union[int, None]:
+        """ Returns the size of a file, or None if it does not exist """
+        if not path:
+            return None
+
+        directory, name = os.path.split(path)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._dirs.get(directory)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._dirs.move_to_end(directory)
+                return entry[1].get(name)
+
+        # Scan outside the lock, so a slow (network) directory does not block everyone else
+        sizes = self._scan(directory)
+
+        with self._lock:
+            self._dirs[directory] = (now, sizes)
+            self._dirs.move_to_end(directory)
+            while len(self._dirs) > self.max_dirs:
+                self._dirs.popitem(last=False)
+
+        return sizes.get(name)
+
+    def invalidate(self, path: Union[str, None] = None) -> None:
+        with self._lock:
+            if path is None:
+                self._dirs.clear()
+            else:
+                self._dirs.pop(os.path.dirname(path), None)
@@ -1,8 +1,11 @@
 from beetsplug.beetstreamnext.utils import *
 from beetsplug.beetstreamnext import app
+from beetsplug.beetstreamnext.cache import cached_response, conditional_response
+from beetsplug.beetstreamnext.genreindex import genre_index
 from beetsplug.beetstreamnext.artists import artist_payload
 from beetsplug.beetstreamnext.albums import album_payload
 from beetsplug.beetstreamnext.songs import song_payload
+from beetsplug.beetstreamnext.metrics import metrics
 import flask
 
 
@@ -24,6 +27,7 @@ def musicdirectory_payload(subsonic_musicdirectory_id: str, with_artists=True) -
 
 @app.route('/rest/getOpenSubsonicExtensions', methods=["GET", "POST"])
 @app.route('/rest/getOpenSubsonicExtensions.view', methods=["GET", "POST"])
+@conditional_response
 def get_open_subsonic_extensions():
     r = flask.request.values
 
@@ -40,30 +44,12 @@ def get_open_subsonic_extensions():
 
 @app.route('/rest/getGenres', methods=["GET", "POST"])
 @app.route('/rest/getGenres.view', methods=["GET", "POST"])
+@conditional_response
+@cached_response
 def get_genres():
     r = flask.request.values
 
-    with flask.g.lib.transaction() as tx:
-        mixed_genres = list(tx.query(
-            """
-            SELECT genre, COUNT(*) AS n_song, '' AS n_album FROM items GROUP BY genre
-            UNION ALL
-            SELECT genre, '' AS n_song, COUNT(*) AS n_album FROM albums GROUP BY genre
-            """))
-
-    g_dict = {}
-    for row in mixed_genres:
-        genre_field, n_song, n_album = row
-        for key in genres_formatter(genre_field):
-            if key not in g_dict:
-                g_dict[key] = [0, 0]
-            if n_song:  # Update song count if present
-                g_dict[key][0] += int(n_song)
-            if n_album: # Update album count if present
-                g_dict[key][1] += int(n_album)
-
-    # And convert to list of tuples (only non-empty genres)
-    g_list = [(k, *v) for k, v in g_dict.items() if k]
+    g_list = genre_index().genres()
     g_list.sort(key=lambda g: g[1], reverse=True)
 
     payload = {
@@ -76,6 +62,7 @@ def get_genres():
 
 @app.route('/rest/getLicense', methods=["GET", "POST"])
 @app.route('/rest/getLicense.view', methods=["GET", "POST"])
+@conditional_response
 def get_license():
     r = flask.request.values
 
@@ -88,6 +75,8 @@ def get_license():
 
 @app.route('/rest/getMusicFolders', methods=["GET", "POST"])
 @app.route('/rest/getMusicFolders.view', methods=["GET", "POST"])
+@conditional_response
+@cached_response
 def get_music_folders():
     r = flask.request.values
 
@@ -98,6 +87,7 @@ def get_music_folders():
 
 @app.route('/rest/getMusicDirectory', methods=["GET", "POST"])
 @app.route('/rest/getMusicDirectory.view', methods=["GET", "POST"])
+@conditional_response
 def get_music_directory():
     # Works pretty much like a file system
     # Usually Artist first, then Album, then Songs
@@ -129,3 +119,7 @@ def get_music_directory():
     return subsonic_response(payload, r.get('f', 'xml'))
 
 
+@app.route('/metrics')
+def get_metrics():
+    """ BeetstreamNext's internal counters (not part of the Subsonic API) """
+    return flask.jsonify(metrics.snapshot())
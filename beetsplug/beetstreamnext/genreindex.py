@@ -0,0 +1,141 @@
+from beetsplug.beetstreamnext.utils import genres_formatter
+from beetsplug.beetstreamnext.cache import library_generation
+from beetsplug.beetstreamnext import app
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from typing import Dict, List, Tuple, Union
+import flask
+
+
+def genre_key(genre: str) -> str:
+    """ Normalises a genre name the same way as getGenres does, so lookups match exactly one canonical genre """
+    formatted = genres_formatter([genre])
+    return formatted[0].casefold() if formatted else ''
+
+
+class GenreIndex:
+    """ Inverted index of the (formatted) genres to the songs and albums that have them.
+    Songs are kept in title order and albums in ID order (the orders of the corresponding endpoints), so a page
+    of results is just a slice, and a page that starts after a given (title, ID) is found by bisection, even if that
+    song is gone. The index is rebuilt with two queries whenever the library changes """
+
+    def __init__(self):
+        self.generation = None
+        self.names: Dict[str, str] = {}             # genre key -> canonical name
+        # all song IDs by title then ID, their titles, and genre key -> sorted positions in that order
+        # (swapped together, so they always match)
+        self._songs: Tuple[array, List[str], Dict[str, array]] = (array('q'), [], {})
+        self._album_ids: Dict[str, array] = {}      # genre key -> sorted album IDs
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _read(lib) -> Tuple[list, list]:
+        catalog = app.config.get('catalog')
+        if catalog is not None:
+            songs = sorted(((s.title or '', s.id, s.genre) for s in catalog.songs.values()))
+            albums = sorted((a.id, a.genre) for a in catalog.albums.values())
+            return songs, albums
+
+        with lib.transaction() as tx:
+            # Same order as Python's (code point order is the order of the UTF-8 bytes)
+            songs = tx.query("SELECT COALESCE(title, ''), id, genre FROM items ORDER BY COALESCE(title, ''), id")
+            albums = tx.query("SELECT id, genre FROM albums ORDER BY id")
+        return songs, albums
+
+    def refresh(self, lib) -> 'GenreIndex':
+        generation = library_generation(lib)
+        if generation == self.generation:
+            return self
+
+        with self._lock:
+            if generation == self.generation:
+                return self
+
+            songs, albums = self._read(lib)
+
+            names = {}
+            formatted = {}      # Most genre strings are shared by many rows, format each one once
+
+            def keys_of(genre_field):
+                keys = formatted.get(genre_field)
+                if keys is None:
+                    keys = []
+                    for name in genres_formatter(genre_field or ''):
+                        if name:
+                            key = name.casefold()
+                            names.setdefault(key, name)
+                            if key not in keys:
+                                keys.append(key)
+                    formatted[genre_field] = keys
+                return keys
+
+            song_order = array('q', (row[1] for row in songs))
+            song_titles = [row[0] for row in songs]
+            song_ranks = defaultdict(lambda: array('l'))
+            for rank, (_, _, genre_field) in enumerate(songs):
+                for key in keys_of(genre_field):
+                    song_ranks[key].append(rank)
+
+            album_ids = defaultdict(lambda: array('q'))
+            for album_id, genre_field in albums:
+                for key in keys_of(genre_field):
+                    album_ids[key].append(album_id)
+
+            self.names = names
+            self._songs = (song_order, song_titles, dict(song_ranks))
+            self._album_ids = dict(album_ids)
+            self.generation = generation
+            app.logger.debug(f'Genre index rebuilt ({len(names)} genres)')
+
+        return self
+
+    def genres(self) -> List[Tuple[str, int, int]]:
+        """ (name, song count, album count) of every genre """
+        empty = ()
+        song_ranks = self._songs[2]
+        return [(name, len(song_ranks.get(key, empty)), len(self._album_ids.get(key, empty)))
+                for key, name in self.names.items()]
+
+    @staticmethod
+    def _position(order: array, titles: List[str], after: Tuple[str, int]) -> int:
+        """ Number of songs sorted at or before the (title, ID) sort key """
+        low, high = 0, len(order)
+        while low < high:
+            middle = (low + high) // 2
+            if (titles[middle], order[middle]) <= after:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def song_ids(self, genre: str, count: int, offset: int = 0, after: Union[Tuple[str, int], None] = None) -> array:
+        """ Songs of the genre, by title. Starts right after the given (title, ID) sort key if any (the song does
+        not need to still exist), or else at offset """
+        order, titles, song_ranks = self._songs
+        ranks = song_ranks.get(genre_key(genre))
+        if not ranks:
+            return array('q')
+        start = bisect_left(ranks, self._position(order, titles, after)) if after is not None else offset
+        return array('q', (order[rank] for rank in ranks[start:start + count]))
+
+    def all_song_ids(self, genre: str) -> array:
+        order, _, song_ranks = self._songs
+        return array('q', (order[rank] for rank in song_ranks.get(genre_key(genre), ())))
+
+    def album_ids(self, genre: str, count: Union[int, None] = None, offset: int = 0,
+                  after_id: Union[int, None] = None) -> array:
+        """ Albums of the genre, by ID. Starts after the given album ID if any, or else at offset """
+        ids = self._album_ids.get(genre_key(genre))
+        if not ids:
+            return array('q')
+        start = bisect_right(ids, after_id) if after_id is not None else offset
+        return ids[start:] if count is None else ids[start:start + count]
+
+
+_genre_index = GenreIndex()
+
+
+def genre_index(lib=None) -> GenreIndex:
+    return _genre_index.refresh(lib or flask.g.lib)
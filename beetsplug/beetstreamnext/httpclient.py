@@ -0,0 +1,104 @@
+from beetsplug.beetstreamnext import app
+import time
+import threading
+import urllib.parse
+from typing import Dict, Tuple, Union
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# (connect, read) timeouts, in seconds
+DEFAULT_TIMEOUT = (3.05, 10)
+
+# Maximum number of requests per second to each upstream (see their terms of use)
+UPSTREAM_RATE_LIMITS = {
+    'musicbrainz.org': 1.0,
+    'coverartarchive.org': 5.0,
+    'api.deezer.com': 10.0,
+    'ws.audioscrobbler.com': 5.0,
+}
+
+
+class RateLimiter:
+    """ Spaces out calls to at most rate per second. Callers wait for their turn, but never longer than max_wait """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, max_wait: float) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            if wait > max_wait:
+                return False
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+
+class HttpClient:
+    """ Shared client for the external services (Last.fm, Deezer, MusicBrainz, the Cover Art Archive...).
+    Connections are kept alive and pooled per host, every call has a timeout, transient failures are retried
+    a few times with an exponential backoff, and calls to each host are rate limited """
+
+    def __init__(self, user_agent: str = '', timeout: Tuple[float, float] = DEFAULT_TIMEOUT, retries: int = 2,
+                 backoff: float = 0.5, pool_size: int = 10, rate_limits: Union[Dict[str, float], None] = None):
+        self.timeout = timeout
+
+        retry = Retry(
+            # A read that timed out is retried only once, so a slow upstream can't hold a request thread for long
+            total=retries, connect=retries, read=min(retries, 1), status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({'GET', 'HEAD'}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=len(rate_limits or ()) + 4, pool_maxsize=pool_size, max_retries=retry)
+
+        # Sessions are safe to share between threads as long as nobody changes their settings (or uses cookies)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if user_agent:
+            self.session.headers['User-Agent'] = user_agent
+
+        self._limiters = {host: RateLimiter(rate) for host, rate in (rate_limits or {}).items()}
+
+    def get(self, url: str, **kwargs) -> Union[requests.Response, None]:
+        """ GETs the url, and returns the response (successful or not), or None if the host could not be reached
+        (or if too many requests to it are already waiting) """
+
+        timeout = kwargs.pop('timeout', self.timeout)
+        limiter = self._limiters.get(urllib.parse.urlsplit(url).hostname)
+        # Waiting for a slot longer than the whole request could take is pointless
+        if limiter is not None and not limiter.acquire(max_wait=sum(timeout) if isinstance(timeout, tuple) else timeout):
+            app.logger.warning(f'Too many requests to {urllib.parse.urlsplit(url).hostname}, skipping {url}')
+            return None
+
+        try:
+            return self.session.get(url, timeout=timeout, **kwargs)
+        except requests.RequestException as e:
+            app.logger.warning(f'Request to {url} failed: {e}')
+            return None
+
+    def fetch_json(self, url: str, **kwargs) -> Union[dict, None]:
+        """ GETs the url, and returns the decoded JSON response. Client errors (like 404) give an empty dict,
+        and None means the service could not be reached or failed (so the answer may be different next time) """
+        response = self.get(url, **kwargs)
+        if response is None or response.status_code == 429 or response.status_code >= 500:
+            return None
+        if not response.ok:
+            return {}
+        try:
+            return response.json()
+        except ValueError:
+            return None
+
+    def get_json(self, url: str, **kwargs) -> dict:
+        """ GETs the url, and returns the decoded JSON response, or an empty dict if anything went wrong """
+        return self.fetch_json(url, **kwargs) or {}
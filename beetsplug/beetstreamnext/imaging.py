@@ -0,0 +1,171 @@
+from beetsplug.beetstreamnext import app
+from beetsplug.beetstreamnext.metrics import metrics
+import os
+import math
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Tuple, Union
+from PIL import Image, features
+
+
+def _can_encode(feature: str) -> bool:
+    try:
+        return features.check(feature)
+    except ValueError:
+        # Unknown to this version of Pillow
+        return False
+
+
+# Output formats of the resized images (by preference), with their encoder settings
+IMAGE_FORMATS = {
+    'jpeg': ('image/jpeg', 'JPEG', {'quality': 85}),
+    'webp': ('image/webp', 'WEBP', {'quality': 80, 'method': 4}),
+    'avif': ('image/avif', 'AVIF', {'quality': 60, 'speed': 8}),
+}
+NEGOTIATED_FORMATS = [fmt for fmt in ('webp', 'avif') if _can_encode(fmt)]
+
+
+def resize_image(data: Union[BytesIO, str, os.PathLike], size: int, fmt: str = 'jpeg') -> BytesIO:
+    _, pil_format, options = IMAGE_FORMATS[fmt]
+
+    with Image.open(data) as img:
+        # JPEG sources are downscaled by the decoder itself (in the DCT domain, by 1/2, 1/4 or 1/8),
+        # to no less than the target size, which avoids decoding all the pixels of big covers
+        img.draft('RGB', (size, size))
+
+        # Other sources: a cheap integer reduction first, to about twice the target size
+        factor = max(img.size) / size
+        if factor >= 4:
+            img = img.reduce(int(factor / 2))
+            factor = max(img.size) / size
+
+        # Lanczos is sharper for the final small steps, bicubic is good enough (and faster) for bigger ones
+        resample = Image.Resampling.LANCZOS if factor < 2 else Image.Resampling.BICUBIC
+        img.thumbnail((size, size), resample=resample, reducing_gap=None)
+
+        if pil_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        elif img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+
+        buf = BytesIO()
+        img.save(buf, format=pil_format, **options)
+
+    buf.seek(0)
+    return buf
+
+
+def _resize_job(source: Union[bytes, str], size: int, fmt: str) -> Tuple[bytes, float]:
+    # Runs in the pool's processes: returns the image, and how long it took (in ms)
+    start = time.perf_counter()
+    img = resize_image(BytesIO(source) if isinstance(source, bytes) else source, size, fmt)
+    return img.getvalue(), (time.perf_counter() - start) * 1000
+
+
+class ImagePoolBusy(Exception):
+    """ The image pool can't take more work (or did not do it in time) """
+
+    def __init__(self, retry_after: int):
+        super().__init__('Too many images to process')
+        self.retry_after = retry_after
+
+
+class ImagePool:
+    """ Processes that decode and resize the images, so that this CPU work (which holds the GIL) does not slow down
+    the request threads serving everything else. At most max_queued jobs wait for a process: beyond that, or if
+    a job does not finish within timeout seconds (waiting included), ImagePoolBusy is raised and the caller serves
+    something else (the original image, or a 503) """
+
+    def __init__(self, processes: int = 2, max_queued: int = 16, timeout: float = 10):
+        self.processes = processes
+        self.timeout = timeout
+        # Jobs running or waiting, released when they are done (even after a timeout, since they keep a process busy)
+        self._slots = threading.BoundedSemaphore(processes + max_queued)
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # Forking a process with running threads (the server's) is unsafe: workers start fresh, once
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'))
+
+    def _restart(self, executor: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._executor is executor:
+                app.logger.warning('An image process died, restarting the image pool')
+                self._executor = self._new_executor()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def resize(self, source: Union[bytes, str], size: int, fmt: str = 'jpeg') -> Tuple[bytes, float]:
+        """ Resizes an image (its data, or the path of its file) in a process. Returns the image and the time the
+        resizing took (in ms) """
+
+        retry_after = math.ceil(self.timeout)
+        if not self._slots.acquire(blocking=False):
+            metrics.increment('images.rejected')
+            raise ImagePoolBusy(retry_after)
+
+        executor = self._executor
+        try:
+            future = executor.submit(_resize_job, source, size, fmt)
+        except (BrokenProcessPool, RuntimeError):
+            self._slots.release()
+            self._restart(executor)
+            raise ImagePoolBusy(retry_after)
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            # Drops it if it did not start yet
+            future.cancel()
+            metrics.increment('images.timeouts')
+            raise ImagePoolBusy(retry_after)
+        except BrokenProcessPool:
+            self._restart(executor)
+            raise ImagePoolBusy(retry_after)
+
+
+_image_pool = None
+_image_pool_lock = threading.Lock()
+
+
+def image_pool() -> Union[ImagePool, None]:
+    """ Returns the image pool, or None if images are processed in the request threads """
+    global _image_pool
+    if _image_pool is None:
+        with _image_pool_lock:
+            if _image_pool is None:
+                processes = app.config.get('image_processes', 0)
+                if not processes:
+                    _image_pool = False
+                else:
+                    _image_pool = ImagePool(
+                        processes=int(processes),
+                        max_queued=int(app.config.get('image_queue', 16)),
+                        timeout=float(app.config.get('image_timeout', 10))
+                    )
+    return _image_pool or None
+
+
+def process_image(data: Union[BytesIO, str, os.PathLike], size: int, fmt: str = 'jpeg') -> BytesIO:
+    """ Resizes an image in the image pool (or in this thread if there is none). Raises ImagePoolBusy if the pool
+    is overloaded """
+
+    start = time.perf_counter()
+    pool = image_pool()
+    if pool is None:
+        img = resize_image(data, size, fmt)
+        resize_ms = (time.perf_counter() - start) * 1000
+    else:
+        source = data.getvalue() if isinstance(data, BytesIO) else os.fspath(data)
+        img_bytes, resize_ms = pool.resize(source, size, fmt)
+        img = BytesIO(img_bytes)
+        metrics.observe('images.wait_ms', (time.perf_counter() - start) * 1000 - resize_ms)
+
+    metrics.observe(f'images.{fmt}.resize_ms', resize_ms)
+    metrics.observe(f'images.{fmt}.bytes', img.getbuffer().nbytes)
+    return img
@@ -0,0 +1,168 @@
+from beetsplug.beetstreamnext import app
+from beetsplug.beetstreamnext.singleflight import single_flight
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Callable, Union
+
+
+DAY = 24 * 3600
+
+# How long the responses of each kind of external query stay fresh, in seconds
+METADATA_TTLS = {
+    'lastfm.artist.info': 30 * DAY,
+    'lastfm.artist.similar': 14 * DAY,
+    'lastfm.artist.toptracks': 7 * DAY,
+    'deezer.artist': 30 * DAY,
+    'musicbrainz': 30 * DAY,
+}
+DEFAULT_TTL = 7 * DAY
+
+# "Not found" answers are cached too, but not for as long
+NEGATIVE_TTL = DAY
+
+# Once expired, an entry can still be served (while it is refreshed in the background) for this fraction of its TTL
+STALE_FRACTION = 1.0
+
+# Only touch the last use time of an entry (a write) if it is older than that
+TOUCH_INTERVAL = 3600
+
+
+def is_missing(value: Union[dict, None]) -> bool:
+    """ Whether an external response means "not found" (Last.fm and Deezer answer errors with a 200 and an 'error') """
+    return not value or 'error' in value
+
+
+class MetadataCache:
+    """ Persistent cache of the responses of the external services (Last.fm, Deezer, MusicBrainz), in a sidecar
+    SQLite database. Every kind of query has its own TTL, "not found" answers are cached for a shorter time, and
+    expired entries are still served while they are refreshed in the background (stale-while-revalidate).
+    The least recently used entries are evicted when the cache grows over max_size bytes """
+
+    def __init__(self, path: Union[str, os.PathLike], max_size: int = 32 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires REAL NOT NULL,
+                    stale_until REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    size INTEGER NOT NULL)
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_by_use ON responses (last_used)")
+            self.size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _read(self, key: str) -> Union[tuple, None]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires, stale_until, last_used FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and time.time() - row[3] > TOUCH_INTERVAL:
+                with self._conn:
+                    self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row
+
+    def _write(self, key: str, kind: str, value: dict) -> None:
+        missing = is_missing(value)
+        ttl = NEGATIVE_TTL if missing else METADATA_TTLS.get(kind, DEFAULT_TTL)
+        data = json.dumps({} if missing else value, separators=(',', ':'))
+        now = time.time()
+
+        with self._lock, self._conn:
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires, stale_until, last_used, size) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, data, now + ttl, now + ttl * (1 + STALE_FRACTION), now, len(data))
+            )
+            self.size += len(data) - (old[0] if old else 0)
+
+            if self.size > self.max_size:
+                # Evict the least recently used entries, down to 90% of the budget (so it does not happen every time)
+                target = self.size - int(self.max_size * 0.9)
+                evicted = self._conn.execute("""
+                    DELETE FROM responses WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, size, SUM(size) OVER (ORDER BY last_used, key) AS freed FROM responses
+                        ) WHERE freed - size < ?
+                    )
+                """, (target,))
+                self.size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                app.logger.debug(f'Metadata cache: evicted {evicted.rowcount} entries')
+
+    def _refresh(self, key: str, kind: str, fetch: Callable[[], Union[dict, None]]) -> Union[dict, None]:
+        # Concurrent requests for the same thing make a single call to the service
+        value = single_flight.do((kind, key), fetch)
+        # None means the service could not be reached: keep what we have
+        if value is not None:
+            self._write(key, kind, value)
+        return value
+
+    def _refresh_in_background(self, key: str, kind: str, fetch: Callable[[], Union[dict, None]]) -> None:
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self._refresh(key, kind, fetch)
+            except Exception as e:
+                app.logger.warning(f'Could not refresh {key}: {e}')
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, name=f'refresh {key}', daemon=True).start()
+
+    def get(self, kind: str, query: str, fetch: Callable[[], Union[dict, None]],
+            cache_only: bool = False) -> Union[dict, None]:
+        """ Returns the cached response to the query if there is one, or else fetches it (unless cache_only,
+        in which case None is returned). fetch returns the response, or None if the service could not be reached.
+        "Not found" responses are returned as empty dicts """
+
+        key = f'{kind}:{query}'
+        row = self._read(key)
+        now = time.time()
+
+        if row is not None:
+            value, expires, stale_until, _ = row
+            if now < expires:
+                return json.loads(value)
+            if now < stale_until:
+                self._refresh_in_background(key, kind, fetch)
+                return json.loads(value)
+
+        if cache_only:
+            return None
+
+        value = self._refresh(key, kind, fetch)
+        if value is None:
+            # Unreachable: an outdated answer is better than none
+            return json.loads(row[0]) if row is not None else {}
+        return {} if is_missing(value) else value
+
+
+_metadata_cache = None
+_metadata_cache_lock = threading.Lock()
+
+
+def metadata_cache() -> MetadataCache:
+    global _metadata_cache
+    if _metadata_cache is None:
+        with _metadata_cache_lock:
+            if _metadata_cache is None:
+                _metadata_cache = MetadataCache(
+                    app.config.get('metadata_cache') or ':memory:',
+                    max_size=int(app.config.get('metadata_cache_size', 32) * 1024 * 1024)
+                )
+    return _metadata_cache
@@ -0,0 +1,29 @@
+import threading
+from collections import defaultdict
+from typing import Dict
+
+
+class Metrics:
+    """ Thread-safe named counters and measurements, to see what the caches and the shared work save """
+
+    def __init__(self):
+        self._counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name: str, value: float) -> None:
+        """ Records a measurement (a duration, a size...): its count, total and maximum are kept """
+        with self._lock:
+            self._counters[f'{name}.count'] += 1
+            self._counters[f'{name}.total'] += value
+            self._counters[f'{name}.max'] = max(self._counters[f'{name}.max'], value)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(sorted(self._counters.items()))
+
+
+metrics = Metrics()
@@ -0,0 +1,122 @@
+import base64
+import json
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Callable, Iterable, Sequence, Tuple, Union
+import flask
+
+
+# Number of (listing, offset) -> cursor translations remembered
+CURSOR_CACHE_SIZE = 10000
+
+
+def encode_cursor(position: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(position, separators=(',', ':')).encode('utf-8')).rstrip(b'=').decode('utf-8')
+
+
+def decode_cursor(cursor: str) -> Union[tuple, None]:
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        return None
+    return tuple(position) if isinstance(position, list) else None
+
+
+class KeysetQuery:
+    """ A listing paged by its sort key rather than by offset: each page starts right after the (sort key, id)
+    of the previous one, so fetching a page does not depend on how deep it is, and changes to the library
+    between two pages can't make rows be skipped or repeated """
+
+    def __init__(self, source: str, keys: Sequence[str] = (), where: str = '', params: Iterable = (),
+                 descending: bool = False):
+        # source is a table or a subquery, and must have an 'id' column
+        # keys are SQL expressions, without NULLs (the id is always added as the last key, to make it unique)
+        self.source = source
+        self.keys = tuple(keys) + ('id',)
+        self.where = where
+        self.params = tuple(params)
+        self.descending = descending
+
+    def sql(self, limit: int, position: Union[tuple, None] = None, offset: int = 0) -> Tuple[str, tuple]:
+        conditions = [f'({self.where})'] if self.where else []
+        params = list(self.params)
+
+        if position is not None:
+            conditions.append(f"({', '.join(self.keys)}) {'<' if self.descending else '>'} "
+                              f"({', '.join('?' * len(self.keys))})")
+            params.extend(position)
+
+        direction = ' DESC' if self.descending else ''
+        query = f"SELECT {', '.join(self.keys)} FROM {self.source}"
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY ' + ', '.join(f'{key}{direction}' for key in self.keys) + ' LIMIT ?'
+        params.append(limit)
+        if offset:
+            query += ' OFFSET ?'
+            params.append(offset)
+        return query, tuple(params)
+
+    def page(self, limit: int, position: Union[tuple, None] = None, offset: int = 0,
+             execute: Union[Callable, None] = None) -> Tuple[array, Union[tuple, None]]:
+        """ Returns the IDs of the page, and the position of its last row """
+        if limit <= 0:
+            return array('q'), None
+
+        query, params = self.sql(limit, position, offset)
+        if execute is None:
+            with flask.g.lib.transaction() as tx:
+                rows = tx.query(query, params)
+        else:
+            rows = execute(query, params)
+
+        ids = array('q', (row[-1] for row in rows))
+        return ids, (tuple(rows[-1]) if rows else None)
+
+
+class CursorCache:
+    """ Remembers where the pages of a listing end, so that plain offsets can be turned into cursors """
+
+    def __init__(self, max_entries: int = CURSOR_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Union[tuple, None]:
+        with self._lock:
+            position = self._entries.get(key)
+            if position is not None:
+                self._entries.move_to_end(key)
+            return position
+
+    def put(self, key: tuple, position: tuple) -> None:
+        with self._lock:
+            self._entries[key] = position
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_cursor_cache = CursorCache()
+
+
+def paginate(query: KeysetQuery, signature: tuple, limit: int, offset: int = 0, cursor: Union[str, None] = None,
+             execute: Union[Callable, None] = None) -> Tuple[array, Union[str, None]]:
+    """ Returns the IDs of a page of the listing, and the cursor of the next page (None if it was the last one).
+    The page starts at the given cursor if any, or else at the given offset (using the cursor of the previous
+    page when it is known). signature identifies the listing, regardless of where its pages start """
+
+    position = decode_cursor(cursor) if cursor else None
+    if position is not None:
+        offset = None
+    elif offset:
+        position = _cursor_cache.get((signature, offset))
+
+    ids, last = query.page(limit, position, offset if position is None else 0, execute=execute)
+
+    if last is None or len(ids) < limit:
+        return ids, None
+    if offset is not None:
+        _cursor_cache.put((signature, offset + len(ids)), last)
+    return ids, encode_cursor(last)
@@ -1,4 +1,5 @@
 from beetsplug.beetstreamnext.utils import PLY_ID_PREF, genres_formatter, creation_date, map_song
+from beetsplug.beetstreamnext.projection import songs_query, song_records
 from beetsplug.beetstreamnext import app
 import flask
 from typing import Union, List
@@ -23,7 +24,9 @@ class Playlist:
                 song = [flask.g.lib.get_item(entry_id)]
             else:
                 with flask.g.lib.transaction() as tx:
-                    song = tx.query("SELECT * FROM items WHERE (path) LIKE (?) LIMIT 1", (entry_path.as_posix(),))
+                    song = list(song_records(
+                        tx.query(songs_query("WHERE (path) LIKE (?) LIMIT 1"), (entry_path.as_posix(),))
+                    ))
 
             if song:
                 self.songs.append(map_song(song[0]))
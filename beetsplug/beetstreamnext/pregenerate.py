@@ -0,0 +1,92 @@
+from beetsplug.beetstreamnext.coverart import extract_cover
+from beetsplug.beetstreamnext.imaging import NEGOTIATED_FORMATS, resize_image
+from beetsplug.beetstreamnext.thumbnails import ThumbnailCache, thumbnail_key
+from beetsplug.beetstreamnext import app
+import os
+import time
+import multiprocessing
+from io import BytesIO
+from typing import Callable, Iterator, List, Sequence, Tuple, Union
+
+
+# Sizes most clients ask for (list rows, grids, album pages, full screen)
+THUMBNAIL_SIZES = (64, 250, 500, 1200)
+
+# Formats getCoverArt can send (JPEG, and WebP or AVIF to the clients that accept them)
+THUMBNAIL_FORMATS = ('jpeg', *NEGOTIATED_FORMATS)
+
+
+def _make_thumbnails(job: tuple) -> List[Tuple[str, bytes]]:
+    """ Runs in the worker processes: reads a cover once, and makes the missing sizes of it.
+    The images are the same as what getCoverArt makes (see resize_image), decoding a JPEG again for each size is
+    cheaper than resizing a full decode, as the decoder itself scales it down """
+    kind, path, missing = job
+    try:
+        if kind == 'album_art':
+            with open(path, 'rb') as f:
+                data = f.read()
+        else:
+            cover = extract_cover(path)
+            if cover is None:
+                return []
+            data = cover.getvalue()
+    except (OSError, ValueError):
+        return []
+
+    thumbnails = []
+    for name, size, fmt in missing:
+        try:
+            thumbnail = resize_image(BytesIO(data), size, fmt)
+        except (OSError, ValueError):
+            continue
+        thumbnails.append((name, thumbnail.getvalue()))
+    return thumbnails
+
+
+def _jobs(lib, cache: ThumbnailCache, sizes: Sequence[int], formats: Sequence[str]) -> Iterator[tuple]:
+    """ Covers with some sizes (or formats) missing from the cache. Thumbnails are keyed like in getCoverArt (on the
+    path and mtime of their source), so covers that did not change since the last run are skipped """
+
+    with lib.transaction() as tx:
+        albums = tx.query("SELECT artpath FROM albums WHERE artpath IS NOT NULL AND artpath != ''")
+        singletons = tx.query("SELECT path, mtime FROM items WHERE album_id IS NULL")
+
+    sources = []
+    for (artpath,) in albums:
+        art_path = (artpath or b'').decode('utf-8')
+        try:
+            mtime = os.path.getmtime(art_path)
+        except OSError:
+            continue
+        sources.append(('album_art', art_path, mtime))
+    for path, mtime in singletons:
+        sources.append(('embedded_art', path, mtime))
+
+    for kind, path, mtime in sources:
+        names = [(thumbnail_key((kind, path, mtime, size, fmt)), size, fmt) for size in sizes for fmt in formats]
+        missing = [(name, size, fmt) for name, size, fmt in names if name not in cache]
+        if missing:
+            yield kind, path, missing
+
+
+def pregenerate_art(lib, cache: ThumbnailCache, sizes: Sequence[int] = THUMBNAIL_SIZES,
+                    formats: Sequence[str] = THUMBNAIL_FORMATS, processes: Union[int, None] = None,
+                    progress: Union[Callable[[int, int, int, float], None], None] = None) -> Tuple[int, int]:
+    """ Makes the thumbnails of every album cover, and of the covers embedded in songs without an album, with a
+    pool of processes (one per core by default). Returns the number of covers processed and of thumbnails made """
+
+    jobs = list(_jobs(lib, cache, sizes, formats))
+    made = 0
+    start = time.monotonic()
+
+    with multiprocessing.Pool(processes) as pool:
+        for done, thumbnails in enumerate(pool.imap_unordered(_make_thumbnails, jobs, chunksize=4), 1):
+            for name, data in thumbnails:
+                cache.put(name, data)
+            made += len(thumbnails)
+            if progress is not None:
+                progress(done, len(jobs), made, time.monotonic() - start)
+
+    if cache.size >= cache.max_size * 0.95:
+        app.logger.warning('The thumbnails cache is full, some thumbnails were evicted: consider a larger thumbnail_cache_size')
+    return len(jobs), made
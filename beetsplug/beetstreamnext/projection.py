@@ -0,0 +1,95 @@
+import sys
+from typing import Iterable, Iterator
+
+
+# === Columns needed by each type of Subsonic response ===
+# Only these are read from the Beets tables: the others (lyrics, acoustid fingerprints, replaygain, etc.) can make
+# up most of the size of a row, and would be fetched and decoded for nothing
+
+# Child (songs)
+CHILD_COLUMNS = (
+    'id', 'album_id', 'path', 'title', 'album', 'albumartist', 'genre', 'year', 'month', 'day',
+    'original_year', 'original_month', 'original_day', 'track', 'disc', 'length', 'bitrate', 'bitdepth',
+    'samplerate', 'channels', 'bpm', 'format', 'mb_albumid', 'mb_artistid', 'added', 'mtime'
+)
+# Flexible attributes of the songs (stored as text in the item_attributes table), with their types
+CHILD_FLEX_COLUMNS = {'play_count': int, 'last_played': float, 'stars_rating': float}
+
+# AlbumID3
+ALBUM_ID3_COLUMNS = (
+    'id', 'artpath', 'album', 'albumartist', 'genre', 'year', 'month', 'day',
+    'original_year', 'original_month', 'original_day', 'disctotal', 'comp', 'mb_albumid', 'mb_albumartistid',
+    'albumtype', 'albumtypes', 'label', 'added'
+)
+
+# ArtistID3 (artists are aggregated from the albums table)
+ARTIST_ID3_COLUMNS = ('albumartist', 'mb_albumartistid')
+
+_SQL_TYPES = {int: 'INTEGER', float: 'REAL'}
+
+
+class _Record:
+    """ Compact read-only record, that can be used wherever the mappers expect a dict-like Beets row """
+    __slots__ = ()
+
+    def keys(self):
+        return self.__slots__
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def values(self) -> tuple:
+        return tuple(getattr(self, key) for key in self.__slots__)
+
+
+class SongRecord(_Record):
+    __slots__ = CHILD_COLUMNS + tuple(CHILD_FLEX_COLUMNS)
+
+
+class AlbumRecord(_Record):
+    __slots__ = ALBUM_ID3_COLUMNS
+
+
+def make_record(cls, values: Iterable, intern: bool = False):
+    record = cls.__new__(cls)
+    for key, val in zip(cls.__slots__, values):
+        # Interning makes all the repeated strings (album names, artists, genres, formats...) share memory
+        setattr(record, key, sys.intern(val) if intern and isinstance(val, str) else val)
+    return record
+
+
+def _flex_column(key: str, kind: type) -> str:
+    return (f"COALESCE(CAST((SELECT value FROM item_attributes WHERE entity_id = items.id AND key = '{key}') "
+            f"AS {_SQL_TYPES[kind]}), 0) AS {key}")
+
+
+# Select lists, in the order of the records' slots
+SONG_SELECT = ', '.join(
+    [f'items.{column}' for column in CHILD_COLUMNS] +
+    [_flex_column(key, kind) for key, kind in CHILD_FLEX_COLUMNS.items()]
+)
+ALBUM_SELECT = ', '.join(f'albums.{column}' for column in ALBUM_ID3_COLUMNS)
+
+
+def songs_query(clauses: str = '') -> str:
+    """ Builds a query for songs, selecting only the columns needed for Child responses """
+    return f"SELECT {SONG_SELECT} FROM items {clauses}".rstrip()
+
+
+def albums_query(clauses: str = '') -> str:
+    """ Builds a query for albums, selecting only the columns needed for AlbumID3 responses """
+    return f"SELECT {ALBUM_SELECT} FROM albums {clauses}".rstrip()
+
+
+def song_records(rows: Iterable) -> Iterator[SongRecord]:
+    return (make_record(SongRecord, row) for row in rows)
+
+
+def album_records(rows: Iterable) -> Iterator[AlbumRecord]:
+    return (make_record(AlbumRecord, row) for row in rows)
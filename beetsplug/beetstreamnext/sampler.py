@@ -0,0 +1,144 @@
+from beetsplug.beetstreamnext.cache import library_generation
+from beetsplug.beetstreamnext.genreindex import genre_index
+from beetsplug.beetstreamnext import app
+import time
+import random
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Union
+import flask
+
+
+class _Shuffle:
+    """ A lazy Fisher-Yates shuffle of a pool of IDs, shared by all the sessions (and never modified): only the
+    positions that were swapped are stored, so drawing k IDs costs O(k) time and memory. No ID comes out twice
+    before the whole pool has been drawn, then a new shuffle starts """
+    __slots__ = ('pool', 'swaps', 'position', 'last_used')
+
+    def __init__(self, pool: array):
+        self.pool = pool
+        self.swaps = {}         # position -> ID now there, for the positions that differ from the pool
+        self.position = 0
+        self.last_used = time.monotonic()
+
+    def _next(self, exclude: set) -> int:
+        pool, swaps, i = self.pool, self.swaps, self.position
+        while True:
+            j = random.randrange(i, len(pool))
+            value = swaps.get(j, pool[j])
+            if value not in exclude:
+                break
+        current = swaps.pop(i, pool[i])
+        if j != i:
+            swaps[j] = current
+        self.position += 1
+        return value
+
+    def draw(self, size: int) -> array:
+        size = min(size, len(self.pool))
+        drawn = array('q')
+        recent = set()
+        while len(drawn) < size:
+            if self.position >= len(self.pool):
+                # Everything has been drawn: start over, but not with what this batch already has
+                self.swaps.clear()
+                self.position = 0
+                recent = set(drawn)
+            drawn.append(self._next(recent))
+        self.last_used = time.monotonic()
+        return drawn
+
+
+class RandomSampler:
+    """ Random songs and albums without sorting the whole library.
+    Candidate IDs (optionally filtered by genre and years) are read once per library generation, and each
+    listening session gets its own shuffle of them, so that nothing repeats within a session """
+
+    def __init__(self, max_pools: int = 64, max_sessions: int = 1024, session_ttl: float = 6 * 3600):
+        self.max_pools = max_pools
+        self.max_sessions = max_sessions
+        self.session_ttl = session_ttl
+        self.generation = None
+        self._pools = OrderedDict()         # (table, filters) -> array of IDs
+        self._sessions = OrderedDict()      # (session, table, filters) -> _Shuffle
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _read_pool(lib, table: str, genre: Union[str, None], from_year: Union[int, None],
+                   to_year: Union[int, None]) -> array:
+        catalog = app.config.get('catalog')
+        with_years = from_year is not None or to_year is not None
+        low, high = min(from_year or 0, to_year or 9999), max(from_year or 0, to_year or 9999)
+
+        pool = None
+        if genre:
+            # Exact matches, from the genre index
+            index = genre_index(lib)
+            pool = index.all_song_ids(genre) if table == 'items' else index.album_ids(genre)
+            if not with_years:
+                return pool
+
+        if catalog is not None:
+            records = catalog.songs if table == 'items' else catalog.albums
+            candidates = records.values() if pool is None else filter(None, map(records.get, pool))
+            return array('q', (rec.id for rec in candidates if not with_years or low <= (rec.year or 0) <= high))
+
+        query = f"SELECT id FROM {table}"
+        params = []
+        if with_years:
+            query += " WHERE year BETWEEN ? AND ?"
+            params.extend([low, high])
+        with lib.transaction() as tx:
+            ids = array('q', (row[0] for row in tx.query(query, params)))
+        if pool is not None:
+            in_years = set(ids)
+            ids = array('q', (i for i in pool if i in in_years))
+        return ids
+
+    def sample(self, table: str, size: int, session: str = '', genre: Union[str, None] = None,
+               from_year: Union[int, None] = None, to_year: Union[int, None] = None, lib=None) -> array:
+        """ Returns up to size random IDs from the given table ('items' or 'albums') """
+
+        lib = lib or flask.g.lib
+        generation = library_generation(lib)
+        filters = (genre, from_year, to_year)
+        pool_key = (table, filters)
+
+        with self._lock:
+            if generation != self.generation:
+                self._pools.clear()
+                self._sessions.clear()
+                self.generation = generation
+            pool = self._pools.get(pool_key)
+
+        if pool is None:
+            pool = self._read_pool(lib, table, genre, from_year, to_year)
+
+        with self._lock:
+            self._pools[pool_key] = pool
+            self._pools.move_to_end(pool_key)
+            while len(self._pools) > self.max_pools:
+                self._pools.popitem(last=False)
+
+            session_key = (session, table, filters)
+            shuffle = self._sessions.get(session_key)
+            if shuffle is None or time.monotonic() - shuffle.last_used > self.session_ttl:
+                shuffle = _Shuffle(pool)
+                self._sessions[session_key] = shuffle
+            self._sessions.move_to_end(session_key)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+            return shuffle.draw(size)
+
+
+_random_sampler = RandomSampler()
+
+
+def random_ids(table: str, size: int, genre: Union[str, None] = None,
+               from_year: Union[int, None] = None, to_year: Union[int, None] = None) -> array:
+    """ Random IDs for the current request. A session is a user on a given client """
+    r = flask.request.values
+    session = f"{r.get('u', '')}:{r.get('c', '')}"
+    return _random_sampler.sample(table, size, session, genre, from_year, to_year)
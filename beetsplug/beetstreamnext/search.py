@@ -1,5 +1,9 @@
 from beetsplug.beetstreamnext.utils import *
 from beetsplug.beetstreamnext import app
+from beetsplug.beetstreamnext.cache import conditional_response
+from beetsplug.beetstreamnext.artistindex import artist_index
+from beetsplug.beetstreamnext.searchindex import search_index
+from beetsplug.beetstreamnext.pagination import KeysetQuery, paginate
 from functools import partial
 
 
@@ -8,7 +12,7 @@ from functools import partial
 
 @app.route('/rest/search3', methods=["GET", "POST"])
 @app.route('/rest/search3.view', methods=["GET", "POST"])
-
+@conditional_response
 def search(ver=None):
     r = flask.request.values
 
@@ -35,23 +39,35 @@ def search(ver=None):
     else:
         pattern = f"%{query.lower()}%"
 
-    with flask.g.lib.transaction() as tx:
-        songs = list(tx.query(
-            "SELECT * FROM items WHERE lower(title) LIKE ? ORDER BY title LIMIT ? OFFSET ?",
-            (pattern, song_count, song_offset)
-        ))
-        albums = list(tx.query(
-            "SELECT * FROM albums WHERE lower(album) LIKE ? ORDER BY album LIMIT ? OFFSET ?",
-            (pattern, album_count, album_offset)
-        ))
-        artists = [row[0] for row in tx.query(
-            """SELECT DISTINCT albumartist FROM albums WHERE lower(albumartist) LIKE ? 
-            and albumartist is NOT NULL LIMIT ? OFFSET ?""",
-            (pattern, artist_count, artist_offset)
-        )]
+    catalog = app.config.get('catalog')
+    index = search_index() if query else None
+
+    song_cursor = album_cursor = None
+    if catalog is not None and index is None:
+        songs = catalog.search_songs(query, song_count, song_offset)
+        albums = catalog.search_albums(query, album_count, album_offset)
+    else:
+        if index is not None:
+            # Full-text search, by relevance
+            song_listing, album_listing, execute = index.songs_query(query), index.albums_query(query), index.execute
+        else:
+            song_listing = KeysetQuery('items', ("COALESCE(title, '')",), where="lower(title) LIKE ?", params=(pattern,))
+            album_listing = KeysetQuery('albums', ("COALESCE(album, '')",), where="lower(album) LIKE ?", params=(pattern,))
+            execute = None
+
+        # Only the IDs are fetched here, the rows themselves are read while the response is sent
+        song_ids, song_cursor = paginate(song_listing, ('searchSongs', query), song_count, song_offset,
+                                         r.get('songCursor'), execute=execute)
+        album_ids, album_cursor = paginate(album_listing, ('searchAlbums', query), album_count, album_offset,
+                                           r.get('albumCursor'), execute=execute)
 
-    # TODO - do the sort in the SQL query instead?
-    artists.sort(key=lambda name: strip_accents(name).upper())
+        if catalog is not None:
+            songs = filter(None, map(catalog.song, song_ids))
+            albums = filter(None, map(catalog.album, album_ids))
+        else:
+            songs = iter_rows('items', song_ids)
+            albums = iter_rows('albums', album_ids)
+    artists = artist_index().search(query, artist_count, artist_offset)
 
     if flask.request.path.rsplit('.', 1)[0][6:] == 'search2':
         tag = 'searchResult2'
@@ -61,9 +77,15 @@ def search(ver=None):
         tag = 'searchResult'
     payload = {
         tag: {
-            'artist': list(map(partial(map_artist, with_albums=False), artists)),  # no need to include albums twice
-            'album': list(map(partial(map_album, with_songs=False), albums)), # no need to include songs twice
-            'song': list(map(map_song, songs))
+            'artist': map(partial(map_artist, with_albums=False), artists),  # no need to include albums twice
+            'album': map_albums(albums, with_songs=False), # no need to include songs twice
+            'song': map(map_song, songs)
         }
     }
-    return subsonic_response(payload, r.get('f', 'xml'))
+    # Not part of the Subsonic API: clients that know about them can pass them back as songCursor and albumCursor
+    if song_cursor:
+        payload[tag]['songNextCursor'] = song_cursor
+    if album_cursor:
+        payload[tag]['albumNextCursor'] = album_cursor
+    # An empty search3 query returns the whole library, so this is streamed
+    return subsonic_response(payload, r.get('f', 'xml'), stream=True)
@@ -0,0 +1,156 @@
+from beetsplug.beetstreamnext.cache import library_generation
+from beetsplug.beetstreamnext.pagination import KeysetQuery
+from beetsplug.beetstreamnext import app
+import os
+import re
+import sqlite3
+import threading
+from array import array
+from typing import Union
+import flask
+
+
+# Indexed columns of each Beets table, by decreasing importance (used as BM25 weights). The first one is the name
+SONGS_FTS_COLUMNS = {'title': 10.0, 'artist': 5.0, 'albumartist': 4.0, 'album': 3.0, 'composer': 2.0, 'genre': 1.0}
+ALBUMS_FTS_COLUMNS = {'album': 10.0, 'albumartist': 5.0, 'genre': 1.0}
+
+_words = re.compile(r'\w+')
+
+
+def fts_query(query: str) -> str:
+    """ Turns what the user typed into an FTS5 query: every word must match, as a prefix (for type-ahead) """
+    return ' '.join(f'"{word}"*' for word in _words.findall(query))
+
+
+class SearchIndex:
+    """ Full-text index of the library, in a sidecar SQLite database.
+    Each indexed table has a plain copy of its searchable columns (the FTS5 external content), and triggers
+    keep the FTS5 index up to date with it. Syncing is a diff of that copy against the library, done in SQL
+    with the library attached, so only the rows that actually changed are re-indexed """
+
+    TABLES = (
+        # (index table, library table, columns)
+        ('songs', 'items', SONGS_FTS_COLUMNS),
+        ('albums', 'albums', ALBUMS_FTS_COLUMNS),
+    )
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path = path
+        self.generation = None
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._conn:
+            for table, _, columns in self.TABLES:
+                self._create(table, tuple(columns))
+
+    def _create(self, table: str, columns: tuple) -> None:
+        cols = ', '.join(columns)
+        new_cols = ', '.join(f'new.{c}' for c in columns)
+        old_cols = ', '.join(f'old.{c}' for c in columns)
+
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, {cols})")
+        self._conn.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+                {cols}, content='{table}', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3')
+        """)
+        self._conn.executescript(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_ai AFTER INSERT ON {table} BEGIN
+                INSERT INTO {table}_fts (rowid, {cols}) VALUES (new.id, {new_cols});
+            END;
+            CREATE TRIGGER IF NOT EXISTS {table}_ad AFTER DELETE ON {table} BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+            END;
+            CREATE TRIGGER IF NOT EXISTS {table}_au AFTER UPDATE ON {table} BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                INSERT INTO {table}_fts (rowid, {cols}) VALUES (new.id, {new_cols});
+            END;
+        """)
+
+    def _sync(self, lib) -> dict:
+        counts = {}
+        self._conn.execute("ATTACH DATABASE ? AS library", (os.fsdecode(lib.path),))
+        try:
+            with self._conn:
+                for table, source, columns in self.TABLES:
+                    cols = ', '.join(columns)
+                    deleted = self._conn.execute(
+                        f"DELETE FROM {table} WHERE id NOT IN (SELECT id FROM library.{source})"
+                    ).rowcount
+                    upserted = self._conn.execute(f"""
+                        INSERT INTO {table} (id, {cols})
+                        SELECT src.id, {', '.join(f'src.{c}' for c in columns)}
+                          FROM library.{source} AS src LEFT JOIN {table} AS idx ON idx.id = src.id
+                         WHERE idx.id IS NULL OR {' OR '.join(f'idx.{c} IS NOT src.{c}' for c in columns)}
+                        ON CONFLICT (id) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in columns)}
+                    """).rowcount
+                    counts[table] = (upserted, deleted)
+        finally:
+            self._conn.execute("DETACH DATABASE library")
+        return counts
+
+    def refresh(self, lib) -> 'SearchIndex':
+        generation = library_generation(lib)
+        if generation == self.generation:
+            return self
+
+        with self._lock:
+            if generation != self.generation:
+                counts = self._sync(lib)
+                self.generation = generation
+                app.logger.debug('Search index synced: ' + ', '.join(
+                    f'{table} ({upserted} updated, {deleted} removed)' for table, (upserted, deleted) in counts.items()
+                ))
+        return self
+
+    def _query(self, table: str, columns: dict, query: str) -> KeysetQuery:
+        weights = ', '.join(str(w) for w in columns.values())
+        name = next(iter(columns))
+        # Equal scores are ordered by name (then ID), so that pages are stable.
+        # fts_query() can be empty (nothing but punctuation), which must match nothing rather than fail
+        source = (f"(SELECT {table}_fts.rowid AS id, bm25({table}_fts, {weights}) AS score, "
+                  f"COALESCE({table}.{name}, '') AS name "
+                  f"FROM {table}_fts JOIN {table} ON {table}.id = {table}_fts.rowid WHERE {table}_fts MATCH ?)")
+        return KeysetQuery(source, ('score', 'name'), params=(fts_query(query) or '""',))
+
+    def songs_query(self, query: str) -> KeysetQuery:
+        """ Songs matching the query, by relevance """
+        return self._query('songs', SONGS_FTS_COLUMNS, query)
+
+    def albums_query(self, query: str) -> KeysetQuery:
+        """ Albums matching the query, by relevance """
+        return self._query('albums', ALBUMS_FTS_COLUMNS, query)
+
+    def execute(self, query: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+    def search_songs(self, query: str, count: int, offset: int = 0) -> array:
+        """ IDs of the best matching songs, by relevance """
+        return self.songs_query(query).page(count, offset=offset, execute=self.execute)[0]
+
+    def search_albums(self, query: str, count: int, offset: int = 0) -> array:
+        """ IDs of the best matching albums, by relevance """
+        return self.albums_query(query).page(count, offset=offset, execute=self.execute)[0]
+
+
+_search_index = None
+_search_index_lock = threading.Lock()
+
+
+def search_index(lib=None) -> Union[SearchIndex, None]:
+    """ Returns the (synced) search index, or None if FTS5 is not available """
+    global _search_index
+    if _search_index is None:
+        with _search_index_lock:
+            if _search_index is None:
+                try:
+                    _search_index = SearchIndex(app.config.get('search_index') or ':memory:')
+                except sqlite3.OperationalError as e:
+                    # SQLite was built without FTS5
+                    app.logger.warning(f'Full-text search is not available ({e}), falling back to simple search')
+                    _search_index = False
+    if _search_index is False:
+        return None
+    return _search_index.refresh(lib or flask.g.lib)
@@ -0,0 +1,259 @@
+from beetsplug.beetstreamnext.utils import NUMPY, genres_formatter
+from beetsplug.beetstreamnext.cache import library_generation
+from beetsplug.beetstreamnext.creditindex import credit_key, credits_separators
+from beetsplug.beetstreamnext import app
+import math
+import threading
+import zlib
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Union
+import flask
+
+if NUMPY:
+    import numpy as np
+
+
+# Layout of the feature vectors. Genres and artists are hashed into a fixed number of buckets, so that the
+# dimensions never change and vectors can be kept from one rebuild to the next
+GENRE_BUCKETS = 64
+ARTIST_BUCKETS = 128
+NUMERIC_FEATURES = ('year', 'bpm', 'length', 'plays')
+DIMENSIONS = GENRE_BUCKETS + ARTIST_BUCKETS + 2 * len(NUMERIC_FEATURES)
+
+# Relative importance of each group of features
+GENRE_WEIGHT = 1.0
+ARTIST_WEIGHT = 0.7
+NUMERIC_WEIGHTS = {'year': 0.5, 'bpm': 0.3, 'length': 0.2, 'plays': 0.3}
+
+# Other artists of the same album count for this much of the song's own artists
+ALBUM_ARTISTS_WEIGHT = 0.5
+
+# Ranges of the numeric features (values outside are clamped)
+NUMERIC_RANGES = {'year': (1900, 2030), 'bpm': (50, 200), 'length': (math.log(60), math.log(1200)),
+                  'plays': (0, math.log1p(200))}
+
+
+def _bucket(token: str, buckets: int) -> int:
+    return zlib.crc32(token.encode('utf-8')) % buckets
+
+
+def _angle(value: float, feature: str) -> float:
+    """ Maps a value to an angle in [0, pi]: the dot product of two (cos, sin) pairs is then the cosine of
+    their difference, so close values are similar, and far apart ones are not """
+    low, high = NUMERIC_RANGES[feature]
+    return math.pi * min(max((value - low) / (high - low), 0.0), 1.0)
+
+
+class _Snapshot(NamedTuple):
+    ids: 'np.ndarray'               # song IDs, in the order of the rows
+    album_ids: 'np.ndarray'
+    matrix: 'np.ndarray'            # one (normalised) feature vector per song
+    positions: Dict[int, int]       # song ID -> row
+    artist_rows: Dict[str, 'np.ndarray']    # album artist key -> rows of its songs
+    artist_keys: Dict[str, int]     # album artist key -> row in artist_matrix
+    artist_names: List[str]         # album artist names, in the order of artist_matrix
+    artist_matrix: 'np.ndarray'     # one (normalised) centroid per album artist
+
+
+class SimilarityEngine:
+    """ Offline similarity of songs and artists, from the library alone.
+    Every song is a vector of its genres, its artists (and the other artists of its album, so artists that
+    share albums end up close), year, tempo, duration and play count. Similar songs are the nearest neighbours
+    of a song (or of the centroid of an album or an artist), found with a single matrix product.
+    When the library changes, the engine is updated in a background thread (the previous vectors are used until it
+    is done), and only the vectors of the songs that actually changed are recomputed """
+
+    def __init__(self):
+        self.generation = None
+        self._signatures: Dict[int, tuple] = {}
+        self._snapshot: Union[_Snapshot, None] = None
+        self._lock = threading.Lock()
+        self._updater: Union[threading.Thread, None] = None
+
+    @staticmethod
+    def _vector(signature: tuple) -> 'np.ndarray':
+        genre, year, bpm, length, artists, album_artists, play_count = signature
+        vector = np.zeros(DIMENSIONS, dtype=np.float32)
+
+        genres = [g.casefold() for g in genres_formatter(genre or '') if g]
+        for name in genres:
+            vector[_bucket(name, GENRE_BUCKETS)] += GENRE_WEIGHT / math.sqrt(len(genres))
+
+        artist_part = vector[GENRE_BUCKETS:GENRE_BUCKETS + ARTIST_BUCKETS]
+        for token in album_artists:
+            artist_part[_bucket(token, ARTIST_BUCKETS)] = ALBUM_ARTISTS_WEIGHT
+        for token in artists:
+            artist_part[_bucket(token, ARTIST_BUCKETS)] = 1.0
+        norm = np.linalg.norm(artist_part)
+        if norm:
+            artist_part *= ARTIST_WEIGHT / norm
+
+        values = {'year': year, 'bpm': bpm, 'length': math.log(length) if length else 0, 'plays': math.log1p(play_count)}
+        offset = GENRE_BUCKETS + ARTIST_BUCKETS
+        for i, feature in enumerate(NUMERIC_FEATURES):
+            # Unknown values (no year, no bpm...) are left out rather than taken as very small ones
+            if values[feature] or feature == 'plays':
+                angle = _angle(values[feature], feature)
+                vector[offset + 2 * i] = NUMERIC_WEIGHTS[feature] * math.cos(angle)
+                vector[offset + 2 * i + 1] = NUMERIC_WEIGHTS[feature] * math.sin(angle)
+
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def refresh(self, lib, wait: bool = False) -> 'SimilarityEngine':
+        """ Starts updating the engine if the library changed, and returns right away (or once it is up to date,
+        if wait). Until then, the similarities are those of the previous library state (or none at first) """
+        generation = library_generation(lib)
+        if generation == self.generation:
+            return self
+
+        with self._lock:
+            if self._updater is None:
+                self._updater = threading.Thread(target=self._update, args=(lib, generation),
+                                                 name='beetstreamnext-similarity', daemon=True)
+                self._updater.start()
+            updater = self._updater
+
+        if wait:
+            updater.join()
+        return self
+
+    def _update(self, lib, generation: int) -> None:
+        try:
+            self._rebuild(lib, generation)
+        except Exception as e:
+            app.logger.error(f'Similarity engine update failed: {e}')
+            # Not again until the library changes
+            self.generation = generation
+        finally:
+            with self._lock:
+                self._updater = None
+
+    def _rebuild(self, lib, generation: int) -> None:
+        with lib.transaction() as tx:
+            rows = tx.query("""
+                SELECT items.id, items.album_id, items.albumartist, items.mb_albumartistid, items.mb_artistid,
+                       items.mb_artistids, items.genre, items.year, items.bpm, items.length,
+                       COALESCE(CAST(plays.value AS INTEGER), 0)
+                  FROM items
+                  LEFT JOIN item_attributes AS plays ON plays.entity_id = items.id AND plays.key = 'play_count'
+                 ORDER BY items.id
+            """)
+
+        # Artists are identified by MBID when there is one, and by name otherwise
+        songs = []
+        album_artists = defaultdict(set)
+        for song_id, album_id, albumartist, albumartist_mbid, artist_mbid, artist_mbids, *features in rows:
+            artists = {albumartist_mbid or credit_key(albumartist or '')}
+            artists.update(m for m in credits_separators.split(f'{artist_mbid or ""};{artist_mbids or ""}') if m)
+            artists.discard('')
+            album_artists[album_id].update(artists)
+            songs.append((song_id, album_id, albumartist or '', frozenset(artists), features))
+
+        old = self._snapshot
+        ids = np.fromiter((song[0] for song in songs), dtype=np.int64, count=len(songs))
+        album_ids = np.fromiter((song[1] or 0 for song in songs), dtype=np.int64, count=len(songs))
+        matrix = np.empty((len(songs), DIMENSIONS), dtype=np.float32)
+        signatures = {}
+        kept_rows, kept_old_rows = [], []
+        artist_rows = defaultdict(list)
+        artist_names = {}
+
+        for row, (song_id, album_id, artist, artists, (genre, year, bpm, length, play_count)) in enumerate(songs):
+            signature = (genre, year or 0, bpm or 0, round(length or 0), artists,
+                         frozenset(album_artists[album_id] - artists), play_count)
+            signatures[song_id] = signature
+            if artist:
+                key = credit_key(artist)
+                artist_rows[key].append(row)
+                artist_names.setdefault(key, artist)
+            if old is not None and self._signatures.get(song_id) == signature:
+                kept_rows.append(row)
+                kept_old_rows.append(old.positions[song_id])
+            else:
+                matrix[row] = self._vector(signature)
+
+        if kept_rows:
+            matrix[kept_rows] = old.matrix[kept_old_rows]
+
+        artist_keys = {key: i for i, key in enumerate(artist_rows)}
+        artist_rows = {key: np.array(rows, dtype=np.int64) for key, rows in artist_rows.items()}
+        artist_matrix = np.zeros((len(artist_keys), DIMENSIONS), dtype=np.float32)
+        for key, i in artist_keys.items():
+            artist_matrix[i] = matrix[artist_rows[key]].sum(axis=0)
+        norms = np.linalg.norm(artist_matrix, axis=1, keepdims=True)
+        artist_matrix /= np.where(norms > 0, norms, 1)
+
+        self._snapshot = _Snapshot(
+            ids=ids, album_ids=album_ids, matrix=matrix,
+            positions={song_id: row for row, song_id in enumerate(ids.tolist())},
+            artist_rows=artist_rows, artist_keys=artist_keys, artist_names=list(artist_names.values()),
+            artist_matrix=artist_matrix
+        )
+        self._signatures = signatures
+        self.generation = generation
+        app.logger.debug(f'Similarity engine updated ({len(songs) - len(kept_rows)} of {len(songs)} songs changed)')
+
+    @staticmethod
+    def _nearest(matrix: 'np.ndarray', rows: 'np.ndarray', count: int, exclude: Iterable[int] = ()) -> 'np.ndarray':
+        """ Rows of the matrix closest to the centroid of the given rows, best first """
+        if not len(rows) or count <= 0:
+            return np.empty(0, dtype=np.int64)
+        centroid = matrix[rows].sum(axis=0)
+        scores = matrix @ centroid
+        scores[list(exclude)] = -np.inf
+        count = min(count, int(np.isfinite(scores).sum()))
+        if count <= 0:
+            return np.empty(0, dtype=np.int64)
+        best = np.argpartition(-scores, count - 1)[:count]
+        return best[np.argsort(-scores[best], kind='stable')]
+
+    def _similar_songs(self, rows: 'np.ndarray', count: int, exclude: bool = True) -> List[int]:
+        snapshot = self._snapshot
+        if snapshot is None:
+            return []
+        return snapshot.ids[self._nearest(snapshot.matrix, rows, count, exclude=rows if exclude else ())].tolist()
+
+    def similar_to_songs(self, song_ids: Iterable[int], count: int) -> List[int]:
+        """ IDs of the songs most similar to the given ones (which are not included) """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return []
+        rows = np.array([snapshot.positions[i] for i in song_ids if i in snapshot.positions], dtype=np.int64)
+        return self._similar_songs(rows, count)
+
+    def similar_to_album(self, album_id: int, count: int) -> List[int]:
+        """ IDs of the songs most similar to the album as a whole (its own songs are not included) """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return []
+        return self._similar_songs(np.flatnonzero(snapshot.album_ids == album_id), count)
+
+    def similar_to_artist(self, artist_name: str, count: int) -> List[int]:
+        """ IDs of the songs closest to the album artist's (which includes its own songs, like an artist radio) """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return []
+        rows = snapshot.artist_rows.get(credit_key(artist_name), np.empty(0, dtype=np.int64))
+        return self._similar_songs(rows, count, exclude=False)
+
+    def similar_artists(self, artist_name: str, count: int) -> List[str]:
+        """ Names of the album artists most similar to the given one """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return []
+        row = snapshot.artist_keys.get(credit_key(artist_name))
+        if row is None:
+            return []
+        nearest = self._nearest(snapshot.artist_matrix, np.array([row]), count, exclude=[row])
+        return [snapshot.artist_names[i] for i in nearest]
+
+
+_similarity_engine = SimilarityEngine()
+
+
+def similarity_engine(lib=None) -> Union[SimilarityEngine, None]:
+    """ Returns the (up to date) similarity engine, or None if it is disabled or NumPy is not installed """
+    if not NUMPY or not app.config.get('local_similarity', True):
+        return None
+    return _similarity_engine.refresh(lib or flask.g.lib)
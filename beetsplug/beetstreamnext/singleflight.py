@@ -0,0 +1,53 @@
+from beetsplug.beetstreamnext.metrics import metrics
+import threading
+from typing import Any, Callable, Hashable, Tuple
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """ Coalesces concurrent calls doing the same work: the first caller for a key does it, and the callers
+    that arrive while it is running wait for it and share its result (or its exception).
+    Keys are (operation, parameters...) tuples, and the counts of executed and coalesced calls are kept per
+    operation in the metrics """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Tuple[Hashable, ...], fn: Callable[[], Any]) -> Any:
+        operation = key[0]
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            metrics.increment(f'singleflight.{operation}.coalesced')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        metrics.increment(f'singleflight.{operation}.executed')
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+single_flight = SingleFlight()
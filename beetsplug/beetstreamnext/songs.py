@@ -1,15 +1,21 @@
 from beetsplug.beetstreamnext.utils import *
 from beetsplug.beetstreamnext import app, stream
+from beetsplug.beetstreamnext.artistindex import artist_index
+from beetsplug.beetstreamnext.genreindex import genre_index
+from beetsplug.beetstreamnext.creditindex import credit_index
+from beetsplug.beetstreamnext.topsongs import top_songs_index
+from beetsplug.beetstreamnext.similarity import similarity_engine
+from beetsplug.beetstreamnext.enrichment import lastfm_artist
+from beetsplug.beetstreamnext.pagination import encode_cursor, decode_cursor
+from beetsplug.beetstreamnext.sampler import random_ids
 import flask
-import re
 
 
-artists_separators = re.compile(r', | & ')
-
 
 def song_payload(subsonic_song_id: str) -> dict:
     beets_song_id = sub_to_beets_song(subsonic_song_id)
-    song_item = flask.g.lib.get_item(beets_song_id)
+    catalog = app.config.get('catalog')
+    song_item = catalog.song(beets_song_id) if catalog is not None else next(iter_rows('items', [beets_song_id]), None)
 
     payload = {
         'song': map_song(song_item)
@@ -31,23 +37,35 @@ def get_song():
 def songs_by_genre():
     r = flask.request.values
 
-    genre = r.get('genre').replace("'", "\\'")
+    genre = r.get('genre', '')
     count = int(r.get('count') or 10)
     offset = int(r.get('offset') or 0)
 
-    genre_pattern = f"%{genre}%"
-    with flask.g.lib.transaction() as tx:
-        songs = list(tx.query(
-            "SELECT * FROM items WHERE lower(genre) LIKE lower(?) ORDER BY title LIMIT ? OFFSET ?",
-            (genre_pattern, count, offset)
-        ))
+    index = genre_index()
+
+    # Songs are in title order, a cursor is the (title, ID) of the last song of the previous page
+    after = None
+    position = decode_cursor(r['cursor']) if r.get('cursor') else None
+    if (position is not None and len(position) == 2
+            and isinstance(position[0], str) and isinstance(position[1], int)):
+        after = position
+
+    song_ids = index.song_ids(genre, count, offset, after)
+
+    catalog = app.config.get('catalog')
+    songs = filter(None, map(catalog.song, song_ids)) if catalog is not None else iter_rows('items', song_ids)
 
     payload = {
         "songsByGenre": {
-            "song": list(map(map_song, songs))
+            "song": map(map_song, songs)
         }
     }
-    return subsonic_response(payload, r.get('f', 'xml'))
+    if count and len(song_ids) == count:
+        # Not part of the Subsonic API: clients that know about it can pass it back as the 'cursor' parameter
+        last_song = catalog.song(song_ids[-1]) if catalog is not None else next(iter_rows('items', song_ids[-1:]), None)
+        if last_song is not None:
+            payload['songsByGenre']['nextCursor'] = encode_cursor((last_song['title'] or '', last_song['id']))
+    return subsonic_response(payload, r.get('f', 'xml'), stream=True)
 
 
 @app.route('/rest/getRandomSongs', methods=["GET", "POST"])
@@ -56,15 +74,14 @@ def get_random_songs():
     r = flask.request.values
 
     size = int(r.get('size') or 10)
+    genre = r.get('genre')
+    from_year = int(r['fromYear']) if r.get('fromYear') else None
+    to_year = int(r['toYear']) if r.get('toYear') else None
+
+    song_ids = random_ids('items', size, genre, from_year, to_year)
 
-    with flask.g.lib.transaction() as tx:
-        # Advance the SQL random generator state
-        _ = list(tx.query("SELECT RANDOM()"))
-        # Now fetch the random songs
-        songs = list(tx.query(
-            "SELECT * FROM items ORDER BY RANDOM() LIMIT ?",
-            (size,)
-        ))
+    catalog = app.config.get('catalog')
+    songs = filter(None, map(catalog.song, song_ids)) if catalog is not None else iter_rows('items', song_ids)
 
     payload = {
         "randomSongs": {
@@ -121,35 +138,39 @@ def get_top_songs():
     r = flask.request.values
 
     req_id = r.get('id', '')
+    limit = int(r.get('count') or 50)
 
     payload = {'topSongs': {'song': []}}
 
     if req_id.startswith(ART_ID_PREF):
         artist_name = sub_to_beets_artist(req_id)
         # grab the artist's mbid
-        with flask.g.lib.transaction() as tx:
-            mbid_artist = tx.query(f""" SELECT mb_artistid FROM items WHERE albumartist LIKE '{artist_name}' LIMIT 1 """)
+        artist = artist_index().get(artist_name)
+        mbid = artist.mbid if artist else ''
 
+        song_ids = []
         if app.config['lastfm_api_key']:
-            # Query last.fm for top tracks for this artist and parse the response
-            if mbid_artist:
-                lastfm_resp = query_lastfm(query=mbid_artist[0][0], type='artist', method='TopTracks', mbid=True)
-            else:
-                lastfm_resp = query_lastfm(query=artist_name, type='artist', method='TopTracks', mbid=False)
+            # Top tracks for this artist from last.fm (as cached by the enrichment worker)
+            lastfm_resp = lastfm_artist(artist_name, mbid, 'TopTracks')
 
             if lastfm_resp:
-                beets_results = [flask.g.lib.items(f"""title:{t.get('name', '').replace("'", "")}""")
-                                 for t in lastfm_resp.get('toptracks', {}).get('track', [])]
-                top_tracks_available = [track[0] for track in beets_results if track]
-
-                payload = {
-                    'topSongs': {
-                        'song': list(map(map_song, top_tracks_available))
-                    }
-                }
-        else:
-            # TODO - Use the local play_count in this case
-            pass
+                # Look all the tracks up at once, among the songs of this artist only
+                song_ids = top_songs_index().match(
+                    artist_name, (t.get('name', '') for t in lastfm_resp.get('toptracks', {}).get('track', []))
+                )[:limit]
+
+        if not song_ids:
+            # No last.fm (or nothing matched): use the local play counts
+            song_ids = top_songs_index().most_played(artist_name, limit)
+
+        catalog = app.config.get('catalog')
+        beets_results = filter(None, map(catalog.song, song_ids)) if catalog is not None else iter_rows('items', song_ids)
+
+        payload = {
+            'topSongs': {
+                'song': list(map(map_song, beets_results))
+            }
+        }
 
     return subsonic_response(payload, r.get('f', 'xml'))
 
@@ -183,13 +204,13 @@ def get_similar_songs():
     r = flask.request.values
 
     req_id = r.get('id')
-    limit = r.get('count', 50)
+    limit = int(r.get('count') or 50)
 
     if req_id.startswith(ART_ID_PREF):
         artist_name = sub_to_beets_artist(req_id)
         # grab the artist's mbid
-        with flask.g.lib.transaction() as tx:
-            mbid_artist = tx.query(f""" SELECT mb_artistid FROM items WHERE albumartist LIKE '{artist_name}' LIMIT 1 """)
+        artist = artist_index().get(artist_name)
+        mbid = artist.mbid if artist else ''
     elif req_id.startswith(SNG_ID_PREF):
         # TODO - Maybe query the track.getSimilar endpoint on lastfm instead of using the artist?
         beets_song_id = sub_to_beets_song(req_id)
@@ -197,14 +218,14 @@ def get_similar_songs():
         if not song_item:
             flask.abort(404)
         artist_name = song_item.get('albumartist', '')
-        mbid_artist = [[song_item.get('mb_artistid', '')]]
+        mbid = song_item.get('mb_artistid', '')
     elif req_id.startswith(ALB_ID_PREF):
         beets_album_id = sub_to_beets_album(req_id)
         album_object = flask.g.lib.get_album(beets_album_id)
         if not album_object:
             flask.abort(404)
         artist_name = album_object.get('albumartist', '')
-        mbid_artist = [[album_object.get('mb_artistid', '')]]
+        mbid = album_object.get('mb_albumartistid', '')
     else:
         flask.abort(404)    # just for now
 
@@ -212,59 +233,39 @@ def get_similar_songs():
 
     # If we can ask lastfm
     if app.config['lastfm_api_key']:
-        # Query last.fm for similar artists and parse the response
-        if mbid_artist:
-            lastfm_resp = query_lastfm(query=mbid_artist[0][0], type='artist', method='similar', mbid=True)
-        else:
-            lastfm_resp = query_lastfm(query=artist_name, type='artist', method='similar', mbid=False)
+        # Similar artists from last.fm (as cached by the enrichment worker)
+        lastfm_resp = lastfm_artist(artist_name, mbid, 'similar')
 
         if lastfm_resp:
 
             similar_artists = {
-                artist.get('name'): artist.get('mbid', '')
+                artist.get('name'): (artist.get('mbid', ''), float(artist.get('match') or 0))
                 for artist in lastfm_resp.get('similarartists', {}).get('artist', [])
             }
 
-    # Add the requested artist (will be the only fallback if no lastfm key available)
-    similar_artists[artist_name] = mbid_artist[0][0] if mbid_artist else ''
-
-    # Build up a humongous SQL query to get everything with related artists
-    mbid_fields = ['mb_artistid', 'mb_artistids']
-    name_fields = ['artist', 'artists', 'composer', 'lyricist']
-    conditions = []
-    params = []
-    for name, mbid in similar_artists.items():
-        if mbid:
-            # When we have an mbid, match against all relevant mbid fields
-            sub_conditions = []
-            # Check each mbid field for an exact match
-            for field in mbid_fields:
-                sub_conditions.append(f"{field} = ?")
-                params.append(mbid)
-            # Also check each name field with a LIKE condition
-            for field in name_fields:
-                sub_conditions.append(f"{field} LIKE ?")
-                params.append(f"%{name}%")
-            conditions.append("(" + " OR ".join(sub_conditions) + ")")
+    song_ids = []
+    engine = similarity_engine()
+    if not similar_artists and engine is not None:
+        # No lastfm: find the nearest songs in the library itself
+        if req_id.startswith(SNG_ID_PREF):
+            song_ids = engine.similar_to_songs([beets_song_id], limit)
+        elif req_id.startswith(ALB_ID_PREF):
+            song_ids = engine.similar_to_album(beets_album_id, limit)
         else:
-            # no mbid: typically with lastfm responses that's bc the entry is several artists in a collab
-            parts = re.split(artists_separators, name)
-            sub_conditions_outer = []
-            for part in parts:
-                sub_conditions_inner = []
-                for field in name_fields:
-                    sub_conditions_inner.append(f"{field} LIKE ?")
-                    params.append(f"%{part}%")
-                sub_conditions_outer.append("(" + " OR ".join(sub_conditions_inner) + ")")
-            conditions.append("(" + " OR ".join(sub_conditions_outer) + ")")
-
-    # we also let SQL remove duplicate rows using DISTINCT, and apply the limit there directly
-    query = "SELECT DISTINCT * FROM items WHERE " + " OR ".join(conditions) + " LIMIT ?"
-    params.append(limit)
-
-    # Run the single big SQL query
-    with flask.g.lib.transaction() as tx:
-        beets_results = list(tx.query(query, params))
+            song_ids = engine.similar_to_artist(artist_name, limit)
+
+    if not song_ids:
+        # Add the requested artist (will be the only fallback if no lastfm key available)
+        similar_artists[artist_name] = (mbid, 1.0)
+
+        # Find the songs crediting these artists (by MBID or name) in the index, and pick some according to similarity
+        song_ids = credit_index().sample(
+            ((name, mbid, match) for name, (mbid, match) in similar_artists.items() if name),
+            limit
+        )
+
+    catalog = app.config.get('catalog')
+    beets_results = filter(None, map(catalog.song, song_ids)) if catalog is not None else iter_rows('items', song_ids)
 
     # and finally reply to the client
     tag = 'similarSongs2' if flask.request.path.rsplit('.', 1)[0].endswith('2') else 'similarSongs'
@@ -0,0 +1,151 @@
+from beetsplug.beetstreamnext import app
+from beetsplug.beetstreamnext.metrics import metrics
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+from typing import Callable, Union
+
+
+def thumbnail_key(key: tuple) -> str:
+    """ Name of a thumbnail, from what identifies it: (source, path and mtime or MBID or URL, size, format).
+    Also used as its ETag """
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+class ThumbnailCache:
+    """ Resized images, stored on disk so they survive restarts.
+    Files are written atomically (to a temporary file, then renamed), and the least recently used ones
+    are deleted when the cache grows over max_size bytes. Keys include the mtime of the source (or its MBID or URL),
+    so a changed cover makes a new thumbnail, and the old one eventually gets evicted """
+
+    def __init__(self, directory: Union[str, os.PathLike], max_size: int = 256 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.size = 0
+        self._files = OrderedDict()     # name -> size, least recently used first
+        self._lock = threading.Lock()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._load()
+
+    def _load(self) -> None:
+        found = []
+        for path in self.directory.glob('*/*'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            if path.suffix == '.tmp':
+                # Left over by a crash
+                path.unlink(missing_ok=True)
+                continue
+            found.append((stat.st_mtime, path.name, stat.st_size))
+        for _, name, size in sorted(found):
+            self._files[name] = size
+            self.size += size
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._files or self._adopt(name)
+
+    def _path(self, name: str) -> Path:
+        return self.directory / name[:2] / name
+
+    def _adopt(self, name: str) -> bool:
+        """ Adds a thumbnail to the index if its file exists, as another process may have made it
+        (e.g. --pregenerate-art while the server runs) """
+        try:
+            size = self._path(name).stat().st_size
+        except OSError:
+            return False
+        with self._lock:
+            if name not in self._files:
+                self._files[name] = size
+                self.size += size
+        return True
+
+    def get(self, name: str) -> Union[Path, None]:
+        if name not in self:
+            return None
+        with self._lock:
+            if name not in self._files:
+                return None
+            self._files.move_to_end(name)
+        path = self._path(name)
+        try:
+            # The mtime is the last use time, so the LRU order is kept across restarts
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.size -= self._files.pop(name, 0)
+            return None
+        return path
+
+    def put(self, name: str, data: bytes) -> Path:
+        path = self._path(name)
+        path.parent.mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+        evicted = []
+        with self._lock:
+            self.size += len(data) - self._files.pop(name, 0)
+            self._files[name] = len(data)
+            while self.size > self.max_size and len(self._files) > 1:
+                old_name, old_size = self._files.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old_name)
+        for old_name in evicted:
+            self._path(old_name).unlink(missing_ok=True)
+        if evicted:
+            metrics.increment('thumbnails.evicted', len(evicted))
+        return path
+
+    def get_or_make(self, name: str, make: Callable[[], Union[bytes, None]]) -> Union[Path, BytesIO, None]:
+        """ Path of the thumbnail, made (and stored) first if needed. None if it can't be made, and the image
+        itself if it can't be stored """
+        path = self.get(name)
+        if path is not None:
+            metrics.increment('thumbnails.hits')
+            return path
+        metrics.increment('thumbnails.misses')
+        data = make()
+        if data is None:
+            return None
+        try:
+            return self.put(name, data)
+        except OSError as e:
+            app.logger.warning(f'Could not store thumbnail {name}: {e}')
+            return BytesIO(data)
+
+
+_thumbnail_cache = None
+_thumbnail_cache_lock = threading.Lock()
+
+
+def thumbnail_cache() -> Union[ThumbnailCache, None]:
+    """ Returns the thumbnails cache, or None if it is disabled """
+    global _thumbnail_cache
+    if _thumbnail_cache is None:
+        with _thumbnail_cache_lock:
+            if _thumbnail_cache is None:
+                directory = app.config.get('thumbnail_cache')
+                max_size = app.config.get('thumbnail_cache_size', 256)
+                if not directory or not max_size:
+                    _thumbnail_cache = False
+                else:
+                    try:
+                        _thumbnail_cache = ThumbnailCache(directory, max_size=int(max_size * 1024 * 1024))
+                    except OSError as e:
+                        app.logger.warning(f'Thumbnails cache disabled ({e})')
+                        _thumbnail_cache = False
+    return _thumbnail_cache or None
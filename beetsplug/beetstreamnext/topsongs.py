@@ -0,0 +1,101 @@
+from beetsplug.beetstreamnext.utils import strip_accents
+from beetsplug.beetstreamnext.cache import library_generation
+from beetsplug.beetstreamnext import app
+import re
+import threading
+from array import array
+from collections import defaultdict
+from typing import Dict, Iterable, List
+import flask
+
+
+# Parts of a title that Last.fm and the tags often disagree on: '(Remastered 2011)', '[Live]', ' - Radio Edit'...
+_title_extras = re.compile(r'\s*[(\[].*?[)\]]|\s+-\s+.*$')
+_non_words = re.compile(r'\W+')
+
+
+def title_key(title: str) -> str:
+    """ Normalises a song title, so that the variants of a title (case, accents, punctuation, remaster and
+    version suffixes) match each other """
+    title = strip_accents(title or '').casefold()
+    key = _non_words.sub(' ', _title_extras.sub('', title)).strip()
+    # A title that is nothing but a bracketed part keeps it
+    return key or _non_words.sub(' ', title).strip()
+
+
+def artist_key(name: str) -> str:
+    return ' '.join(strip_accents(name or '').casefold().split())
+
+
+class TopSongsIndex:
+    """ The songs of each album artist, by normalised title and by play count.
+    Matching the top tracks from Last.fm is then one lookup per track within the artist's songs, and the local
+    top songs (when Last.fm is not available) are a slice. Rebuilt with a single query whenever the library changes """
+
+    def __init__(self):
+        self.generation = None
+        self._titles: Dict[str, Dict[str, int]] = {}    # artist key -> title key -> song ID (the most played one)
+        self._top: Dict[str, array] = {}                # artist key -> played song IDs, most played first
+        self._lock = threading.Lock()
+
+    def refresh(self, lib) -> 'TopSongsIndex':
+        generation = library_generation(lib)
+        if generation == self.generation:
+            return self
+
+        with self._lock:
+            if generation == self.generation:
+                return self
+
+            with lib.transaction() as tx:
+                rows = tx.query("""
+                    SELECT items.id, items.albumartist, items.title,
+                           COALESCE(CAST(plays.value AS INTEGER), 0) AS play_count
+                      FROM items
+                      LEFT JOIN item_attributes AS plays ON plays.entity_id = items.id AND plays.key = 'play_count'
+                     WHERE items.albumartist IS NOT NULL AND items.albumartist != ''
+                     ORDER BY play_count DESC, items.id
+                """)
+
+            titles = defaultdict(dict)
+            top = defaultdict(lambda: array('q'))
+            keys = {}       # Album artists are very repetitive, normalise each one once
+            for song_id, albumartist, title, play_count in rows:
+                key = keys.get(albumartist)
+                if key is None:
+                    key = keys[albumartist] = artist_key(albumartist)
+                # Rows come most played first, so the first song with a title is the one to keep
+                titles[key].setdefault(title_key(title), song_id)
+                if play_count > 0:
+                    top[key].append(song_id)
+
+            self._titles, self._top = dict(titles), dict(top)
+            self.generation = generation
+            app.logger.debug(f'Top songs index rebuilt ({len(self._titles)} artists)')
+
+        return self
+
+    def match(self, artist: str, titles: Iterable[str]) -> List[int]:
+        """ IDs of the artist's songs with the given titles (in the same order, skipping the ones that aren't
+        in the library, and without duplicates) """
+        songs = self._titles.get(artist_key(artist))
+        if not songs:
+            return []
+        found, seen = [], set()
+        for title in titles:
+            song_id = songs.get(title_key(title))
+            if song_id is not None and song_id not in seen:
+                seen.add(song_id)
+                found.append(song_id)
+        return found
+
+    def most_played(self, artist: str, count: int) -> array:
+        """ IDs of the artist's most played songs """
+        return self._top.get(artist_key(artist), array('q'))[:count]
+
+
+_top_songs_index = TopSongsIndex()
+
+
+def top_songs_index(lib=None) -> TopSongsIndex:
+    return _top_songs_index.refresh(lib or flask.g.lib)
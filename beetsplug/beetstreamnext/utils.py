@@ -2,7 +2,7 @@ import unicodedata
 from datetime import datetime
 import platform
 from pathlib import Path
-from typing import Union
+from typing import Union, Iterable, Iterator
 import flask
 import json
 import base64
@@ -10,14 +10,17 @@ import mimetypes
 import os
 import re
 from beets import library
-import xml.etree.cElementTree as ET
-from xml.dom import minidom
 import shutil
 import importlib
-from functools import partial
-import requests
+from itertools import islice
+from array import array
 import urllib.parse
 from beetsplug.beetstreamnext import app
+from beetsplug.beetstreamnext.filestats import FileStatCache
+from beetsplug.beetstreamnext.httpclient import HttpClient, UPSTREAM_RATE_LIMITS
+from beetsplug.beetstreamnext.metadatacache import metadata_cache
+from beetsplug.beetstreamnext.artistregistry import artist_registry
+from beetsplug.beetstreamnext.projection import songs_query, albums_query, song_records, album_records
 
 
 
@@ -30,9 +33,28 @@ ALB_ID_PREF = 'al-'
 SNG_ID_PREF = 'sg-'
 PLY_ID_PREF = 'pl-'
 
+# Number of rows read per transaction when streaming large listings
+ROWS_BATCH_SIZE = 500
+# Size of the chunks sent to the client when streaming a response
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+# Sizes of the media files, so mapping songs does not need to hit the filesystem every time
+file_stats = FileStatCache()
+
+# Last.fm error codes that mean "try again later"
+LASTFM_TEMPORARY_ERRORS = {8, 11, 16, 29}
+
+# Connections to the external services (Last.fm, Deezer, MusicBrainz...), with timeouts, retries and rate limits
+http_client = HttpClient(
+    user_agent=f'BeetstreamNext/{BEETSTREAMNEXT_VERSION} ( https://github.com/FlorentLM/BeetstreamNext )',
+    rate_limits=UPSTREAM_RATE_LIMITS
+)
+
 
 FFMPEG_BIN = shutil.which("ffmpeg") is not None
 FFMPEG_PYTHON = importlib.util.find_spec("ffmpeg") is not None
+NUMPY = importlib.util.find_spec("numpy") is not None
 
 if FFMPEG_PYTHON:
     import ffmpeg
@@ -44,12 +66,25 @@ elif FFMPEG_BIN:
 # These IDs are sent to the client once (when it accesses endpoints such as getArtists or getAlbumList
 # and the client will then use these to access a specific item via endpoints that need an ID
 
-def beets_to_sub_artist(beet_artist_name):
-    base64_name = base64.urlsafe_b64encode(str(beet_artist_name).encode('utf-8'))
-    return f"{ART_ID_PREF}{base64_name.rstrip(b'=').decode('utf-8')}"
+def beets_to_sub_artist(beet_artist_name) -> Union[str, None]:
+    """ ID of an album artist of the library, or None if there is no such artist """
+    beet_artist_name = str(beet_artist_name)
+    artist_id = artist_registry().id_for(beet_artist_name)
+    if artist_id is None:
+        # Maybe new in the library: bringing the artist index up to date registers it (imported here, as the
+        # artist index needs this module)
+        from beetsplug.beetstreamnext.artistindex import artist_index
+        artist_index()
+        artist_id = artist_registry().id_for(beet_artist_name)
+    return f'{ART_ID_PREF}{artist_id}' if artist_id is not None else None
 
 def sub_to_beets_artist(subsonic_artist_id):
     subsonic_artist_id = str(subsonic_artist_id)[len(ART_ID_PREF):]
+    if subsonic_artist_id.isdigit():
+        artist_name = artist_registry().name_for(int(subsonic_artist_id))
+        if artist_name is not None:
+            return artist_name
+    # Older versions used the base64-encoded name as ID, clients may still have some of these
     padding = 4 - (len(subsonic_artist_id) % 4)
     return base64.urlsafe_b64decode(subsonic_artist_id + ('=' * padding)).decode('utf-8')
 
@@ -70,15 +105,18 @@ def sub_to_beets_song(subsonic_song_id):
 
 # TODO - Support multiartists lists!!! See https://opensubsonic.netlify.app/docs/responses/child/
 
+def as_mapping(beets_object):
+    """ Beets models and projected records can be read as they are, only raw SQL rows need a conversion """
+    return beets_object if hasattr(beets_object, 'get') else dict(beets_object)
+
 def map_media(beets_object: Union[dict, library.LibModel]):
-    beets_object = dict(beets_object)
+    beets_object = as_mapping(beets_object)
 
     artist_name = beets_object.get('albumartist', '')
 
     # Common fields to albums and songs
     subsonic_media = {
         'artist': artist_name,
-        'artistId': beets_to_sub_artist(artist_name),
         'displayArtist': artist_name,
         'displayAlbumArtist': artist_name,
         'album': beets_object.get('album', ''),
@@ -97,10 +135,15 @@ def map_media(beets_object: Union[dict, library.LibModel]):
             'day': beets_object.get('day', 0)
         },
     }
+    artist_id = beets_to_sub_artist(artist_name) if artist_name else None
+    if artist_id is not None:
+        subsonic_media['artistId'] = artist_id
     return subsonic_media
 
-def map_album(album_object: Union[dict, library.Album], with_songs=True) -> dict:
-    album = dict(album_object)
+def map_album(album_object: Union[dict, library.Album], with_songs=True, aggregates: Union[tuple, None] = None) -> dict:
+    """ aggregates is the album's (song count, duration, average rating), as returned by album_aggregates.
+    When not including songs, passing it avoids querying the album's songs """
+    album = as_mapping(album_object)
 
     subsonic_album = map_media(album)
 
@@ -124,7 +167,7 @@ def map_album(album_object: Union[dict, library.Album], with_songs=True) -> dict
 
         # These are only needed when part of a directory response
         'isDir': True,
-        'parent': subsonic_album['artistId'],
+        'parent': subsonic_album.get('artistId', 'm-0'),
 
         # Title field is required for Child responses (also used in albumList or albumList2 responses)
         'title': album_name,
@@ -153,30 +196,52 @@ def map_album(album_object: Union[dict, library.Album], with_songs=True) -> dict
     # - an AlbumID3WithSongs response
     # - a directory response (in which case the 'song' key needs to be renamed to 'child')
 
-    # Even if not including songs in the response, we still need to have their count and duration...
-    if not isinstance(album_object, library.Album):
-        # ...so in case album_object comes from a direct SQL transaction, we need to query once more
-        songs = list(flask.g.lib.items(f'album_id:{beets_album_id}'))
-    else:
-        # ...if it is a beets.library.Album object, we already have them
-        songs = list(album_object.items())
-
     if with_songs:
+        catalog = app.config.get('catalog')
+        if isinstance(album_object, library.Album):
+            # If it is a beets.library.Album object, we already have them
+            songs = list(album_object.items())
+        elif catalog is not None:
+            songs = catalog.album_songs(beets_album_id)
+        else:
+            # In case album_object comes from a direct SQL transaction, we need to query once more
+            with flask.g.lib.transaction() as tx:
+                songs = list(song_records(tx.query(songs_query("WHERE album_id = ?"), (beets_album_id,))))
         songs.sort(key=lambda s: s.track)  # Is it really necessary to sort them?
         subsonic_album['song'] = list(map(map_song, songs))
 
+        # Untyped flexible attributes come back as strings
+        songs_ratings = [float(s.get('stars_rating', 0)) for s in songs if float(s.get('stars_rating', 0) or 0)]
+        aggregates = (len(songs),
+                      sum(s.get('length', 0) for s in songs),
+                      sum(songs_ratings) / len(songs_ratings) if songs_ratings else 0)
+
+    elif aggregates is None:
+        # Even if not including songs in the response, we still need to have their count and duration
+        aggregates = album_aggregates([beets_album_id]).get(beets_album_id)
+
+    song_count, duration, average_rating = aggregates or (0, 0, 0)
+
     # Add remaining required fields
-    subsonic_album['duration'] = round(sum(s.get('length', 0) for s in songs))
-    subsonic_album['songCount'] = len(songs)
+    subsonic_album['duration'] = round(duration or 0)
+    subsonic_album['songCount'] = song_count
 
     # Optional field
-    songs_ratings = [s.get('stars_rating', 0) for s in subsonic_album.get('song', []) if s.get('stars_rating', 0)]
-    subsonic_album['averageRating'] = sum(songs_ratings) / len(songs_ratings) if songs_ratings else 0
+    subsonic_album['averageRating'] = average_rating or 0
 
     return subsonic_album
 
+def map_albums(albums: Iterable, with_songs=False) -> Iterator[dict]:
+    """ Lazily maps albums, page by page. When songs are not included, the aggregates of each page of albums
+    are fetched in a single query """
+    for page in batched(albums, ROWS_BATCH_SIZE):
+        aggregates = {} if with_songs else album_aggregates(album['id'] for album in page)
+        for album in page:
+            yield map_album(album, with_songs=with_songs, aggregates=aggregates.get(album['id'], (0, 0, 0)))
+
+
 def map_song(song_object):
-    song = dict(song_object)
+    song = as_mapping(song_object)
 
     subsonic_song = map_media(song)
 
@@ -184,6 +249,14 @@ def map_song(song_object):
     song_name = song.get('title', '')
     song_filepath = song.get('path', b'').decode('utf-8')
 
+    if app.config.get('stat_files', True):
+        file_size = file_stats.size(song_filepath)
+        file_exists = file_size is not None
+    else:
+        # Trust the library
+        file_size = None
+        file_exists = bool(song_filepath)
+
     album_id = beets_to_sub_album(song.get('album_id', 0))
 
     song_specific = {
@@ -195,7 +268,6 @@ def map_song(song_object):
         'coverArt': album_id or song_id,
 
         'track': song.get('track', 1),
-        'path': song_filepath if os.path.isfile(song_filepath) else '',
 
         'played': timestamp_to_iso(song.get('last_played', 0)),
         # 'starred': timestamp_to_iso(song.get('last_liked', 0)),
@@ -213,7 +285,7 @@ def map_song(song_object):
 
         # These are only needed when part of a directory response
         'isDir': False,
-        'parent': album_id or subsonic_song['artistId'],
+        'parent': album_id or subsonic_song.get('artistId', 'm-0'),
 
         # TODO - is there really no chance to have videos in beets' database?
         'isVideo': False,
@@ -234,16 +306,33 @@ def map_song(song_object):
     #         'albumPeak': song.get('rg_album_peak', 0)
     # }
 
+    if app.config.get('INCLUDE_PATHS', False):
+        subsonic_song['path'] = song_filepath if file_exists else ''
+
     # Add remaining filetype-related elements with fallbacks
-    subsonic_song['suffix'] = song.get('format').lower() or subsonic_song['path'].rsplit('.', 1)[-1].lower()
-    subsonic_song['size'] = os.path.getsize(subsonic_song['path']) or round(song.get('bitrate', 0) * song.get('length', 0) / 8)
-    subsonic_song['contentType'] = get_mimetype(subsonic_song.get('path', None) or subsonic_song.get('suffix', None))
+    subsonic_song['suffix'] = (song.get('format') or '').lower() or song_filepath.rsplit('.', 1)[-1].lower()
+    subsonic_song['size'] = file_size or round(song.get('bitrate', 0) * song.get('length', 0) / 8)
+    subsonic_song['contentType'] = get_mimetype(song_filepath if file_exists else subsonic_song['suffix'])
 
     return subsonic_song
 
 
-def map_artist(artist_name, with_albums=True):
-    subsonic_artist_id = beets_to_sub_artist(artist_name)
+def map_artist(artist, with_albums=True):
+    """ artist is either an album artist's name, or its entry in the artist index (which avoids any query) """
+
+    if isinstance(artist, str):
+        artist_name = artist
+        with flask.g.lib.transaction() as tx:
+            album_count, artist_mbid = tx.query(
+                "SELECT COUNT(*), MAX(mb_albumartistid) FROM albums WHERE albumartist = ?", (artist_name,)
+            )[0]
+    else:
+        artist_name, album_count, artist_mbid = artist.name, artist.album_count, artist.mbid
+
+    if isinstance(artist, str):
+        subsonic_artist_id = beets_to_sub_artist(artist_name) or ''
+    else:
+        subsonic_artist_id = f'{ART_ID_PREF}{artist.id}'
 
     subsonic_artist = {
         'id': subsonic_artist_id,
@@ -268,13 +357,23 @@ def map_artist(artist_name, with_albums=True):
     # if dz_data:
     #     subsonic_artist['artistImageUrl'] = dz_data.get('picture_big', '')
 
-    albums = list(flask.g.lib.albums(f'albumartist:{artist_name}'))
-    subsonic_artist['albumCount'] = len(albums)
-    if albums:
-        subsonic_artist['musicBrainzId'] = albums[0].get('mb_albumartistid', '')
+    subsonic_artist['albumCount'] = album_count
+    if album_count:
+        subsonic_artist['musicBrainzId'] = artist_mbid or ''
 
         if with_albums:
-            subsonic_artist['album'] = list(map(partial(map_album, with_songs=False), albums))
+            catalog = app.config.get('catalog')
+            if catalog is not None:
+                albums = catalog.artist_albums(artist_name)
+            elif not isinstance(artist, str):
+                # Primary key lookups only
+                albums = list(iter_rows('albums', artist.album_ids))
+            else:
+                with flask.g.lib.transaction() as tx:
+                    albums = list(album_records(
+                        tx.query(albums_query("WHERE albumartist = ? ORDER BY year, album"), (artist_name,))
+                    ))
+            subsonic_artist['album'] = list(map_albums(albums, with_songs=False))
 
     return subsonic_artist
 
@@ -295,64 +394,269 @@ def map_playlist(playlist):
     return subsonic_playlist
 
 
+# === Batched database access ===
+
+
+def query_ids(query: str, params: Iterable = ()) -> array:
+    """ Runs a query that selects IDs only, and returns them as a compact array """
+    with flask.g.lib.transaction() as tx:
+        return array('q', (row[0] for row in tx.query(query, params)))
+
+
+def album_aggregates(album_ids: Iterable[int]) -> dict:
+    """ Returns the (song count, duration, average rating) of several albums at once, keyed by album ID """
+
+    catalog = app.config.get('catalog')
+    if catalog is not None:
+        return catalog.album_aggregates(album_ids)
+
+    album_ids = list(album_ids)
+    aggregates = {}
+    for start in range(0, len(album_ids), ROWS_BATCH_SIZE):
+        batch = album_ids[start:start + ROWS_BATCH_SIZE]
+        placeholders = ', '.join('?' * len(batch))
+        with flask.g.lib.transaction() as tx:
+            rows = tx.query(f"""
+                SELECT items.album_id, COUNT(*), SUM(items.length), AVG(NULLIF(CAST(ratings.value AS REAL), 0))
+                  FROM items
+                  LEFT JOIN item_attributes AS ratings
+                    ON ratings.entity_id = items.id AND ratings.key = 'stars_rating'
+                 WHERE items.album_id IN ({placeholders})
+                 GROUP BY items.album_id
+            """, batch)
+        for album_id, song_count, duration, average_rating in rows:
+            aggregates[album_id] = (song_count, duration or 0, average_rating or 0)
+    return aggregates
+
+
+def iter_rows(table: str, ids: Iterable[int], batch_size: int = ROWS_BATCH_SIZE) -> Iterator:
+    """ Lazily yields the (projected) rows of the given table for the given IDs (in the same order).
+    Every batch is read in its own short transaction, so the library is never locked while streaming """
+
+    if table == 'items':
+        query, records = songs_query, song_records
+    elif table == 'albums':
+        query, records = albums_query, album_records
+    else:
+        raise ValueError(f'Unknown table: {table}')
+
+    ids = list(ids) if not isinstance(ids, (list, tuple, array)) else ids
+    for start in range(0, len(ids), batch_size):
+        batch = list(ids[start:start + batch_size])
+        placeholders = ', '.join('?' * len(batch))
+        with flask.g.lib.transaction() as tx:
+            rows = {row.id: row for row in records(tx.query(query(f"WHERE {table}.id IN ({placeholders})"), batch))}
+        for beets_id in batch:
+            row = rows.get(beets_id)
+            if row is not None:
+                yield row
+
+
 # === Core response-formatting functions ===
 
 
-def dict_to_xml(tag: str, data):
+def _xml_escape_text(text: str) -> str:
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def _xml_escape_attr(text: str) -> str:
+    text = _xml_escape_text(text)
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if '\n' in text:
+        text = text.replace('\n', '&#10;')
+    if '\r' in text:
+        text = text.replace('\r', '&#13;')
+    if '\t' in text:
+        text = text.replace('\t', '&#09;')
+    return text
+
+
+def _xml_value(val) -> str:
+    return str(val).lower() if isinstance(val, bool) else str(val)
+
+
+# Kinds of XML children
+_XML_TEXT, _XML_ELEM, _XML_LAZY = range(3)
+
+
+def _xml_split(tag: str, data, attrs: Union[dict, None] = None):
     """
-    Converts a json-like dict to an XML tree where every key/value pair
-    with a simple value is mapped as an attribute.... unless if adding the attribute
-    would create a duplicate, in which case a new element with that tag is created instead
+    Sorts the contents of a json-like value into the element's attributes and its children, where every
+    key/value pair with a simple value is mapped as an attribute.... unless if adding the attribute
+    would create a duplicate, in which case a new element with that tag is created instead.
+    Children are (tag, data, kind) tuples in document order, and children is None for simple values
     """
-    elem = ET.Element(tag)
+    attrib = dict(attrs) if attrs else {}
+    children = []
 
     if isinstance(data, dict):
         for key, val in data.items():
-            if not isinstance(val, (dict, list)):
+            if not isinstance(val, (dict, list, Iterator)):
                 # If the attribute already exists, create a child element
-                if key in elem.attrib:
-                    child = ET.Element(key)
-                    child.text = str(val).lower() if isinstance(val, bool) else str(val)
-                    elem.append(child)
+                if key in attrib:
+                    children.append((key, _xml_value(val), _XML_TEXT))
                 else:
-                    elem.set(key, str(val).lower() if isinstance(val, bool) else str(val))
+                    attrib[key] = _xml_value(val)
             elif isinstance(val, list):
                 for item in val:
                     # For each item in the list, process depending on type
                     if not isinstance(item, (dict, list)):
-                        if key in elem.attrib:
-                            child = ET.Element(key)
-                            child.text = str(item).lower() if isinstance(item, bool) else str(item)
-                            elem.append(child)
+                        if key in attrib:
+                            children.append((key, _xml_value(item), _XML_TEXT))
                         else:
-                            elem.set(key, str(item).lower() if isinstance(item, bool) else str(item))
+                            attrib[key] = _xml_value(item)
                     else:
-                        child = dict_to_xml(key, item)
-                        elem.append(child)
-            elif isinstance(val, dict):
-                child = dict_to_xml(key, val)
-                elem.append(child)
+                        children.append((key, item, _XML_ELEM))
+            elif isinstance(val, Iterator):
+                # Lazy iterables can't be looked ahead, so their items always become children
+                children.append((key, val, _XML_LAZY))
+            else:
+                children.append((key, val, _XML_ELEM))
 
     elif isinstance(data, list):
         # when data is a list, each item becomes a new child
         for item in data:
             if not isinstance(item, (dict, list)):
-                if tag in elem.attrib:
-                    child = ET.Element(tag)
-                    child.text = str(item).lower() if isinstance(item, bool) else str(item)
-                    elem.append(child)
+                if tag in attrib:
+                    children.append((tag, _xml_value(item), _XML_TEXT))
                 else:
-                    elem.set(tag, str(item).lower() if isinstance(item, bool) else str(item))
+                    attrib[tag] = _xml_value(item)
             else:
-                child = dict_to_xml(tag, item)
-                elem.append(child)
+                children.append((tag, item, _XML_ELEM))
     else:
-        elem.text = str(data).lower() if isinstance(data, bool) else str(data)
+        children = None
+
+    return attrib, children
+
+
+def _xml_start_tag(tag: str, attrib: dict, empty: bool = False) -> str:
+    attributes = ''.join(f' {key}="{_xml_escape_attr(val)}"' for key, val in attrib.items())
+    return f'<{tag}{attributes} />' if empty else f'<{tag}{attributes}>'
+
+
+def xml_element(tag: str, data, attrs: Union[dict, None] = None, indent: str = '', level: int = 0) -> str:
+    """ Serialises a json-like dict to an XML string in a single pass (see _xml_split for the mapping rules) """
+
+    attrib, children = _xml_split(tag, data, attrs)
+
+    if children is None:
+        # Simple value: it becomes the element's text
+        return f'{_xml_start_tag(tag, attrib)}{_xml_escape_text(_xml_value(data))}</{tag}>'
+    if not children:
+        return _xml_start_tag(tag, attrib, empty=True)
+
+    parts = [_xml_start_tag(tag, attrib)]
+    child_sep = f'\n{indent * (level + 1)}' if indent else ''
+    for child_tag, child_data, kind in children:
+        if kind == _XML_TEXT:
+            parts.append(f'{child_sep}<{child_tag}>{_xml_escape_text(child_data)}</{child_tag}>')
+        elif kind == _XML_ELEM:
+            parts.append(child_sep)
+            parts.append(xml_element(child_tag, child_data, indent=indent, level=level + 1))
+        else:
+            for item in child_data:
+                parts.append(child_sep)
+                parts.append(xml_element(child_tag, item, indent=indent, level=level + 1))
+    if indent:
+        parts.append(f'\n{indent * level}')
+    parts.append(f'</{tag}>')
+
+    return ''.join(parts)
+
+
+def iter_xml(tag: str, data, attrs: Union[dict, None] = None, indent: str = '', level: int = 0) -> Iterator[str]:
+    """ Same as xml_element, but yields the XML fragments as the lazy iterables in data get consumed """
+
+    attrib, children = _xml_split(tag, data, attrs)
+
+    if not children or not any(kind == _XML_LAZY or (kind == _XML_ELEM and _is_lazy(child_data))
+                               for _, child_data, kind in children):
+        # Nothing to stream in there
+        yield xml_element(tag, data, attrs=attrs, indent=indent, level=level)
+        return
+
+    yield _xml_start_tag(tag, attrib)
+    child_sep = f'\n{indent * (level + 1)}' if indent else ''
+    for child_tag, child_data, kind in children:
+        if kind == _XML_TEXT:
+            yield f'{child_sep}<{child_tag}>{_xml_escape_text(child_data)}</{child_tag}>'
+        elif kind == _XML_ELEM:
+            yield child_sep
+            yield from iter_xml(child_tag, child_data, indent=indent, level=level + 1)
+        else:
+            for item in child_data:
+                yield child_sep
+                yield from iter_xml(child_tag, item, indent=indent, level=level + 1)
+    if indent:
+        yield f'\n{indent * level}'
+    yield f'</{tag}>'
+
+
+def _is_lazy(data) -> bool:
+    """ Whether a json-like value contains any lazy iterable (which needs to be streamed) """
+    if isinstance(data, Iterator):
+        return True
+    if isinstance(data, dict):
+        return any(_is_lazy(v) for v in data.values() if isinstance(v, (dict, list, Iterator)))
+    if isinstance(data, list):
+        return any(_is_lazy(v) for v in data if isinstance(v, (dict, list, Iterator)))
+    return False
+
 
-    return elem
+def iter_json(data) -> Iterator[str]:
+    """ Yields the compact JSON serialisation of a json-like value, consuming its lazy iterables as it goes """
 
+    if not _is_lazy(data):
+        yield json.dumps(data, separators=(',', ':'))
+
+    elif isinstance(data, dict):
+        sep = '{'
+        for key, val in data.items():
+            yield f'{sep}{json.dumps(key)}:'
+            yield from iter_json(val)
+            sep = ','
+        yield '}' if sep == ',' else '{}'
+
+    else:
+        sep = '['
+        for item in data:
+            yield sep
+            yield from iter_json(item)
+            sep = ','
+        yield ']' if sep == ',' else '[]'
+
+
+def _chunked(fragments: Iterable[str], chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    """ Groups small text fragments into bigger encoded chunks, so we don't send one chunk per element """
+    buffer = []
+    buffered = 0
+    for fragment in fragments:
+        buffer.append(fragment)
+        buffered += len(fragment)
+        if buffered >= chunk_size:
+            yield ''.join(buffer).encode('UTF-8')
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer).encode('UTF-8')
+
+
+def jsonpify(format: str, data: dict, stream: bool = False):
+    if stream:
+        fragments = iter_json(data)
+        if format == 'jsonp':
+            callback = flask.request.values.get("callback")
+            fragments = (f for part in ([f"{callback}("], fragments, [");"]) for f in part)
+        return flask.Response(flask.stream_with_context(_chunked(fragments)),
+                              mimetype='application/javascript' if format == 'jsonp' else 'application/json')
 
-def jsonpify(format: str, data: dict):
     if format == 'jsonp':
         callback = flask.request.values.get("callback")
         return f"{callback}({json.dumps(data)});"
@@ -360,9 +664,34 @@ def jsonpify(format: str, data: dict):
         return flask.jsonify(data)
 
 
-def subsonic_response(data: dict = {}, resp_fmt: str = 'xml'):
+def xmlify(status: str, data: dict, stream: bool = False):
+    """ Serialises a json-like dict to a subsonic XML document (only pretty-printed in debug mode) """
+
+    root_attrs = {
+        'xmlns': 'http://subsonic.org/restapi',
+        'status': status,
+        'version': API_VERSION,
+        'type': 'BeetstreamNext',
+        'serverVersion': BEETSTREAMNEXT_VERSION,
+        'openSubsonic': 'true'
+    }
+    indent = '\t' if app.debug else ''
+    declaration = '<?xml version="1.0" encoding="UTF-8"?>\n'
+
+    if stream:
+        fragments = iter_xml('subsonic-response', data, attrs=root_attrs, indent=indent)
+        fragments = (f for part in ([declaration], fragments) for f in part)
+        return flask.Response(flask.stream_with_context(_chunked(fragments)), mimetype="text/xml")
+
+    body = xml_element('subsonic-response', data, attrs=root_attrs, indent=indent)
+    return flask.Response(f'{declaration}{body}'.encode('UTF-8'), mimetype="text/xml")
+
+
+def subsonic_response(data: dict = {}, resp_fmt: str = 'xml', stream: bool = False):
     """ Wrap any json-like dict with the subsonic response elements
-     and output the appropriate 'format' (json or xml) """
+     and output the appropriate 'format' (json or xml)
+     With stream=True, the lazy iterables (generators, map objects...) in data are only consumed
+     while the response is being sent, so large listings never need to be fully built in memory """
 
     if resp_fmt.startswith('json'):
         wrapped = {
@@ -375,22 +704,10 @@ def subsonic_response(data: dict = {}, resp_fmt: str = 'xml'):
                 **data
             }
         }
-        return jsonpify(resp_fmt, wrapped)
+        return jsonpify(resp_fmt, wrapped, stream=stream)
 
     else:
-        root = dict_to_xml("subsonic-response", data)
-        root.set("xmlns", "http://subsonic.org/restapi")
-        root.set("status", 'ok')
-        root.set("version", API_VERSION)
-        root.set("type", 'BeetstreamNext')
-        root.set("serverVersion", BEETSTREAM_VERSION)
-        root.set("openSubsonic", 'true')
-
-        xml_bytes = ET.tostring(root, encoding='UTF-8', method='xml', xml_declaration=True)
-        pretty_xml = minidom.parseString(xml_bytes).toprettyxml(encoding='UTF-8')
-        xml_str = pretty_xml.decode('UTF-8')
-
-        return flask.Response(xml_str, mimetype="text/xml")
+        return xmlify('ok', data, stream=stream)
 
 
 def subsonic_error(code: int = 0, message: str = '', resp_fmt: str = 'xml'):
@@ -432,24 +749,18 @@ def subsonic_error(code: int = 0, message: str = '', resp_fmt: str = 'xml'):
         return jsonpify(resp_fmt, wrapped)
 
     else:
-        root = dict_to_xml("subsonic-response", err_payload)
-        root.set("xmlns", "http://subsonic.org/restapi")
-        root.set("status", 'failed')
-        root.set("version", API_VERSION)
-        root.set("type", 'BeetstreamNext')
-        root.set("serverVersion", BEETSTREAMNEXT_VERSION)
-        root.set("openSubsonic", 'true')
-
-        xml_bytes = ET.tostring(root, encoding='UTF-8', method='xml', xml_declaration=True)
-        pretty_xml = minidom.parseString(xml_bytes).toprettyxml(encoding='UTF-8')
-        xml_str = pretty_xml.decode('UTF-8')
-
-        return flask.Response(xml_str, mimetype="text/xml")
+        return xmlify('failed', err_payload)
 
 
 # === Various other utility functions ===
 
 
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    """ Splits an iterable into lists of (at most) size elements """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
 def strip_accents(s):
     return ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
 
@@ -526,34 +837,30 @@ def creation_date(filepath):
                 return stat.st_mtime
 
 
-def query_musicbrainz(mbid: str, type: str):
+def query_musicbrainz(mbid: str, type: str, cache_only: bool = False):
 
     types_mb = {'track': 'recording', 'album': 'release', 'artist': 'artist'}
     endpoint = f'https://musicbrainz.org/ws/2/{types_mb[type]}/{mbid}'
 
-    headers = {'User-Agent': f'BeetstreamNext/{BEETSTREAMNEXT_VERSION} ( https://github.com/FlorentLM/BeetstreamNext )'}
     params = {'fmt': 'json'}
 
     if types_mb[type] == 'artist':
         params['inc'] = 'annotation'
 
-    response = requests.get(endpoint, headers=headers, params=params)
-    return response.json() if response.ok else {}
+    return metadata_cache().get(f'musicbrainz.{types_mb[type]}', mbid,
+                                lambda: http_client.fetch_json(endpoint, params=params), cache_only=cache_only)
 
 
-def query_deezer(query: str, type: str):
+def query_deezer(query: str, type: str, cache_only: bool = False):
 
     query_urlsafe = urllib.parse.quote_plus(query.replace(' ', '-'))
     endpoint = f'https://api.deezer.com/{type}/{query_urlsafe}'
 
-    headers = {'User-Agent': f'BeetstreamNext/{BEETSTREAMNEXT_VERSION} ( https://github.com/FlorentLM/BeetstreamNext )'}
-
-    response = requests.get(endpoint, headers=headers)
+    return metadata_cache().get(f'deezer.{type}', query_urlsafe.casefold(), lambda: http_client.fetch_json(endpoint),
+                                cache_only=cache_only)
 
-    return response.json() if response.ok else {}
 
-
-def query_lastfm(query: str, type: str, method: str = 'info', mbid=True):
+def query_lastfm(query: str, type: str, method: str = 'info', mbid=True, cache_only: bool = False):
     if not app.config['lastfm_api_key']:
         return {}
 
@@ -571,11 +878,16 @@ def query_lastfm(query: str, type: str, method: str = 'info', mbid=True):
     elif query_lastfm and type != 'user':
         params[type] = query_lastfm
 
+    def fetch():
+        data = http_client.fetch_json(endpoint, params=params)
+        # Last.fm's temporary errors (operation failed, service offline, temporarily unavailable, rate limited)
+        # are not "not found" answers, and must not be cached
+        if data and data.get('error') in LASTFM_TEMPORARY_ERRORS:
+            return None
+        return data
 
-    headers = {'User-Agent': f'BeetstreamNext/{BEETSTREAMNEXT_VERSION} ( https://github.com/FlorentLM/BeetstreamNext )'}
-    response = requests.get(endpoint, headers=headers, params=params)
-
-    return response.json() if response.ok else {}
+    kind = f'lastfm.{type}.{method.lower()}'
+    return metadata_cache().get(kind, f"{'mbid' if mbid else 'name'}:{query.casefold()}", fetch, cache_only=cache_only)
 
 
 def trim_text(text, char_limit=300):
@@ -0,0 +1,52 @@
+import pytest
+from beets.library import Item, Library
+
+from beetsplug.beetstreamnext import app, cache
+
+GENRES = ['Rock', 'Krautrock', 'Jazz; Post Rock', 'Electronic, Ambient', 'Hip Hop']
+
+
+def build_library(path) -> Library:
+    """ 20 albums of 8 songs, by 7 artists, with one of GENRES each (in turn) """
+    lib = Library(str(path / 'library.db'), str(path / 'music'))
+    for a in range(20):
+        items = [
+            Item(title=f'Song {a}-{t}', artist=f'Artist {a % 7}', albumartist=f'Artist {a % 7}',
+                 album=f'Album {a}', track=t + 1, length=200.5 + t, bitrate=320000, format='MP3',
+                 genre=GENRES[a % len(GENRES)], year=1990 + a, mb_artistid=f'mbid-{a % 7}',
+                 path=str(path / 'music' / str(a) / f'{t}.mp3').encode(), added=1700000000 + a)
+            for t in range(8)
+        ]
+        lib.add_album(items)
+    return lib
+
+
+@pytest.fixture(scope='session')
+def library(tmp_path_factory):
+    path = tmp_path_factory.mktemp('beets')
+    lib = build_library(path)
+    app.config.update(
+        lib=lib, lastfm_api_key='', local_similarity=True, fetch_artists_images=False, save_artists_images=False,
+        root_directory=path / 'music', users_storage=path / 'users.bin', artists_db=path / 'artists.db',
+        search_index=path / 'search.db', metadata_cache=path / 'metadata.db', thumbnail_cache=path / 'thumbnails',
+        image_processes=0, INCLUDE_PATHS=False, never_transcode=False, playlist_dirs={}, catalog=None,
+        enrichment_worker=None,
+    )
+    return lib
+
+
+@pytest.fixture
+def client(library, monkeypatch):
+    # Notice changes to the library right away
+    monkeypatch.setattr(cache._library_state, 'check_interval', 0)
+    return app.test_client()
+
+
+@pytest.fixture
+def api(client):
+    def get(endpoint: str, **params) -> dict:
+        """ The JSON payload of an endpoint (without the 'subsonic-response' wrapper) """
+        response = client.get(f'/rest/{endpoint}', query_string={'f': 'json', **params})
+        assert response.status_code == 200
+        return response.get_json()['subsonic-response']
+    return get
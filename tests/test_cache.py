@@ -0,0 +1,55 @@
+from beets.library import Item
+
+from beetsplug.beetstreamnext.cache import ResponseCache, get_response_cache
+
+
+def genre_names(payload: dict) -> set:
+    return {genre['value'] for genre in payload['genres']['genre']}
+
+
+def test_responses_are_cached(api):
+    first = api('getGenres')
+    cache = get_response_cache()
+    entries = len(cache)
+    assert entries > 0
+    # Same request (whatever the client and credentials): served from the cache
+    assert api('getGenres', u='someone', c='other client') == first
+    assert len(cache) == entries
+    # Other parameters: another entry
+    api('getGenres', unused='1')
+    assert len(cache) == entries + 1
+
+
+def test_cache_is_bypassed_after_a_library_change(api, library):
+    assert 'Zydeco' not in genre_names(api('getGenres'))
+
+    item = Item(title='New song', artist='New artist', album='', genre='Zydeco', path=b'/new.mp3')
+    library.add(item)
+    try:
+        assert 'Zydeco' in genre_names(api('getGenres'))
+    finally:
+        item.remove()
+    assert 'Zydeco' not in genre_names(api('getGenres'))
+
+
+def test_stale_generations_are_dropped():
+    cache = ResponseCache(max_bytes=1024)
+    cache.put(('a',), 1, b'body', 'application/json')
+    assert cache.get(('a',), 1) == (b'body', 'application/json')
+    assert cache.get(('a',), 2) is None
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_cache_size_is_bounded():
+    cache = ResponseCache(max_bytes=10)
+    cache.put(('a',), 1, b'12345', 'text/xml')
+    cache.put(('b',), 1, b'12345', 'text/xml')
+    cache.get(('a',), 1)
+    # Evicts the least recently used entry
+    cache.put(('c',), 1, b'12345', 'text/xml')
+    assert cache.get(('b',), 1) is None
+    assert cache.get(('a',), 1) is not None and cache.get(('c',), 1) is not None
+    # Too big to be cached at all
+    cache.put(('d',), 1, b'x' * 11, 'text/xml')
+    assert cache.get(('d',), 1) is None
+    assert cache.size == 10
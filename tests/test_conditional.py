@@ -0,0 +1,52 @@
+from beets.library import Item
+
+
+def test_not_modified_on_matching_etag(client):
+    response = client.get('/rest/getGenres?f=json')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert response.headers['Last-Modified']
+
+    response = client.get('/rest/getGenres?f=json', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+
+    # Another request (the format is part of it) has another ETag
+    response = client.get('/rest/getGenres?f=xml', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_not_modified_since(client):
+    last_modified = client.get('/rest/getGenres?f=json').headers['Last-Modified']
+    response = client.get('/rest/getGenres?f=json', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 304
+    response = client.get('/rest/getGenres?f=json', headers={'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'})
+    assert response.status_code == 200
+
+
+def test_etag_changes_with_the_library(client, library):
+    etag = client.get('/rest/getGenres?f=json').headers['ETag']
+    item = Item(title='New song', artist='New artist', album='', genre='Zydeco', path=b'/new.mp3')
+    library.add(item)
+    try:
+        response = client.get('/rest/getGenres?f=json', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+    finally:
+        item.remove()
+
+
+def test_get_indexes_if_modified_since(api):
+    indexes = api('getIndexes')['indexes']
+    assert indexes['index']
+    last_modified = indexes['lastModified']
+
+    # Nothing changed since then: no artists
+    indexes = api('getIndexes', ifModifiedSince=last_modified)['indexes']
+    assert indexes['lastModified'] == last_modified
+    assert 'index' not in indexes
+
+    indexes = api('getIndexes', ifModifiedSince=last_modified - 1000)['indexes']
+    assert indexes['index']
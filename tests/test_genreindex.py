@@ -0,0 +1,58 @@
+from beets.library import Item
+
+from beetsplug.beetstreamnext.genreindex import genre_key, genre_index
+
+
+def test_genre_keys():
+    assert genre_key('rock') == genre_key('Rock') == genre_key(' ROCK ')
+    assert genre_key('Post Rock') == genre_key('post-rock')
+    assert genre_key('Rock') != genre_key('Krautrock')
+
+
+def test_get_genres(api):
+    genres = {genre['value']: (genre['songCount'], genre['albumCount'])
+              for genre in api('getGenres')['genres']['genre']}
+    # Multi-genre fields are split, and names are normalised
+    assert genres['Rock'] == genres['Krautrock'] == genres['Jazz'] == genres['Post-Rock'] == (32, 4)
+    assert 'Jazz; Post Rock' not in genres
+
+
+def test_exact_genre_match(api):
+    songs = api('getSongsByGenre', genre='rock', count=500)['songsByGenre']['song']
+    assert len(songs) == 32
+    # Not "Krautrock" or "Post Rock"
+    assert {song['genre'] for song in songs} == {'Rock'}
+
+    albums = api('getAlbumList2', type='byGenre', genre='Post Rock', size=500)['albumList2']['album']
+    assert len(albums) == 4
+    assert {album['genre'] for album in albums} == {'Jazz; Post Rock'}
+
+
+def test_songs_by_title(api):
+    songs = api('getSongsByGenre', genre='Jazz', count=500)['songsByGenre']['song']
+    assert [song['title'] for song in songs] == sorted(song['title'] for song in songs)
+
+
+def test_cursor_after_a_removed_song(api, library):
+    everything = [song['id'] for song in api('getSongsByGenre', genre='Rock', count=500)['songsByGenre']['song']]
+
+    item = Item(title='Song 0-4b', artist='Artist 0', album='', genre='Rock', path=b'/new.mp3')
+    library.add(item)
+    listing = api('getSongsByGenre', genre='Rock', count=6)['songsByGenre']
+    assert listing['song'][-1]['title'] == 'Song 0-4b'
+
+    # The page after it is the same, whether or not it still exists
+    item.remove()
+    listing = api('getSongsByGenre', genre='Rock', count=6, cursor=listing['nextCursor'])['songsByGenre']
+    assert [song['id'] for song in listing['song']] == everything[5:11]
+
+
+def test_song_ids_after_a_sort_key(library):
+    index = genre_index(library)
+    everything = list(index.all_song_ids('Rock'))
+    titles = [library.get_item(song_id).title for song_id in everything]
+    assert list(index.song_ids('Rock', 3, after=(titles[4], everything[4]))) == everything[5:8]
+    # Between two songs
+    assert list(index.song_ids('Rock', 3, after=(titles[4] + ' ', 0))) == everything[5:8]
+    assert list(index.song_ids('Rock', 3, after=('', 0))) == everything[:3]
+    assert list(index.song_ids('Rock', 3, after=('zzz', 0))) == []
@@ -0,0 +1,151 @@
+import socket
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from beetsplug.beetstreamnext.httpclient import HttpClient, RateLimiter
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real services
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: bytes = b'{}', headers: dict = None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.hits[self.path] += 1
+            hits = server.hits[self.path]
+            server.clients.add(self.client_address)
+
+        if self.path == '/ok':
+            self._send(200, b'{"ok": true}')
+        elif self.path == '/flaky':
+            # Fails twice, then works
+            self._send(503) if hits <= 2 else self._send(200, b'{"ok": true}')
+        elif self.path == '/throttled':
+            self._send(429, headers={'Retry-After': '0'}) if hits == 1 else self._send(200, b'{"ok": true}')
+        elif self.path == '/down':
+            self._send(500)
+        elif self.path == '/slow':
+            time.sleep(1)
+            self._send(200)
+        else:
+            self._send(404)
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.hits = defaultdict(int)
+    server.clients = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server, path: str) -> str:
+    return f'http://127.0.0.1:{server.server_address[1]}{path}'
+
+
+def test_retries_server_errors(stub):
+    client = HttpClient(retries=2, backoff=0)
+    assert client.fetch_json(url(stub, '/flaky')) == {'ok': True}
+    assert stub.hits['/flaky'] == 3
+
+
+def test_retries_throttled_requests(stub):
+    client = HttpClient(retries=2, backoff=0)
+    assert client.fetch_json(url(stub, '/throttled')) == {'ok': True}
+    assert stub.hits['/throttled'] == 2
+
+
+def test_gives_up_after_the_retries(stub):
+    client = HttpClient(retries=2, backoff=0)
+    # Failures mean "unreachable" (None), not "not found" (an empty dict)
+    assert client.fetch_json(url(stub, '/down')) is None
+    assert stub.hits['/down'] == 3
+    assert client.fetch_json(url(stub, '/missing')) == {}
+    assert stub.hits['/missing'] == 1
+
+
+def test_read_timeout(stub):
+    client = HttpClient(timeout=(1, 0.2), retries=2, backoff=0)
+    start = time.monotonic()
+    assert client.get(url(stub, '/slow')) is None
+    # Reads that time out are only retried once
+    assert stub.hits['/slow'] == 2
+    assert time.monotonic() - start < 1.5
+
+
+def test_connect_timeout():
+    # A server that never accepts: once its backlog is full, new connections hang
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(0)
+    port = listener.getsockname()[1]
+    fillers = []
+    try:
+        for _ in range(8):
+            filler = socket.socket()
+            filler.setblocking(False)
+            filler.connect_ex(('127.0.0.1', port))
+            fillers.append(filler)
+
+        client = HttpClient(timeout=(0.2, 5), retries=0)
+        start = time.monotonic()
+        assert client.get(f'http://127.0.0.1:{port}/') is None
+        assert time.monotonic() - start < 2
+    finally:
+        for filler in fillers:
+            filler.close()
+        listener.close()
+
+
+def test_rate_limiter_spacing():
+    limiter = RateLimiter(rate=20)
+    times = []
+    for _ in range(5):
+        assert limiter.acquire(max_wait=1)
+        times.append(time.monotonic())
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    assert min(gaps) >= 0.04
+
+    # Callers that would have to wait longer than they can are turned away
+    limiter = RateLimiter(rate=1)
+    assert limiter.acquire(max_wait=0)
+    assert not limiter.acquire(max_wait=0.1)
+
+
+def test_rate_limits_per_host(stub):
+    client = HttpClient(rate_limits={'127.0.0.1': 10})
+    start = time.monotonic()
+    for _ in range(4):
+        assert client.get(url(stub, '/ok')).ok
+    assert time.monotonic() - start >= 0.25
+
+
+def test_connections_are_reused(stub):
+    client = HttpClient()
+    for _ in range(5):
+        assert client.get_json(url(stub, '/ok')) == {'ok': True}
+    # All the requests came from the same (kept alive) connection
+    assert stub.hits['/ok'] == 5
+    assert len(stub.clients) == 1
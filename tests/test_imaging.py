@@ -0,0 +1,78 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from beetsplug.beetstreamnext import coverart, imaging
+from beetsplug.beetstreamnext.imaging import ImagePool, ImagePoolBusy, resize_image
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / 'cover.png'
+    Image.new('RGB', (800, 600), 'green').save(path)
+    return path
+
+
+@pytest.fixture
+def pool():
+    pool = ImagePool(processes=1, max_queued=0, timeout=30)
+    yield pool
+    pool._executor.shutdown(cancel_futures=True)
+
+
+@pytest.fixture
+def full_pool(pool, monkeypatch):
+    # Every slot taken
+    pool._slots.acquire()
+    monkeypatch.setattr(imaging, '_image_pool', pool)
+    yield pool
+    pool._slots.release()
+
+
+def test_resize_image(image_path):
+    with Image.open(resize_image(image_path, 100)) as img:
+        assert img.format == 'JPEG'
+        assert img.size == (100, 75)
+
+
+def test_resize_in_the_pool(pool, image_path):
+    data, resize_ms = pool.resize(str(image_path), 100, 'jpeg')
+    assert resize_ms > 0
+    with Image.open(BytesIO(data)) as img:
+        assert img.size == (100, 75)
+
+
+def test_full_pool_is_busy(full_pool, image_path):
+    with pytest.raises(ImagePoolBusy) as e:
+        full_pool.resize(str(image_path), 100)
+    assert e.value.retry_after == 30
+
+
+def test_busy_pool_serves_the_original(client, library, full_pool, image_path):
+    album = library.get_album(2)
+    album.artpath = str(image_path).encode()
+    album.store()
+    try:
+        response = client.get('/rest/getCoverArt?id=al-2&size=77')
+        assert response.status_code == 200
+        assert response.mimetype == 'image/png'
+    finally:
+        album.artpath = None
+        album.store()
+
+
+def test_busy_pool_without_a_fallback_is_a_503(client, library, full_pool, image_path, monkeypatch):
+    monkeypatch.setattr(coverart, 'have_ffmpeg', True)
+    monkeypatch.setattr(coverart, 'extract_cover', lambda path: BytesIO(image_path.read_bytes()))
+    item = library.get_item(9)
+    album_id = item.album_id
+    item.album_id = None
+    item.store()
+    try:
+        response = client.get(f'/rest/getCoverArt?id=sg-{item.id}&size=77')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '30'
+    finally:
+        item.album_id = album_id
+        item.store()
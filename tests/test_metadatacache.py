@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+from beetsplug.beetstreamnext.metadatacache import MetadataCache
+
+
+class Fetcher:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return MetadataCache(tmp_path / 'metadata.db')
+
+
+def expire(cache: MetadataCache, key: str, stale: bool) -> None:
+    """ Makes an entry expired (and past its stale period if stale) """
+    now = time.time()
+    with cache._conn:
+        cache._conn.execute("UPDATE responses SET expires = ?, stale_until = ? WHERE key = ?",
+                            (now - 10, now - 5 if stale else now + 100, key))
+
+
+def test_responses_are_cached(cache):
+    fetch = Fetcher({'artist': 'A'})
+    assert cache.get('lastfm.artist.info', 'a', fetch) == {'artist': 'A'}
+    assert cache.get('lastfm.artist.info', 'a', fetch) == {'artist': 'A'}
+    assert fetch.calls == 1
+    # Persistent
+    assert MetadataCache(cache.path).get('lastfm.artist.info', 'a', fetch, cache_only=True) == {'artist': 'A'}
+    assert cache.get('lastfm.artist.info', 'b', fetch, cache_only=True) is None
+
+
+def test_not_found_is_cached(cache):
+    fetch = Fetcher({'error': 6, 'message': 'Not found'})
+    assert cache.get('lastfm.artist.info', 'a', fetch) == {}
+    assert cache.get('lastfm.artist.info', 'a', fetch) == {}
+    assert fetch.calls == 1
+
+
+def test_unreachable_is_not_cached(cache):
+    fetch = Fetcher(None, {'artist': 'A'})
+    assert cache.get('deezer.artist', 'a', fetch) == {}
+    assert cache.get('deezer.artist', 'a', fetch) == {'artist': 'A'}
+    assert fetch.calls == 2
+
+
+def test_stale_while_revalidate(cache):
+    fetch = Fetcher({'v': 1}, {'v': 2})
+    cache.get('musicbrainz', 'a', fetch)
+    expire(cache, 'musicbrainz:a', stale=False)
+
+    # Served at once, and refreshed in the background
+    assert cache.get('musicbrainz', 'a', fetch) == {'v': 1}
+    for _ in range(100):
+        if fetch.calls == 2 and not cache._refreshing:
+            break
+        time.sleep(0.01)
+    assert cache.get('musicbrainz', 'a', fetch) == {'v': 2}
+
+
+def test_expired_entries_are_fetched_again(cache):
+    fetch = Fetcher({'v': 1}, None, {'v': 3})
+    cache.get('musicbrainz', 'a', fetch)
+    expire(cache, 'musicbrainz:a', stale=True)
+    # Unreachable: the outdated answer is still better than nothing
+    assert cache.get('musicbrainz', 'a', fetch) == {'v': 1}
+    assert cache.get('musicbrainz', 'a', fetch) == {'v': 3}
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = MetadataCache(tmp_path / 'metadata.db', max_size=1000)
+    for i in range(10):
+        cache.get('lastfm.artist.info', str(i), lambda: {'bio': 'x' * 180})
+        with cache._conn:
+            # Older entries were used less recently
+            cache._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (i, f'lastfm.artist.info:{i}'))
+    assert cache.size <= 1000
+    assert cache.get('lastfm.artist.info', '9', lambda: None, cache_only=True) is not None
+    assert cache.get('lastfm.artist.info', '0', lambda: None, cache_only=True) is None
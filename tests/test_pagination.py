@@ -0,0 +1,67 @@
+from beets.library import Item
+
+from beetsplug.beetstreamnext.pagination import decode_cursor, encode_cursor
+
+
+def album_pages(api, size: int, **params) -> list:
+    """ All the pages of alphabeticalByName, following the cursors """
+    pages = []
+    cursor = None
+    while True:
+        extra = {'cursor': cursor} if cursor else {}
+        listing = api('getAlbumList2', type='alphabeticalByName', size=size, **params, **extra)['albumList2']
+        pages.append([album['id'] for album in listing.get('album', [])])
+        cursor = listing.get('nextCursor')
+        if not cursor:
+            return pages
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(('Title', 12))) == ('Title', 12)
+    assert decode_cursor('not a cursor') is None
+
+
+def test_cursor_pages_neither_overlap_nor_skip(api):
+    everything = [album['id'] for album in
+                  api('getAlbumList2', type='alphabeticalByName', size=500)['albumList2']['album']]
+    assert len(everything) == 20
+
+    pages = album_pages(api, 3)
+    assert all(len(page) == 3 for page in pages[:-1])
+    assert sum(pages, []) == everything
+
+
+def test_offsets_match_cursors(api):
+    pages = album_pages(api, 4)
+    for number, page in enumerate(pages):
+        listing = api('getAlbumList2', type='alphabeticalByName', size=4, offset=4 * number)['albumList2']
+        assert [album['id'] for album in listing['album']] == page
+
+
+def test_pages_are_stable_when_the_library_changes(api, library):
+    first = api('getAlbumList2', type='alphabeticalByName', size=5)['albumList2']
+    cursor = first['nextCursor']
+    second = api('getAlbumList2', type='alphabeticalByName', size=5, cursor=cursor)['albumList2']
+
+    # An album that sorts before the end of the first page: the next page must not change
+    album = library.add_album([Item(title='New song', album='AAA', albumartist='New artist', path=b'/new.mp3')])
+    try:
+        again = api('getAlbumList2', type='alphabeticalByName', size=5, cursor=cursor)['albumList2']
+        assert [a['id'] for a in again['album']] == [a['id'] for a in second['album']]
+    finally:
+        album.remove()
+
+
+def test_search_cursors(api):
+    found = api('search3', query='song', songCount=500, albumCount=0, artistCount=0)['searchResult3']['song']
+    songs = []
+    cursor = None
+    while True:
+        extra = {'songCursor': cursor} if cursor else {}
+        result = api('search3', query='song', songCount=50, albumCount=0, artistCount=0, **extra)['searchResult3']
+        songs += [song['id'] for song in result['song']]
+        cursor = result.get('songNextCursor')
+        if not cursor:
+            break
+    assert songs == [song['id'] for song in found]
+    assert len(set(songs)) == len(songs) == 160
@@ -0,0 +1,42 @@
+from array import array
+
+from beetsplug.beetstreamnext.sampler import _Shuffle
+
+
+def test_shuffle_has_no_repeats_until_the_pool_is_exhausted():
+    pool = array('q', range(100))
+    shuffle = _Shuffle(pool)
+    drawn = [i for _ in range(15) for i in shuffle.draw(7)][:100]
+    assert sorted(drawn) == list(pool)
+    # The pool itself is shared, and never modified
+    assert pool == array('q', range(100))
+
+
+def test_shuffle_starts_over_without_repeats_in_a_batch():
+    shuffle = _Shuffle(array('q', range(10)))
+    shuffle.draw(8)
+    batch = shuffle.draw(6)
+    assert len(set(batch)) == 6
+    # A batch bigger than the pool is the whole pool
+    assert sorted(shuffle.draw(50)) == list(range(10))
+
+
+def test_random_songs_per_session(api):
+    seen = []
+    for _ in range(16):
+        seen += [song['id'] for song in api('getRandomSongs', size=10, u='alice', c='sampler')['randomSongs']['song']]
+    assert len(seen) == 160
+    assert len(set(seen)) == 160
+
+
+def test_random_songs_filters(api):
+    songs = api('getRandomSongs', size=500, genre='rock', fromYear=1994, toYear=2009)['randomSongs']['song']
+    # 'Rock' albums are 0, 5, 10 and 15 (years 1990 + album): not 'Krautrock' or 'Post Rock'
+    assert {song['year'] for song in songs} == {1995, 2000, 2005}
+    assert {song['genre'] for song in songs} == {'Rock'}
+    assert len(songs) == 24
+
+
+def test_random_albums(api):
+    albums = api('getAlbumList2', type='random', size=500, fromYear=2005, toYear=2000)['albumList2']['album']
+    assert sorted(album['year'] for album in albums) == list(range(2000, 2006))
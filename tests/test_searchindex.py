@@ -0,0 +1,70 @@
+import pytest
+from beets.library import Item, Library
+
+from beetsplug.beetstreamnext import cache
+from beetsplug.beetstreamnext.searchindex import SearchIndex
+
+
+@pytest.fixture
+def lib(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache._library_state, 'check_interval', 0)
+    lib = Library(str(tmp_path / 'library.db'), str(tmp_path / 'music'))
+    for title, artist, genre in [
+        ('Halo', 'Beyoncé', 'Pop'),
+        ('Crazy in Love', 'Beyoncé', 'Pop'),
+        ('Love Song', 'The Cure', 'Rock'),
+        ('Song for Love', 'Someone', 'Love Rock'),
+        ('Charlie', 'Same', 'Tie'),
+        ('Alpha', 'Same', 'Tie'),
+        ('Bravo', 'Same', 'Tie'),
+        ('Alpha', 'Same', 'Tie'),
+    ]:
+        lib.add(Item(title=title, artist=artist, album='', genre=genre, path=f'/{title}.mp3'.encode()))
+    return lib
+
+
+@pytest.fixture
+def index(lib):
+    return SearchIndex(':memory:').refresh(lib)
+
+
+def titles(lib, ids) -> list:
+    return [lib.get_item(i).title for i in ids]
+
+
+def test_prefix_and_folding(lib, index):
+    assert titles(lib, index.search_songs('hal', 10)) == ['Halo']
+    assert set(titles(lib, index.search_songs('BEYONCE', 10))) == {'Crazy in Love', 'Halo'}
+    # Every word must match
+    assert titles(lib, index.search_songs('beyonce love', 10)) == ['Crazy in Love']
+    assert list(index.search_songs('nothing', 10)) == []
+    assert list(index.search_songs('!!', 10)) == []
+
+
+def test_results_by_relevance(lib, index):
+    # Matches in the title come before matches in the genre only
+    found = titles(lib, index.search_songs('rock', 10))
+    assert found == ['Love Song', 'Song for Love']
+    found = titles(lib, index.search_songs('love', 10))
+    assert found[-1] == 'Song for Love'
+
+
+def test_equal_scores_by_name_then_id(lib, index):
+    ids = index.search_songs('same', 10)
+    assert titles(lib, ids) == ['Alpha', 'Alpha', 'Bravo', 'Charlie']
+    assert ids[0] < ids[1]
+    # Pages of the same listing don't overlap
+    assert list(index.search_songs('same', 2)) + list(index.search_songs('same', 2, offset=2)) == list(ids)
+
+
+def test_index_follows_the_library(lib, index):
+    item = lib.get_item(index.search_songs('halo', 1)[0])
+    item.title = 'Single Ladies'
+    item.store()
+    index.refresh(lib)
+    assert list(index.search_songs('halo', 10)) == []
+    assert list(index.search_songs('ladies', 10)) == [item.id]
+
+    item.remove()
+    index.refresh(lib)
+    assert list(index.search_songs('ladies', 10)) == []
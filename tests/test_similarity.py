@@ -0,0 +1,73 @@
+import pytest
+from beets.library import Item, Library
+
+from beetsplug.beetstreamnext import cache
+from beetsplug.beetstreamnext.similarity import SimilarityEngine
+
+pytest.importorskip('numpy')
+
+
+@pytest.fixture
+def lib(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache._library_state, 'check_interval', 0)
+    lib = Library(str(tmp_path / 'library.db'), str(tmp_path / 'music'))
+    for artist, genre, year, bpm in [
+        ('Rock One', 'Rock', 1990, 140),
+        ('Rock Two', 'Rock; Hard Rock', 1992, 135),
+        ('Jazz One', 'Jazz', 1960, 90),
+        ('Jazz Two', 'Jazz; Bebop', 1962, 95),
+    ]:
+        lib.add_album([
+            Item(title=f'{artist} {t}', artist=artist, albumartist=artist, album=artist, genre=genre, year=year,
+                 bpm=bpm, length=200 + t, path=f'/{artist}/{t}.mp3'.encode())
+            for t in range(4)
+        ])
+    return lib
+
+
+@pytest.fixture
+def engine(lib):
+    return SimilarityEngine().refresh(lib, wait=True)
+
+
+def artists_of(lib, song_ids) -> list:
+    return [lib.get_item(i).albumartist for i in song_ids]
+
+
+def test_similar_songs(lib, engine):
+    song = lib.items('artist:"Rock One"').get()
+    similar = engine.similar_to_songs([song.id], 7)
+    assert song.id not in similar
+    # The rest of the album, then the other rock album
+    assert artists_of(lib, similar) == ['Rock One'] * 3 + ['Rock Two'] * 4
+
+
+def test_similar_to_album(lib, engine):
+    album = lib.albums('album:"Jazz Two"').get()
+    similar = engine.similar_to_album(album.id, 4)
+    assert artists_of(lib, similar) == ['Jazz One'] * 4
+
+
+def test_similar_artists(engine):
+    assert engine.similar_artists('Rock One', 1) == ['Rock Two']
+    assert engine.similar_artists('jazz one', 1) == ['Jazz Two']
+    assert engine.similar_artists('Nobody', 3) == []
+
+
+def test_follows_library_changes(lib, engine):
+    rock = lib.items('artist:"Rock One"').get()
+    item = Item(title='New', artist='Rock One', albumartist='Rock One', genre='Rock', year=1990, bpm=140,
+                length=200, path=b'/new.mp3')
+    lib.add(item)
+
+    engine.refresh(lib, wait=True)
+    assert item.id in engine.similar_to_songs([rock.id], 4)
+
+    # A changed song gets a new vector
+    jazz = lib.items('artist:"Jazz Two"').get()
+    before = engine.similar_to_songs([jazz.id], 1)
+    jazz.update({'genre': 'Rock', 'year': 1990, 'bpm': 140, 'artist': 'Rock One', 'albumartist': 'Rock One'})
+    jazz.store()
+    engine.refresh(lib, wait=True)
+    assert engine.similar_to_songs([jazz.id], 1) != before
+    assert artists_of(lib, engine.similar_to_songs([jazz.id], 1)) == ['Rock One']
@@ -0,0 +1,75 @@
+import threading
+import time
+
+import pytest
+
+from beetsplug.beetstreamnext.singleflight import SingleFlight
+
+
+def run_concurrently(fn, count: int) -> list:
+    results = [None] * count
+
+    def run(i):
+        try:
+            results[i] = fn()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_calls_are_coalesced():
+    flight = SingleFlight()
+    calls = []
+
+    def work():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'result'
+
+    results = run_concurrently(lambda: flight.do(('cover', 1, 64), work), 8)
+    assert results == ['result'] * 8
+    assert len(calls) == 1
+
+    # Once done, the next call does the work again
+    assert flight.do(('cover', 1, 64), work) == 'result'
+    assert len(calls) == 2
+
+
+def test_different_keys_are_not_coalesced():
+    flight = SingleFlight()
+    calls = []
+
+    def work(size):
+        calls.append(size)
+        time.sleep(0.1)
+        return size
+
+    results = run_concurrently(lambda: flight.do(('cover', 1, 64), lambda: work(64)), 4)
+    results += run_concurrently(lambda: flight.do(('cover', 1, 128), lambda: work(128)), 4)
+    assert results == [64] * 4 + [128] * 4
+    assert calls == [64, 128]
+
+
+def test_errors_are_shared():
+    flight = SingleFlight()
+    calls = []
+
+    def work():
+        calls.append(1)
+        time.sleep(0.2)
+        raise ValueError('failed')
+
+    results = run_concurrently(lambda: flight.do(('lookup', 'a'), work), 4)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(calls) == 1
+
+    # Not remembered
+    with pytest.raises(ValueError):
+        flight.do(('lookup', 'a'), work)
+    assert len(calls) == 2
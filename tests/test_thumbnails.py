@@ -0,0 +1,111 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from beetsplug.beetstreamnext import coverart
+from beetsplug.beetstreamnext.thumbnails import ThumbnailCache, thumbnail_cache
+
+
+def test_eviction_respects_the_byte_budget(tmp_path):
+    cache = ThumbnailCache(tmp_path, max_size=1000)
+    for name in ('aa1', 'bb2', 'cc3'):
+        cache.put(name, b'x' * 400)
+    assert cache.size <= 1000
+    assert 'aa1' not in cache
+    assert len(list(tmp_path.glob('*/*'))) == 2
+
+    # Using a thumbnail makes it the most recent one
+    assert cache.get('bb2') is not None
+    cache.put('dd4', b'x' * 400)
+    assert 'bb2' in cache and 'cc3' not in cache
+    assert cache.size == 800
+
+
+def test_thumbnails_are_kept_across_restarts(tmp_path):
+    cache = ThumbnailCache(tmp_path)
+    cache.put('aa1', b'image')
+    (tmp_path / 'aa' / 'aa2.tmp').write_bytes(b'half written')
+
+    cache = ThumbnailCache(tmp_path)
+    assert cache.get('aa1').read_bytes() == b'image'
+    assert cache.size == 5
+    # Leftovers of a crash are cleaned up
+    assert not (tmp_path / 'aa' / 'aa2.tmp').exists()
+
+
+def test_thumbnails_made_by_another_process(tmp_path):
+    cache = ThumbnailCache(tmp_path)
+    ThumbnailCache(tmp_path).put('aa1', b'image')
+    assert cache.get('aa1').read_bytes() == b'image'
+    assert cache.size == 5
+
+
+def test_get_or_make(tmp_path):
+    cache = ThumbnailCache(tmp_path)
+    made = []
+
+    def make():
+        made.append(1)
+        return b'image'
+
+    assert cache.get_or_make('aa1', make).read_bytes() == b'image'
+    assert cache.get_or_make('aa1', make).read_bytes() == b'image'
+    assert len(made) == 1
+    assert cache.get_or_make('bb1', lambda: None) is None
+
+
+@pytest.fixture
+def album_with_art(library, tmp_path):
+    path = tmp_path / 'cover.png'
+    Image.new('RGB', (600, 600), 'red').save(path)
+    album = library.get_album(1)
+    album.artpath = str(path).encode()
+    album.store()
+    yield album
+    album.artpath = None
+    album.store()
+
+
+def test_resized_covers_are_cached(client, album_with_art):
+    response = client.get('/rest/getCoverArt?id=al-1&size=64')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    with Image.open(BytesIO(response.data)) as img:
+        assert img.size == (64, 64)
+
+    cache = thumbnail_cache()
+    assert response.headers['ETag'].strip('"') in cache
+    entries = len(cache._files)
+    assert client.get('/rest/getCoverArt?id=al-1&size=64').data == response.data
+    assert len(cache._files) == entries
+
+    # Without a size: the original file
+    response = client.get('/rest/getCoverArt?id=al-1')
+    assert response.mimetype == 'image/png'
+
+
+def test_embedded_art_without_size_is_not_cached(client, library, monkeypatch):
+    cover = BytesIO()
+    Image.new('RGB', (600, 600), 'blue').save(cover, format='JPEG')
+    monkeypatch.setattr(coverart, 'have_ffmpeg', True)
+    monkeypatch.setattr(coverart, 'extract_cover', lambda path: BytesIO(cover.getvalue()))
+
+    item = library.get_item(1)
+    item.album_id = None
+    item.store()
+    try:
+        cache = thumbnail_cache()
+        entries = len(cache._files)
+        response = client.get(f'/rest/getCoverArt?id=sg-{item.id}')
+        assert response.status_code == 200
+        assert response.data == cover.getvalue()
+        assert len(cache._files) == entries
+
+        # Resized: a thumbnail
+        response = client.get(f'/rest/getCoverArt?id=sg-{item.id}&size=32')
+        assert response.status_code == 200
+        assert len(cache._files) == entries + 1
+    finally:
+        item.album_id = 1
+        item.store()